@@ -1,4 +1,5 @@
 import asyncio
+import math
 import re
 import uuid
 from datetime import datetime
@@ -6,20 +7,19 @@ from typing import List, Optional, Dict, Any, Annotated
 
 from fastapi import APIRouter, HTTPException, Request, Depends
 from sse_starlette.sse import EventSourceResponse
-from concurrent.futures import ThreadPoolExecutor
+from starlette.background import BackgroundTask
 
 from api import schemas as api_schemas
 from db import schemas as db_schemas
 from db import crud
 from dependencies import (
-    DBSession, get_concrete_process, get_response_gen
+    DBSession, get_concrete_process, get_response_gen, get_admission
 )
 from architecture.concrete_understanding.base import ConcreteUnderstanding
 from architecture.user_response.generator import UserResponseGenerator
 from architecture.concrete_understanding.schema_architecture import EpisodeData
-
-# --- スレッドプール Executor ---
-inference_executor = ThreadPoolExecutor(max_workers=100)
+from lm_studio_rag.admission import AdmissionController, AdmissionRejected
+from lm_studio_rag.routing import STAGE_FINAL_RESPONSE
 
 # --- Helper Functions ---
 def extract_keywords(text: str) -> List[str]:
@@ -69,6 +69,31 @@ def parse_final_user_response(response_text: str) -> Dict[str, Any]:
     parsed_data["dialogue"] = response_text
     return parsed_data
 
+async def relay_token_events(task: asyncio.Task, token_queue: asyncio.Queue):
+    """Yield queued `token` SSE events until `task` finishes; cancels the task if the consumer goes away."""
+    getter = None
+    try:
+        while not task.done():
+            getter = asyncio.ensure_future(token_queue.get())
+            done, _ = await asyncio.wait({task, getter}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                yield getter.result()
+            else:
+                getter.cancel()
+        while not token_queue.empty():
+            yield token_queue.get_nowait()
+    finally:
+        if getter is not None and not getter.done():
+            getter.cancel()
+        if not task.done():
+            task.cancel()
+
+def token_event_sink(token_queue: asyncio.Queue, phase: str):
+    """Build an on_token(stage, delta) callback that enqueues `token` SSE events for `phase`."""
+    def on_token(stage: str, delta: str):
+        token_queue.put_nowait({"event": "token", "data": {"phase": phase, "stage": stage, "delta": delta}})
+    return on_token
+
 # --- Router Definition ---
 router = APIRouter()
 
@@ -104,7 +129,8 @@ async def stream_message(
     http_request: Request,
     db: DBSession,
     concrete_process: Annotated[ConcreteUnderstanding, Depends(get_concrete_process)],
-    response_gen: Annotated[UserResponseGenerator, Depends(get_response_gen)]
+    response_gen: Annotated[UserResponseGenerator, Depends(get_response_gen)],
+    admission: Annotated[AdmissionController, Depends(get_admission)]
 ):
     """Streams a response to a message within a specific thread."""
     # Verify thread exists
@@ -113,11 +139,20 @@ async def stream_message(
     if not thread:
         raise HTTPException(status_code=404, detail="THREAD_NOT_FOUND")
     # [temp]特にエラーの進行はなし
+    # Bounded admission: past the queue limit, fail fast instead of waiting until the client times out
+    try:
+        ticket = admission.enter()
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=503, detail="SERVER_BUSY", headers={"Retry-After": str(math.ceil(e.retry_after))})
 
     async def event_generator():
-        loop = asyncio.get_running_loop()
         start_time = datetime.now()
         try:
+            # Admitted but waiting: report queue position and estimated wait as they change
+            async for position, estimated_wait in admission.wait(ticket):
+                yield {"event": "queued", "data": {"position": position, "estimated_wait_ms": int(estimated_wait * 1000),
+                                                   "timestamp": datetime.now().isoformat()}}
+            start_time = datetime.now()
             # The logic from the old stream_message endpoint goes here.
             # It is adapted to use thread_id instead of session_id.
             # Check if client already disconnected before starting heavy work
@@ -126,8 +161,15 @@ async def stream_message(
                 return
             yield {"event": "phase_start", "data": {"phase": "abstract_recognition", "timestamp": datetime.now().isoformat()}}
             await asyncio.sleep(0)
-            # run inference in threadpool
-            abstract_cli_result, retrieved_experiences = await loop.run_in_executor(inference_executor, concrete_process.start_inference, message_req.message)
+            # LM calls are awaited directly on the pooled async client; estimation deltas are relayed as `token` events
+            token_queue: asyncio.Queue = asyncio.Queue()
+            # Retrieval is limited to the thread owner's partition (plus shared seed data)
+            inference_task = asyncio.create_task(concrete_process.start_inference_async(
+                message_req.message, on_token=token_event_sink(token_queue, "abstract_recognition"),
+                user_id=thread.owner_user_id))
+            async for token_event in relay_token_events(inference_task, token_queue):
+                yield token_event
+            abstract_cli_result, retrieved_experiences = inference_task.result()
             # If client disconnected while inference was running, stop early
             if await http_request.is_disconnected():
                 print(f"Client disconnected after abstract recognition: {thread_id}")
@@ -178,7 +220,12 @@ async def stream_message(
             if await http_request.is_disconnected():
                 print(f"Client disconnected before response generation: {thread_id}")
                 return
-            final_user_response = await loop.run_in_executor(inference_executor, response_gen.generate, abstract_cli_result, concrete_info, message_req.message)
+            response_task = asyncio.create_task(response_gen.generate_async(
+                abstract_cli_result, concrete_info, message_req.message,
+                on_token=token_event_sink(token_queue, "response_generation")))
+            async for token_event in relay_token_events(response_task, token_queue):
+                yield token_event
+            final_user_response = response_task.result()
             parsed_data = parse_final_user_response(final_user_response.dialogue) if "DECISION:" in final_user_response.dialogue or "ACTION:" in final_user_response.dialogue else {
                 "inferred_decision": final_user_response.inferred_decision,
                 "inferred_action": final_user_response.inferred_action,
@@ -205,7 +252,7 @@ async def stream_message(
                 response=final_response_data,
                 metadata={
                     "total_processing_time_ms": int((datetime.now() - start_time).total_seconds() * 1000),
-                    "model_used": "gemma-3-1b-it",
+                    "model_used": response_gen.alm.router.profile(STAGE_FINAL_RESPONSE).model,
                     "safety_check": "passed"
                 }
             )
@@ -229,4 +276,7 @@ async def stream_message(
             error_data = {"code": "INTERNAL_ERROR", "message": str(e), "timestamp": datetime.now().isoformat()}
             yield {"event": "error", "data": error_data, "retry": 10000}
             yield {"event": "stream_end", "data": {"status": "error", "timestamp": datetime.now().isoformat()}}
-    return EventSourceResponse(event_generator())
+        finally:
+            admission.release(ticket)
+    # release() is idempotent; the background task covers a response that is never iterated
+    return EventSourceResponse(event_generator(), background=BackgroundTask(admission.release, ticket))
@@ -1,6 +1,7 @@
 # archtecture_base
 from lm_studio_rag.storage import RAGStorage
 from lm_studio_rag.lm_studio_client import LMStudioClient
+from lm_studio_rag.routing import STAGE_EMOTION_ESTIMATION, STAGE_THINK_ESTIMATION
 from . import schama_architecture as schama
 from typing import List, Optional, Dict, Any
 
@@ -19,9 +20,9 @@ def artechture_base(storage: RAGStorage, field_info_input: str) -> Optional[scha
     # result_schama = schama.abstract_recognition_response()
     
     question_query:str = "「context_field_info」に書かれている状況において「context_experience」のような体験をしてきた人はどのような感情の動きをするのかを予測してください。"
-    emostion_result:str = lm.generate_response(question_query, context_texts if context_texts else "No relevant context found.","gemma-3-1b-it")
+    emostion_result:str = lm.generate_response(question_query, context_texts if context_texts else "No relevant context found.", stage=STAGE_EMOTION_ESTIMATION)
     question_query:str = "「context_field_info」に書かれている状況において「context_experience」のような体験をしてきた人はどのような思考をするのかを予測してくだい。"
-    think_result:str = lm.generate_response(question_query, context_texts if context_texts else "No relevant context found.","gemma-3-1b-it")
+    think_result:str = lm.generate_response(question_query, context_texts if context_texts else "No relevant context found.", stage=STAGE_THINK_ESTIMATION)
     print("RAG answer:\n", emostion_result)
     print("RAG answer:\n", think_result)
 
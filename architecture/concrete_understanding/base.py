@@ -1,12 +1,16 @@
 # architecture/concrete_understanding/base.py
+import asyncio
 import uuid
 from datetime import datetime
 from lm_studio_rag.storage import RAGStorage
-from lm_studio_rag.lm_studio_client import LMStudioClient
+from lm_studio_rag.partitions import PartitionedStorage
+from lm_studio_rag.rag_service import RAGServiceClient
+from lm_studio_rag.lm_studio_client import LMStudioClient, AsyncLMStudioClient
+from lm_studio_rag.routing import STAGE_RAG_QUERY, STAGE_EMOTION_ESTIMATION, STAGE_THINK_ESTIMATION
 from utils.yaml_load import load_yaml
 from . import schema_architecture as schema
 from ..abstract_recognition import schama_architecture as abstract_recognition_schema
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable, Union
 from pydantic import ValidationError
 
 class ConcreteUnderstanding:
@@ -15,23 +19,29 @@ class ConcreteUnderstanding:
     過去の経験に基づいて状況を理解する対話的なプロセスを管理し、
     ユーザーのフィードバックによる洗練を可能にします。
     """
-    def __init__(self, storage: RAGStorage, lm_client: Optional[LMStudioClient] = None):
+    def __init__(self, storage: Union[RAGStorage, PartitionedStorage, RAGServiceClient], lm_client: Optional[LMStudioClient] = None,
+                 async_lm_client: Optional[AsyncLMStudioClient] = None):
         """
         ConcreteUnderstandingプロセスを初期化します。
 
         Args:
             storage: 経験を取得するためのRAGStorageインスタンス。
+                     PartitionedStorage（または RAG サービスの RAGServiceClient）の場合、
+                     user_id を渡すとそのユーザーのパーティション（と共有データ）だけを検索します。
             lm_client: 言語モデル推論のためのLMStudioClientインスタンス。
                        Noneの場合、新しいクライアントが作成されます。
+            async_lm_client: start_inference_async で使う AsyncLMStudioClient インスタンス。
+                       Noneの場合、新しいクライアントが作成されます。
         """
         self.storage = storage
         self.lm = lm_client if lm_client else LMStudioClient()
+        self.alm = async_lm_client if async_lm_client else AsyncLMStudioClient()
         self.field_info: Optional[str] = None
         self.experience: Optional[List[Dict[str, Any]]] = None
         self.current_estimation: Optional[abstract_recognition_schema.abstract_recognition_response] = None
         self.history: List[Dict[str, Any]] = []
 
-    def start_inference(self, field_info_input: str) -> (Optional[abstract_recognition_schema.abstract_recognition_response], Optional[List[Dict[str, Any]]]):
+    def start_inference(self, field_info_input: str, user_id: Optional[str] = None) -> (Optional[abstract_recognition_schema.abstract_recognition_response], Optional[List[Dict[str, Any]]]):
         """
         初期の状況情報を用いて推論プロセスを開始します。
         これには、RAGシステムのための高品質なクエリの作成、経験の検索と評価、
@@ -39,6 +49,7 @@ class ConcreteUnderstanding:
 
         Args:
             field_info_input: 初期の状況や場面の情報。
+            user_id: 経験を検索するユーザー（PartitionedStorage のときのみ有効）。
 
         Returns:
             感情と思考の初期推定値と、検索された経験のリストのタプル。失敗した場合は(None, None)。
@@ -49,7 +60,7 @@ class ConcreteUnderstanding:
         rag_query = self._create_rag_query(field_info_input)
         
         print("関連する経験を検索中...")
-        retrieved_experiences = self.storage.search_similar(rag_query, category="experience", top_k=3)
+        retrieved_experiences = self._search_experiences(rag_query, user_id)
 
         self.experience = self._evaluate_retrieved_experiences(retrieved_experiences, rag_query)
         
@@ -58,12 +69,66 @@ class ConcreteUnderstanding:
         
         return self.current_estimation, self.experience
 
-    def _create_rag_query(self, field_info_input: str) -> str:
+    async def start_inference_async(self, field_info_input: str, on_token: Optional[Callable[[str, str], None]] = None,
+                                    user_id: Optional[str] = None) -> (Optional[abstract_recognition_schema.abstract_recognition_response], Optional[List[Dict[str, Any]]]):
         """
-        入力された状況情報を分析し、時間、人物、環境などの要素を抽出して、
-        RAGのための高品質なクエリを作成します。
+        start_inference の asyncio 版です。LM 呼び出しは AsyncLMStudioClient を直接 await し、
+        感情と思考の推定は並行して実行します。
+        ベクトル検索（CPU処理）のみスレッドに逃がします。
+
+        複数リクエストから同じインスタンスが共有されるため、途中の状態はローカル変数で保持し、
+        インスタンス属性は最後にまとめて更新します。
+
+        Args:
+            field_info_input: 初期の状況や場面の情報。
+            on_token: 指定された場合、感情・思考推定をストリーミングで生成し、
+                      トークン差分ごとに on_token(stage, delta) を呼び出します。
+                      stage は "emotion_estimation" または "think_estimation" です。
+            user_id: 経験を検索するユーザー（PartitionedStorage のときのみ有効）。
+
+        Returns:
+            感情と思考の初期推定値と、検索された経験のリストのタプル。
+        """
+        print("高品質なRAGクエリを作成中...")
+        rag_query = await self.alm.generate_response(
+            query=self._rag_query_prompt(field_info_input),
+            context="",
+            stage=STAGE_RAG_QUERY
+        )
+        print(f"生成されたRAGクエリ: {rag_query}")
+
+        print("関連する経験を検索中...")
+        retrieved_experiences = await asyncio.to_thread(self._search_experiences, rag_query, user_id)
+        experience = self._evaluate_retrieved_experiences(retrieved_experiences, rag_query)
+
+        print("初期推定を開始中...")
+        context_texts, emotion_query, think_query = self._estimation_prompts(experience, field_info_input)
+        emostion_result, think_result = await asyncio.gather(
+            self._agenerate(emotion_query, context_texts, STAGE_EMOTION_ESTIMATION, on_token),
+            self._agenerate(think_query, context_texts, STAGE_THINK_ESTIMATION, on_token),
+        )
+
+        self.field_info = field_info_input
+        self.experience = experience
+        estimation = self._record_estimation(emostion_result, think_result)
+        return estimation, experience
+
+    async def _agenerate(self, query: str, context: str, stage: str, on_token: Optional[Callable[[str, str], None]]) -> str:
+        """
+        stage のルーティング設定（モデル・max_tokens など）で生成します。
+        on_token があればストリーミングで生成して差分を通知し、全文を返します。
         """
-        prompt = f"""
+        if on_token is None:
+            return await self.alm.generate_response(query, context, stage=stage)
+        parts: List[str] = []
+        async for delta in self.alm.generate_response_stream(query, context, stage=stage):
+            parts.append(delta)
+            on_token(stage, delta)
+        return "".join(parts)
+
+    @staticmethod
+    def _rag_query_prompt(field_info_input: str) -> str:
+        return f"""
         以下の状況説明文から、検索クエリとして利用するための重要な要素（時間、人物、環境）を抽出してください。
         そして、それらの要素を組み合わせた自然な文章の検索クエリを作成してください。
 
@@ -72,17 +137,31 @@ class ConcreteUnderstanding:
 
         検索クエリ:
         """
-        
+
+    def _create_rag_query(self, field_info_input: str) -> str:
+        """
+        入力された状況情報を分析し、時間、人物、環境などの要素を抽出して、
+        RAGのための高品質なクエリを作成します。
+        """
         # LMを使用してクエリを生成します。
         generated_query = self.lm.generate_response(
-            query=prompt,
+            query=self._rag_query_prompt(field_info_input),
             context="", # この部分には追加のコンテキストは不要
-            model="gemma-3-1b-it"
+            stage=STAGE_RAG_QUERY
         )
         
         print(f"生成されたRAGクエリ: {generated_query}")
         return generated_query
 
+    def _search_experiences(self, rag_query: str, user_id: Optional[str]) -> List[Dict[str, Any]]:
+        """
+        関連する経験を検索します。user_id があり storage が PartitionedStorage の場合は、
+        そのユーザーのパーティションと共有データだけを検索します（他ユーザーの経験は混ざりません）。
+        """
+        if user_id is not None and isinstance(self.storage, (PartitionedStorage, RAGServiceClient)):
+            return self.storage.search_similar(rag_query, category="experience", top_k=3, user_id=user_id)
+        return self.storage.search_similar(rag_query, category="experience", top_k=3)
+
     def _evaluate_retrieved_experiences(self, experiences: List[Dict[str, Any]], query: str) -> List[Dict[str, Any]]:
         """
         検索された経験がクエリと関連性があるか評価します。
@@ -98,16 +177,35 @@ class ConcreteUnderstanding:
         言語モデルを使用して推定を実行します。
         初期推定、またはフィードバックに基づく再推定に使用できます。
         """
+        context_texts, emotion_query, think_query = self._estimation_prompts(
+            self.experience, self.field_info, feedback, self.current_estimation
+        )
+
+        emostion_result: str = self.lm.generate_response(emotion_query, context_texts, stage=STAGE_EMOTION_ESTIMATION)
+        think_result: str = self.lm.generate_response(think_query, context_texts, stage=STAGE_THINK_ESTIMATION)
+
+        self._record_estimation(emostion_result, think_result, feedback)
+
+    @staticmethod
+    def _estimation_prompts(
+        experience: Optional[List[Dict[str, Any]]],
+        field_info: Optional[str],
+        feedback: Optional[str] = None,
+        previous: Optional[abstract_recognition_schema.abstract_recognition_response] = None,
+    ) -> (str, str, str):
+        """
+        推定用のコンテキストと、感情・思考それぞれの質問文を組み立てます。
+        """
         if feedback:
             # コンテキストには、前回の推定と新しいフィードバックが含まれます
             context_texts = f"""
             前回のコンテキスト:
-              context_experience:{self.experience}
-              context_field_info:{self.field_info}
+              context_experience:{experience}
+              context_field_info:{field_info}
             
             前回の推定:
-              Emotion: {self.current_estimation.emotion_estimation if self.current_estimation else 'N/A'}
-              Thought: {self.current_estimation.think_estimation if self.current_estimation else 'N/A'}
+              Emotion: {previous.emotion_estimation if previous else 'N/A'}
+              Thought: {previous.think_estimation if previous else 'N/A'}
 
             ユーザーフィードバック:
               {feedback}
@@ -118,29 +216,34 @@ class ConcreteUnderstanding:
             # 初期コンテキスト
             context_texts = f"""
             コンテキスト:
-              context_experience:{self.experience}
-              context_field_info:{self.field_info}
+              context_experience:{experience}
+              context_field_info:{field_info}
             """
             emotion_query = "「context_field_info」に書かれている状況において「context_experience」のような体験をしてきた人はどのような感情の動きをするのかを予測してください。"
             think_query = "「context_field_info」に書かれている状況において「context_experience」のような体験をしてきた人はどのような思考をするのかを予測してくだい。"
+        return context_texts, emotion_query, think_query
 
-        emostion_result: str = self.lm.generate_response(emotion_query, context_texts, "gemma-3-1b-it")
-        think_result: str = self.lm.generate_response(think_query, context_texts, "gemma-3-1b-it")
-        
+    def _record_estimation(self, emostion_result: str, think_result: str, feedback: Optional[str] = None) -> Optional[abstract_recognition_schema.abstract_recognition_response]:
+        """
+        推定結果をスキーマに詰めて現在の推定と履歴に反映します。
+        """
         print("RAGの回答 (感情):\n", emostion_result)
         print("RAGの回答 (思考):\n", think_result)
 
         try:
-            self.current_estimation = abstract_recognition_schema.abstract_recognition_response(
+            estimation = abstract_recognition_schema.abstract_recognition_response(
                 emotion_estimation=emostion_result,
                 think_estimation=think_result
             )
-            self.history.append({"estimation": self.current_estimation, "feedback": feedback})
+            self.current_estimation = estimation
+            self.history.append({"estimation": estimation, "feedback": feedback})
+            return estimation
         except ValidationError as e:
             print(f"スキーマのバリデーションに失敗しました: {e}")
             # バリデーションエラーの場合、現在の推定は更新しませんが、
             # このイベントをログに記録すべきでしょう。
             self.history.append({"error": str(e), "feedback": feedback})
+            return None
 
     def process_user_feedback(self, user_input: str) -> Optional[abstract_recognition_schema.abstract_recognition_response]:
         """
@@ -1,5 +1,6 @@
 from lm_studio_rag.storage import RAGStorage
 from lm_studio_rag.lm_studio_client import LMStudioClient
+from lm_studio_rag.routing import STAGE_DECISION_INFERENCE, STAGE_STRUCTURED_RESPONSE
 from ..abstract_recognition.base import artechture_base
 from ..concrete_understanding.base import ConcreteUnderstanding
 from .schema_response import UserResponse
@@ -121,7 +122,7 @@ class ResponseGenerator:
         意思決定:
         行動:
         """
-        response = self.lm.generate_response(prompt, "", "gemma-3-1b-it")
+        response = self.lm.generate_response(prompt, "", stage=STAGE_DECISION_INFERENCE)
         
         # レスポンスから意思決定と行動をパースする（簡易的な実装）
         decision = "不明な意思決定"
@@ -175,7 +176,7 @@ class ResponseGenerator:
         - **DIALOGUE:** (ユーザーへの発話内容のみを「」で括って記述。地の文は含めない)
         - **BEHAVIOR:** (発話に伴う、客観的に観測可能な物理的行動を記述。例:「PCに向き直り、キーボードを叩き始めた」)
         """
-        response_text = self.lm.generate_response(prompt, "", "gemma-3-1b-it")
+        response_text = self.lm.generate_response(prompt, "", stage=STAGE_STRUCTURED_RESPONSE)
 
         # レスポンスをパースして辞書に格納
         parsed_response = {
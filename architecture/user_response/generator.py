@@ -1,6 +1,8 @@
 # architecture/user_response/generator.py
 import re
-from lm_studio_rag.lm_studio_client import LMStudioClient
+from typing import Callable, List, Optional
+from lm_studio_rag.lm_studio_client import LMStudioClient, AsyncLMStudioClient
+from lm_studio_rag.routing import STAGE_FINAL_RESPONSE
 from .schema import UserResponse
 from ..abstract_recognition.schama_architecture import abstract_recognition_response
 from ..concrete_understanding.schema_architecture import EpisodeData
@@ -11,8 +13,12 @@ class UserResponseGenerator:
     抽象的理解（デフォルメ）と具象的理解（具現化）を統合し、
     ユーザーの意思決定、行動、そして最終的な応答を推論するクラス。
     """
-    def __init__(self, lm_client: LMStudioClient = None):
+    # 生成指示（コンテキストとは別に query として渡す）
+    PROMPT = "上記の指示と入力情報に従って、思考プロセスを実行し、指定された出力形式で応答を生成してください。"
+
+    def __init__(self, lm_client: LMStudioClient = None, async_lm_client: AsyncLMStudioClient = None):
         self.lm = lm_client if lm_client else LMStudioClient()
+        self.alm = async_lm_client if async_lm_client else AsyncLMStudioClient()
 
     def generate(
         self,
@@ -23,7 +29,42 @@ class UserResponseGenerator:
         """
         与えられた抽象的・具象的情報から、最終的なユーザー応答を生成します。
         """
-        context = f"""
+        raw_response = self.lm.generate_response(
+            query=self.PROMPT,
+            context=self._build_context(abstract_info, field_info),
+            stage=STAGE_FINAL_RESPONSE
+        )
+        return self._parse_response(raw_response)
+
+    async def generate_async(
+        self,
+        abstract_info: abstract_recognition_response,
+        concrete_info: EpisodeData,
+        field_info: str,
+        on_token: Optional[Callable[[str, str], None]] = None
+    ) -> UserResponse:
+        """
+        generate の asyncio 版です。AsyncLMStudioClient を直接 await します。
+        on_token が指定された場合はストリーミングで生成し、差分ごとに on_token("final_response", delta) を呼び出します。
+        """
+        context = self._build_context(abstract_info, field_info)
+        if on_token is None:
+            raw_response = await self.alm.generate_response(
+                query=self.PROMPT,
+                context=context,
+                stage=STAGE_FINAL_RESPONSE
+            )
+        else:
+            parts: List[str] = []
+            async for delta in self.alm.generate_response_stream(query=self.PROMPT, context=context, stage=STAGE_FINAL_RESPONSE):
+                parts.append(delta)
+                on_token(STAGE_FINAL_RESPONSE, delta)
+            raw_response = "".join(parts)
+        return self._parse_response(raw_response)
+
+    @staticmethod
+    def _build_context(abstract_info: abstract_recognition_response, field_info: str) -> str:
+        return f"""
         # 指示
         あなたは、これから与えられる情報を持つ「人物そのもの」です。
         あなた自身の過去の経験（抽象的理解）と、現在の具体的な状況（具象的理解）に基づいて、あたかもあなたがその人物であるかのように、一人称視点（「私」）で思考し、応答してください。
@@ -53,13 +94,11 @@ class UserResponseGenerator:
         - **BEHAVIOR:** (発話に伴う、客観的に観測可能な物理的行動を記述。例:「PCに向き直り、キーボードを叩き始めた」)
         """
 
-        prompt = "上記の指示と入力情報に従って、思考プロセスを実行し、指定された出力形式で応答を生成してください。"
-
-        raw_response = self.lm.generate_response(
-            query=prompt,
-            context=context,
-            model="gemma-3-1b-it"
-        )
+    @staticmethod
+    def _parse_response(raw_response: str) -> UserResponse:
+        """
+        LLMの生の応答を UserResponse にパースします。パースに失敗した場合は応答全体を dialogue に入れます。
+        """
         print(f"「LLMの回答」@@@\n{raw_response}\n@@@")
 
         try:
@@ -1,7 +1,8 @@
 from typing import Annotated
 from fastapi import Depends
 from lm_studio_rag.storage import RAGStorage
-from lm_studio_rag.lm_studio_client import LMStudioClient
+from lm_studio_rag.lm_studio_client import LMStudioClient, AsyncLMStudioClient
+from lm_studio_rag.admission import AdmissionController
 from architecture.concrete_understanding.base import ConcreteUnderstanding
 from architecture.user_response.generator import UserResponseGenerator
 
@@ -19,6 +20,10 @@ def get_lm_client() -> LMStudioClient:
     """LMStudioClientを返す（実体はmain.pyで注入）"""
     raise NotImplementedError("Must be overridden in main_api.py")
 
+def get_async_lm_client() -> AsyncLMStudioClient:
+    """AsyncLMStudioClientを返す（実体はmain.pyで注入）"""
+    raise NotImplementedError("Must be overridden in main_api.py")
+
 def get_concrete_process() -> ConcreteUnderstanding:
     """ConcreteUnderstandingを返す（実体はmain.pyで注入）"""
     raise NotImplementedError("Must be overridden in main_api.py")
@@ -27,4 +32,8 @@ def get_response_gen() -> UserResponseGenerator:
     """UserResponseGeneratorを返す（実体はmain.pyで注入）"""
     raise NotImplementedError("Must be overridden in main_api.py")
 
+def get_admission() -> AdmissionController:
+    """AdmissionControllerを返す（実体はmain.pyで注入）"""
+    raise NotImplementedError("Must be overridden in main_api.py")
+
 DBSession = Annotated[AsyncSession, Depends(get_db)]
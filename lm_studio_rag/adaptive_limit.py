@@ -0,0 +1,107 @@
+# adaptive_limit.py
+import math
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from .config import LLM_ADAPTIVE_MIN_LIMIT, LLM_ADAPTIVE_MAX_LIMIT
+
+ALGORITHM_AIMD = "aimd"
+ALGORITHM_GRADIENT = "gradient"
+
+_HISTORY = 200
+
+
+class AdaptiveLimit:
+    """
+    Discovers a backend's concurrency limit from observed latency instead of a fixed worker count.
+    Each completed call reports (rtt, in_flight, dropped); rtt is measured from slot grant
+    (so our own queueing does not count) to the response, or to the first token for streams.
+     - aimd:     +1/limit per fast sample while the limit is saturated; x backoff_ratio when the sample
+                 exceeds `tolerance` x the long-term RTT
+     - gradient: limit = limit * clamp(tolerance * long_rtt / short_rtt, 0.5, 1) + sqrt(limit), smoothed
+    Errors (dropped) always back off multiplicatively. Decreases happen at most once per short RTT,
+    so one burst of slow responses does not collapse the limit.
+    """
+
+    def __init__(self, algorithm: str = ALGORITHM_GRADIENT, initial_limit: int = 4,
+                 min_limit: int = LLM_ADAPTIVE_MIN_LIMIT, max_limit: int = LLM_ADAPTIVE_MAX_LIMIT,
+                 tolerance: float = 1.5, backoff_ratio: float = 0.9, smoothing: float = 0.2,
+                 long_window: int = 100, short_window: int = 10):
+        if algorithm not in (ALGORITHM_AIMD, ALGORITHM_GRADIENT):
+            raise ValueError(f"unknown adaptive limit algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff_ratio = backoff_ratio
+        self.smoothing = smoothing
+        self._long_alpha = 2.0 / (long_window + 1)
+        self._short_alpha = 2.0 / (short_window + 1)
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._long_rtt: Optional[float] = None
+        self._short_rtt: Optional[float] = None
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        self._samples = 0
+        self._drops = 0
+        self.history: Deque[tuple] = deque([(time.time(), int(self._limit))], maxlen=_HISTORY)
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def update(self, rtt: float, in_flight: int, dropped: bool = False) -> int:
+        with self._lock:
+            self._samples += 1
+            now = time.monotonic()
+            if dropped:
+                self._drops += 1
+                self._decrease(now)
+                return self._commit()
+
+            self._short_rtt = rtt if self._short_rtt is None else self._short_rtt + self._short_alpha * (rtt - self._short_rtt)
+            self._long_rtt = rtt if self._long_rtt is None else self._long_rtt + self._long_alpha * (rtt - self._long_rtt)
+            saturated = in_flight >= self._limit - 1
+
+            if self.algorithm == ALGORITHM_AIMD:
+                if rtt > self._long_rtt * self.tolerance:
+                    self._decrease(now)
+                elif saturated:
+                    self._limit += 1.0 / self._limit
+            else:
+                gradient = max(0.5, min(1.0, self.tolerance * self._long_rtt / self._short_rtt))
+                if gradient < 1.0 or saturated:
+                    # only grow when the limit is actually what holds us back
+                    target = self._limit * gradient + math.sqrt(self._limit)
+                    if target < self._limit and now - self._last_decrease < self._short_rtt:
+                        target = self._limit
+                    elif target < self._limit:
+                        self._last_decrease = now
+                    self._limit += self.smoothing * (target - self._limit)
+            return self._commit()
+
+    def _decrease(self, now: float):
+        if self._short_rtt is not None and now - self._last_decrease < self._short_rtt:
+            return
+        self._last_decrease = now
+        self._limit *= self.backoff_ratio
+
+    def _commit(self) -> int:
+        self._limit = min(max(self._limit, self.min_limit), self.max_limit)
+        if int(self._limit) != self.history[-1][1]:
+            self.history.append((time.time(), int(self._limit)))
+        return int(self._limit)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "algorithm": self.algorithm,
+                "limit": int(self._limit),
+                "samples": self._samples,
+                "drops": self._drops,
+                "short_rtt_ms": self._short_rtt * 1000 if self._short_rtt is not None else None,
+                "long_rtt_ms": self._long_rtt * 1000 if self._long_rtt is not None else None,
+                "history": list(self.history)[-20:],
+            }
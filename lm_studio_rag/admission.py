@@ -0,0 +1,134 @@
+# admission.py
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, Optional, Tuple
+
+from .config import STREAM_MAX_ACTIVE, STREAM_MAX_QUEUE
+
+logger = logging.getLogger("admission")
+
+_DURATION_SAMPLES = 100
+_DEFAULT_DURATION = 10.0  # seconds per request until the first ones have completed
+
+
+class AdmissionRejected(Exception):
+    """The wait queue is full; `retry_after` is the estimated seconds until a slot frees up."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"server busy, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    __slots__ = ("enqueued_at", "admitted_at", "released", "_changed")
+
+    def __init__(self):
+        self.enqueued_at = time.monotonic()
+        self.admitted_at: Optional[float] = None
+        self.released = False
+        self._changed = asyncio.Event()
+
+    @property
+    def admitted(self) -> bool:
+        return self.admitted_at is not None
+
+
+class AdmissionController:
+    """
+    Bounded admission for whole requests (one SSE stream = several LLM calls).
+     - at most `max_active` requests run at once; the rest wait FIFO
+     - once `max_queue` requests are waiting, enter() rejects immediately with AdmissionRejected,
+       so a doomed request does not hold a connection until the client times out
+     - waiting requests can follow their queue position and estimated wait via wait()
+    Estimates use the median duration of recently completed requests. Event-loop only (not thread-safe).
+    """
+
+    def __init__(self, max_active: int = STREAM_MAX_ACTIVE, max_queue: int = STREAM_MAX_QUEUE, name: str = "stream"):
+        self.name = name
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self._active = 0
+        self._queue: Deque[AdmissionTicket] = deque()
+        self._durations: Deque[float] = deque(maxlen=_DURATION_SAMPLES)
+        self._waits: Deque[float] = deque(maxlen=_DURATION_SAMPLES)
+        self._counters = {"admitted": 0, "rejected": 0, "abandoned": 0}
+
+    # --- estimates ---
+    def _typical_duration(self) -> float:
+        if not self._durations:
+            return _DEFAULT_DURATION
+        return sorted(self._durations)[len(self._durations) // 2]
+
+    def estimated_wait(self, position: int) -> float:
+        """Seconds until the request at 1-based queue `position` is admitted."""
+        return math.ceil(position / max(self.max_active, 1)) * self._typical_duration()
+
+    def position(self, ticket: AdmissionTicket) -> int:
+        return self._queue.index(ticket) + 1
+
+    # --- enter / wait / release ---
+    def enter(self) -> AdmissionTicket:
+        """Admit or queue a request. Raises AdmissionRejected when the queue is already full."""
+        if self._active >= self.max_active and len(self._queue) >= self.max_queue:
+            self._counters["rejected"] += 1
+            raise AdmissionRejected(max(1.0, self.estimated_wait(len(self._queue) + 1)))
+        ticket = AdmissionTicket()
+        if self._active < self.max_active and not self._queue:
+            self._admit(ticket)
+        else:
+            self._queue.append(ticket)
+        return ticket
+
+    async def wait(self, ticket: AdmissionTicket) -> AsyncIterator[Tuple[int, float]]:
+        """Yield (position, estimated_wait_seconds) whenever the position changes, until admitted."""
+        last = None
+        while not ticket.admitted:
+            ticket._changed.clear()
+            position = self.position(ticket)
+            if position != last:
+                last = position
+                yield position, self.estimated_wait(position)
+            await ticket._changed.wait()
+
+    def release(self, ticket: AdmissionTicket):
+        """Finish or abandon a request. Idempotent, so it can be called from several cleanup paths."""
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.admitted:
+            self._active -= 1
+            self._durations.append(time.monotonic() - ticket.admitted_at)
+        else:
+            self._queue.remove(ticket)
+            self._counters["abandoned"] += 1
+        self._dispatch()
+
+    def _admit(self, ticket: AdmissionTicket):
+        self._active += 1
+        ticket.admitted_at = time.monotonic()
+        self._waits.append(ticket.admitted_at - ticket.enqueued_at)
+        self._counters["admitted"] += 1
+        ticket._changed.set()
+
+    def _dispatch(self):
+        while self._queue and self._active < self.max_active:
+            self._admit(self._queue.popleft())
+        # everyone still waiting moved up (or the head left); let them report their new position
+        for waiting in self._queue:
+            waiting._changed.set()
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+        return dict(
+            self._counters,
+            name=self.name,
+            max_active=self.max_active,
+            max_queue=self.max_queue,
+            active=self._active,
+            queued=len(self._queue),
+            typical_duration_ms=self._typical_duration() * 1000,
+            wait_p95_ms=waits[int(0.95 * (len(waits) - 1))] * 1000 if waits else 0.0,
+        )
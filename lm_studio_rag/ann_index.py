@@ -0,0 +1,296 @@
+# ann_index.py
+"""
+FAISS index kinds used by RAGStorage, and a recall@k / latency / memory report to choose their settings.
+Every kind keeps documents' durable 64-bit ids (flat and hnsw through an IndexIDMap2; IVF stores the ids
+in its inverted lists, and must not be wrapped: IndexIDMap's remove_ids assumes flat-style renumbering):
+ - "flat":  exhaustive inner-product search (IndexFlatIP)
+ - "ivfpq": inverted lists + product quantization (IndexIVFPQ); needs training, searched with `nprobe`
+ - "hnsw":  graph search (IndexHNSWFlat); searched with `efSearch`, cannot remove vectors
+Flat and hnsw can store compact vectors instead of float32 ("float16", or "int8" scalar quantization with a
+per-dimension range; IndexScalarQuantizer / IndexHNSWSQ), and any kind can search a PCA projection of the
+vectors (IndexPreTransform). Both need training data and lose precision; RAGStorage rescores their top
+candidates against the full-precision vectors it keeps on disk.
+
+    python -m lm_studio_rag.ann_index --vectors 200000 --dim 384 --k 10
+    python -m lm_studio_rag.ann_index --index ./faiss.index --k 10
+    python -m lm_studio_rag.ann_index --codecs float32 float16 int8 --pca 128
+"""
+import argparse
+import logging
+import math
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .config import (
+    FAISS_IVF_NLIST, FAISS_PQ_M, FAISS_HNSW_M, FAISS_NPROBE, FAISS_EF_SEARCH, FAISS_RESCORE_FACTOR,
+)
+
+logger = logging.getLogger("ann_index")
+
+INDEX_FLAT = "flat"
+INDEX_IVFPQ = "ivfpq"
+INDEX_HNSW = "hnsw"
+INDEX_KINDS = (INDEX_FLAT, INDEX_IVFPQ, INDEX_HNSW)
+
+# vector codecs of flat / hnsw indexes (ivfpq has its own: product quantization)
+CODEC_FLOAT32 = "float32"
+CODEC_FLOAT16 = "float16"
+CODEC_INT8 = "int8"
+CODECS = (CODEC_FLOAT32, CODEC_FLOAT16, CODEC_INT8)
+
+_TRAIN_SAMPLE = 100_000  # k-means on more points than this buys little
+
+
+def _faiss():
+    import faiss
+    return faiss
+
+
+def base_index(index):
+    """The innermost index, under the IndexIDMap2 and PCA IndexPreTransform wrappers."""
+    faiss = _faiss()
+    if isinstance(index, faiss.IndexIDMap2):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexPreTransform):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def index_kind(index) -> str:
+    """Kind of an index built by build_index()."""
+    faiss = _faiss()
+    base = base_index(index)
+    if isinstance(base, faiss.IndexIVF):
+        return INDEX_IVFPQ
+    if isinstance(base, faiss.IndexHNSW):
+        return INDEX_HNSW
+    return INDEX_FLAT
+
+
+def index_codec(index) -> str:
+    """Scalar codec of the stored vectors (CODEC_FLOAT32 for full vectors and for ivfpq, which has PQ codes)."""
+    faiss = _faiss()
+    base = base_index(index)
+    storage = faiss.downcast_index(base.storage) if isinstance(base, faiss.IndexHNSW) else base
+    if isinstance(storage, faiss.IndexScalarQuantizer):
+        return CODEC_FLOAT16 if storage.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else CODEC_INT8
+    return CODEC_FLOAT32
+
+
+def index_pca_dim(index) -> int:
+    """Output dimension of the index's PCA projection; 0 without one."""
+    faiss = _faiss()
+    if isinstance(index, faiss.IndexIDMap2):
+        index = faiss.downcast_index(index.index)
+    return index.index.d if isinstance(index, faiss.IndexPreTransform) else 0
+
+
+def is_lossy(index) -> bool:
+    """Whether search scores are approximate (quantized or projected vectors), so hits are worth rescoring."""
+    return index_kind(index) == INDEX_IVFPQ or index_codec(index) != CODEC_FLOAT32 or bool(index_pca_dim(index))
+
+
+def vector_bytes(index) -> int:
+    """Approximate resident bytes per vector: its code and id, plus the level-0 links of an hnsw graph."""
+    faiss = _faiss()
+    base = base_index(index)
+    if isinstance(base, faiss.IndexHNSW):
+        return faiss.downcast_index(base.storage).sa_code_size() + 8 + 4 * base.hnsw.nb_neighbors(0)
+    return base.sa_code_size() + 8
+
+
+def supports_remove(index) -> bool:
+    # HNSW graphs cannot unlink nodes; stale vectors stay until the index is rebuilt
+    return index_kind(index) != INDEX_HNSW
+
+
+def ivf_nlist(n: int) -> int:
+    """FAISS_IVF_NLIST, or about 4*sqrt(n) lists while keeping >= 39 training points per list."""
+    nlist = FAISS_IVF_NLIST or int(4 * math.sqrt(max(n, 1)))
+    return max(1, min(nlist, n // 39 or 1))
+
+
+def pq_m(dim: int) -> int:
+    """Largest number of PQ sub-quantizers <= FAISS_PQ_M that divides dim."""
+    return next(m for m in range(min(FAISS_PQ_M, dim), 0, -1) if dim % m == 0)
+
+
+def build_index(kind: str, dim: int, vectors: Optional[np.ndarray] = None, ids: Optional[np.ndarray] = None,
+                codec: str = CODEC_FLOAT32, pca_dim: int = 0):
+    """
+    Empty (or filled, when `vectors`/`ids` are given) index of the given kind over inner product.
+    `codec` (flat / hnsw) stores vectors as float16 or int8 instead of float32; `pca_dim` > 0 indexes the
+    PCA projection of the vectors to that many dimensions. Trainable layouts are trained on `vectors`:
+    "ivfpq" needs at least 256 of them (one per PQ centroid), int8 and PCA at least one.
+    """
+    faiss = _faiss()
+    if codec not in CODECS:
+        raise ValueError(f"unknown vector codec {codec!r}; expected one of {CODECS}")
+    inner_dim = pca_dim or dim
+    qtype = faiss.ScalarQuantizer.QT_fp16 if codec == CODEC_FLOAT16 else faiss.ScalarQuantizer.QT_8bit
+    if kind == INDEX_FLAT:
+        base = (faiss.IndexFlatIP(inner_dim) if codec == CODEC_FLOAT32
+                else faiss.IndexScalarQuantizer(inner_dim, qtype, faiss.METRIC_INNER_PRODUCT))
+    elif kind == INDEX_HNSW:
+        base = (faiss.IndexHNSWFlat(inner_dim, FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT) if codec == CODEC_FLOAT32
+                else faiss.IndexHNSWSQ(inner_dim, qtype, FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT))
+        base.hnsw.efConstruction = max(40, 2 * FAISS_HNSW_M)
+    elif kind == INDEX_IVFPQ:
+        if vectors is None or len(vectors) < 256:
+            raise ValueError("an ivfpq index needs at least 256 training vectors")
+        base = faiss.IndexIVFPQ(faiss.IndexFlatIP(inner_dim), inner_dim, ivf_nlist(len(vectors)), pq_m(inner_dim), 8,
+                                faiss.METRIC_INNER_PRODUCT)
+    else:
+        raise ValueError(f"unknown FAISS index kind {kind!r}; expected one of {INDEX_KINDS}")
+    if pca_dim:
+        if not 0 < pca_dim < dim:
+            raise ValueError(f"pca_dim must be between 1 and {dim - 1}, got {pca_dim}")
+        base = faiss.IndexPreTransform(faiss.PCAMatrix(dim, pca_dim), base)
+    if not base.is_trained:
+        if vectors is None or not len(vectors):
+            raise ValueError(f"a {kind} index with codec={codec}, pca_dim={pca_dim} needs training vectors")
+        sample = vectors
+        if len(vectors) > _TRAIN_SAMPLE:
+            sample = vectors[np.random.default_rng(0).choice(len(vectors), _TRAIN_SAMPLE, replace=False)]
+        base.train(np.ascontiguousarray(sample, dtype=np.float32))
+    index = base if kind == INDEX_IVFPQ else faiss.IndexIDMap2(base)
+    if vectors is not None and len(vectors):
+        index.add_with_ids(np.ascontiguousarray(vectors, dtype=np.float32), np.asarray(ids, dtype=np.int64))
+    return index
+
+
+def search_params(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None, sel=None):
+    """
+    Per-call SearchParameters for the index kind, defaulting to FAISS_NPROBE / FAISS_EF_SEARCH
+    (None for an unfiltered flat search). `sel` (an IDSelector over document ids) restricts the scan;
+    the caller must keep it alive until the search returns.
+    """
+    faiss = _faiss()
+    kind = index_kind(index)
+    extra = {"sel": sel} if sel is not None else {}
+    if kind == INDEX_IVFPQ:
+        return faiss.SearchParametersIVF(nprobe=nprobe or FAISS_NPROBE, **extra)
+    if kind == INDEX_HNSW:
+        return faiss.SearchParametersHNSW(efSearch=ef_search or FAISS_EF_SEARCH, **extra)
+    return faiss.SearchParameters(**extra) if extra else None
+
+
+# --- recall / latency / memory report ---
+def recall_report(vectors: np.ndarray, queries: np.ndarray, k: int = 10,
+                  nprobes: Sequence[int] = (1, 4, 8, 16, 32, 64),
+                  ef_searches: Sequence[int] = (16, 32, 64, 128, 256),
+                  codecs: Sequence[str] = (), pca_dims: Sequence[int] = (),
+                  rescore: int = FAISS_RESCORE_FACTOR) -> List[Dict[str, Any]]:
+    """
+    Recall@k of each ANN setting against exact search, with per-query latency (one query per search call,
+    as RAGStorage issues them) and resident bytes per vector. Vectors and queries should be L2-normalized.
+    Every compact layout (each of `codecs` with and without each of `pca_dims`) is measured as flat and as
+    hnsw at FAISS_EF_SEARCH, each also with its top k*`rescore` candidates rescored against the full
+    vectors, as RAGStorage does (its full vectors live on disk, so they are not counted as resident).
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    ids = np.arange(len(vectors), dtype=np.int64)
+    rows = []
+
+    def measure(kind: str, index, build_ms: float, setting: str, params, truth=None, rescore_factor: int = 0):
+        latencies, found = [], []
+        for q in queries:
+            start = time.perf_counter()
+            _, I = index.search(q[None, :], k * max(rescore_factor, 1), params=params)
+            hits = I[0][I[0] >= 0]
+            if rescore_factor:
+                hits = hits[np.argsort(-(vectors[hits] @ q))[:k]]
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append(hits)
+        latencies.sort()
+        row = {
+            "index": kind, "setting": setting + (f" rescore={rescore_factor}" if rescore_factor else ""),
+            "build_ms": build_ms, "bytes_per_vector": vector_bytes(index),
+            "p50_ms": latencies[len(latencies) // 2], "p95_ms": latencies[int(0.95 * (len(latencies) - 1))],
+            "recall": 1.0 if truth is None else float(np.mean(
+                [len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])),
+        }
+        rows.append(row)
+        return found
+
+    def build(kind: str, codec: str = CODEC_FLOAT32, pca_dim: int = 0):
+        start = time.perf_counter()
+        index = build_index(kind, vectors.shape[1], vectors, ids, codec=codec, pca_dim=pca_dim)
+        return index, (time.perf_counter() - start) * 1000
+
+    builds = {kind: build(kind) for kind in (INDEX_FLAT, INDEX_IVFPQ, INDEX_HNSW)}
+    truth = measure(INDEX_FLAT, *builds[INDEX_FLAT], "exact", None)
+    for nprobe in nprobes:
+        index, build_ms = builds[INDEX_IVFPQ]
+        measure(INDEX_IVFPQ, index, build_ms, f"nprobe={nprobe}", search_params(index, nprobe=nprobe), truth)
+    if rescore:
+        index, build_ms = builds[INDEX_IVFPQ]
+        measure(INDEX_IVFPQ, index, build_ms, f"nprobe={FAISS_NPROBE}", search_params(index), truth, rescore)
+    for ef in ef_searches:
+        index, build_ms = builds[INDEX_HNSW]
+        measure(INDEX_HNSW, index, build_ms, f"efSearch={ef}", search_params(index, ef_search=max(ef, k)), truth)
+
+    layouts = [(codec, pca_dim) for codec in (codecs or (CODEC_FLOAT32,)) for pca_dim in (0, *pca_dims)]
+    for codec, pca_dim in layouts:
+        if (codec, pca_dim) == (CODEC_FLOAT32, 0):
+            continue
+        label = codec + (f" pca={pca_dim}" if pca_dim else "")
+        for kind in (INDEX_FLAT, INDEX_HNSW):
+            index, build_ms = build(kind, codec, pca_dim)
+            setting = label if kind == INDEX_FLAT else f"{label} efSearch={FAISS_EF_SEARCH}"
+            params = search_params(index, ef_search=max(FAISS_EF_SEARCH, k * max(rescore, 1)))
+            measure(kind, index, build_ms, setting, params, truth)
+            if rescore:
+                measure(kind, index, build_ms, setting, params, truth, rescore)
+    return rows
+
+
+def _stored_vectors(path: str) -> np.ndarray:
+    """Vectors of a persisted RAGStorage index (only full-precision flat or hnsw indexes keep them exactly)."""
+    faiss = _faiss()
+    index = faiss.read_index(path, faiss.IO_FLAG_MMAP)
+    if is_lossy(index):
+        raise ValueError(f"{path} stores quantized or projected vectors; report on a float32 flat or hnsw index")
+    base = base_index(index)
+    return base.reconstruct_n(0, base.ntotal)
+
+
+def _clustered_vectors(n: int, dim: int, rng: np.random.Generator) -> np.ndarray:
+    # sentence embeddings are clustered by topic; uniform random vectors would understate ANN recall
+    centers = rng.standard_normal((max(1, n // 500), dim)).astype(np.float32)
+    x = centers[rng.integers(0, len(centers), n)] + 0.35 * rng.standard_normal((n, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k versus latency and memory of the FAISS index layouts")
+    parser.add_argument("--index", help="persisted RAGStorage index to take vectors from (default: synthetic)")
+    parser.add_argument("--vectors", type=int, default=100_000, help="synthetic corpus size")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--codecs", nargs="*", default=[], choices=CODECS, help="compact vector codecs to add")
+    parser.add_argument("--pca", nargs="*", type=int, default=[], help="PCA dimensions to add")
+    parser.add_argument("--rescore", type=int, default=FAISS_RESCORE_FACTOR, help="rescoring factor (0: off)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    vectors = _stored_vectors(args.index) if args.index else _clustered_vectors(args.vectors, args.dim, rng)
+    # queries: perturbed corpus vectors, like a paraphrase of something already stored
+    queries = vectors[rng.choice(len(vectors), min(args.queries, len(vectors)), replace=False)]
+    queries = queries + 0.05 * rng.standard_normal(queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    print(f"{len(vectors)} vectors, dim={vectors.shape[1]}, {len(queries)} queries, recall@{args.k}")
+    print(f"{'index':<6} {'setting':<36} {'recall':>7} {'p50 ms':>8} {'p95 ms':>8} {'bytes/vec':>10} {'build ms':>10}")
+    for row in recall_report(vectors, queries, k=args.k, codecs=args.codecs, pca_dims=args.pca, rescore=args.rescore):
+        print(f"{row['index']:<6} {row['setting']:<36} {row['recall']:>7.3f} {row['p50_ms']:>8.3f} "
+              f"{row['p95_ms']:>8.3f} {row['bytes_per_vector']:>10} {row['build_ms']:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# cassette.py
+import asyncio
+import io
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List
+
+import zstandard
+from .config import LLM_CASSETTE_TIME_SCALE
+from .llm_cache import request_cache_key
+
+logger = logging.getLogger("cassette")
+
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+
+
+class CassetteMiss(LookupError):
+    """Replay mode got a request that was never recorded."""
+
+
+class Cassette:
+    """
+    Record/replay of LLM traffic, for benchmarking builds without a model.
+     - record: every upstream request/response (and the arrival time of every stream chunk) is appended
+       to `path` as one zstd frame per entry (JSON lines inside), so a crash loses at most the last entry
+     - replay: requests are matched on path + normalized payload hash (llm_cache.request_cache_key) and served
+       with the recorded latency multiplied by `time_scale` (0 = instant). Repeated recordings of the same
+       request are served in recorded order, cycling.
+    A streamed recording can answer a non-streamed request and vice versa.
+    """
+
+    def __init__(self, path: str, mode: str = MODE_REPLAY, time_scale: float = LLM_CASSETTE_TIME_SCALE):
+        if mode not in (MODE_RECORD, MODE_REPLAY):
+            raise ValueError(f"unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.time_scale = time_scale
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Deque[Dict[str, Any]]] = defaultdict(deque)
+        self._counters = {"recorded": 0, "replayed": 0, "misses": 0}
+        self._compressor = zstandard.ZstdCompressor(level=3)
+        self._file = None
+        if mode == MODE_REPLAY:
+            self._load()
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(path, "ab")
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == MODE_REPLAY
+
+    @staticmethod
+    def _key(path: str, payload: dict) -> str:
+        return f"{path}:{request_cache_key(payload)}"
+
+    # --- storage ---
+    def _load(self):
+        with open(self.path, "rb") as fh:
+            reader = zstandard.ZstdDecompressor().stream_reader(fh, read_across_frames=True)
+            for line in io.TextIOWrapper(reader, encoding="utf-8"):
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries[entry["key"]].append(entry)
+        logger.info("Loaded %d recorded requests from %s", sum(len(v) for v in self._entries.values()), self.path)
+
+    def _append(self, path: str, payload: dict, entry: Dict[str, Any]):
+        entry = dict(entry, key=self._key(path, payload), path=path, payload=payload, recorded_at=time.time())
+        frame = self._compressor.compress((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+        with self._lock:
+            self._file.write(frame)
+            self._file.flush()
+            self._counters["recorded"] += 1
+
+    def _lookup(self, path: str, payload: dict) -> Dict[str, Any]:
+        key = self._key(path, payload)
+        with self._lock:
+            recorded = self._entries.get(key)
+            if not recorded:
+                self._counters["misses"] += 1
+                raise CassetteMiss(f"no recording for {path} (payload hash {key.split(':', 1)[1][:16]})")
+            entry = recorded[0]
+            recorded.rotate(-1)
+            self._counters["replayed"] += 1
+            return entry
+
+    # --- replay timing ---
+    def _replay_plan(self, entry: Dict[str, Any]) -> List[tuple]:
+        """[(sleep_before, delta), ...] for a stream; a plain response becomes a single delta."""
+        if "chunks" in entry:
+            plan, previous = [], 0.0
+            for offset, delta in entry["chunks"]:
+                plan.append(((offset - previous) * self.time_scale, delta))
+                previous = offset
+            return plan
+        text = entry["response"]["choices"][0]["message"]["content"]
+        return [(entry["latency"] * self.time_scale, text)]
+
+    def _replay_response(self, entry: Dict[str, Any], payload: dict) -> tuple:
+        """(total_sleep, response) for a non-streamed call."""
+        if "response" in entry:
+            return entry["latency"] * self.time_scale, entry["response"]
+        text = "".join(delta for _, delta in entry["chunks"])
+        latency = entry["chunks"][-1][0] if entry["chunks"] else 0.0
+        response = {"model": payload.get("model"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}}]}
+        return latency * self.time_scale, response
+
+    # --- wrappers used by the clients ---
+    def wrap_call(self, path: str, payload: dict, fn: Callable[[], dict]) -> dict:
+        if self.replaying:
+            delay, response = self._replay_response(self._lookup(path, payload), payload)
+            time.sleep(delay)
+            return response
+        started = time.monotonic()
+        response = fn()
+        self._append(path, payload, {"latency": time.monotonic() - started, "response": response})
+        return response
+
+    async def awrap_call(self, path: str, payload: dict, fn: Callable[[], Awaitable[dict]]) -> dict:
+        if self.replaying:
+            delay, response = self._replay_response(self._lookup(path, payload), payload)
+            await asyncio.sleep(delay)
+            return response
+        started = time.monotonic()
+        response = await fn()
+        self._append(path, payload, {"latency": time.monotonic() - started, "response": response})
+        return response
+
+    def wrap_stream(self, path: str, payload: dict, fn: Callable[[], Iterator[str]]) -> Iterator[str]:
+        if self.replaying:
+            for delay, delta in self._replay_plan(self._lookup(path, payload)):
+                time.sleep(delay)
+                yield delta
+            return
+        started, chunks = time.monotonic(), []
+        for delta in fn():
+            chunks.append((time.monotonic() - started, delta))
+            yield delta
+        self._append(path, payload, {"chunks": chunks})
+
+    async def awrap_stream(self, path: str, payload: dict, fn: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        if self.replaying:
+            for delay, delta in self._replay_plan(self._lookup(path, payload)):
+                await asyncio.sleep(delay)
+                yield delta
+            return
+        started, chunks = time.monotonic(), []
+        async for delta in fn():
+            chunks.append((time.monotonic() - started, delta))
+            yield delta
+        self._append(path, payload, {"chunks": chunks})
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._counters, mode=self.mode, path=self.path)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
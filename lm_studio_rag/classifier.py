@@ -1,13 +1,14 @@
 # classifier.py
-from typing import Tuple, Dict
+from typing import Tuple, Dict, Optional
 import re
 import logging
-from sentence_transformers import SentenceTransformer
 import numpy as np
 from sklearn.linear_model import LogisticRegression
 from sklearn.preprocessing import StandardScaler
-from .config import EMBEDDING_MODEL_NAME
+from .config import EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND
 from .lm_studio_client import LMStudioClient
+from .embeddings import create_embedder
+from .embedding_cache import EmbeddingCache
 from .utils import now_iso
 
 logger = logging.getLogger("classifier")
@@ -20,8 +21,13 @@ class ContentClassifier:
      - Optional LLM-based classification via LMStudioClient.classify_content_via_llm (fallback or ensemble)
     """
 
-    def __init__(self, use_llm: bool = False):
-        self.emb_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    def __init__(self, use_llm: bool = False, embedding_cache: Optional[EmbeddingCache] = None,
+                 embedding_model=None):
+        # `embedding_model`: reuse an existing embedder (e.g. RAGServiceClient.embedding_model) instead of loading one.
+        # Otherwise share the embedding cache with RAGStorage so a text is encoded once for both;
+        # the classifier has no LLM client, so it embeds in-process even when RAGStorage is "remote"
+        backend = "onnx" if EMBEDDING_BACKEND == "onnx" else "local"
+        self.emb_model = embedding_model or create_embedder(backend, EMBEDDING_MODEL_NAME, cache=embedding_cache)
         self.scaler = StandardScaler()
         self.clf = LogisticRegression()
         self._is_trained = False
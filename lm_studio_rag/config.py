@@ -1,18 +1,128 @@
 # config.py
+import json
 import os
 
 # LM Studio OpenAI互換 API 設定
 LM_STUDIO_BASE_URL = os.getenv("LM_STUDIO_BASE_URL", "http://localhost:1234")  # 例: http://localhost:8080
 LM_STUDIO_API_KEY = os.getenv("LM_STUDIO_API_KEY", "your_api_key_here")
+# 複数ノードで分散する場合はカンマ区切り (例: http://gpu1:1234,http://gpu2:1234)
+LM_STUDIO_BASE_URLS = [u for u in os.getenv("LM_STUDIO_BASE_URLS", "").split(",") if u.strip()] or [LM_STUDIO_BASE_URL]
+
+# Endpoint health: /v1/models probe interval, ejection after consecutive failures, re-admission delay
+LLM_HEALTH_CHECK_INTERVAL = float(os.getenv("LLM_HEALTH_CHECK_INTERVAL", "10"))
+LLM_EJECT_AFTER_FAILURES = int(os.getenv("LLM_EJECT_AFTER_FAILURES", "3"))
+LLM_EJECT_SECONDS = float(os.getenv("LLM_EJECT_SECONDS", "30"))
+
+# Retries (connection errors, timeouts, 429/5xx) with full-jitter exponential backoff, capped by a global budget
+LLM_RETRY_ATTEMPTS = int(os.getenv("LLM_RETRY_ATTEMPTS", "3"))  # total attempts, 1 = no retry
+LLM_RETRY_BACKOFF_BASE = float(os.getenv("LLM_RETRY_BACKOFF_BASE", "0.2"))
+LLM_RETRY_BACKOFF_MAX = float(os.getenv("LLM_RETRY_BACKOFF_MAX", "5"))
+LLM_RETRY_BUDGET_RATIO = float(os.getenv("LLM_RETRY_BUDGET_RATIO", "0.1"))  # retries per original request
+LLM_RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("LLM_RETRY_BUDGET_MIN_PER_SECOND", "1"))
+# Hedging (async, non-streaming, interactive only): duplicate a call to another endpoint once it exceeds the observed p95
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+
+# Per-stage model routing: default model, and {stage: {"model", "max_tokens", "temperature", "stop"}} overrides as JSON
+LM_STUDIO_MODEL = os.getenv("LM_STUDIO_MODEL", "gemma-3-1b-it")
+LLM_STAGE_PROFILES = json.loads(os.getenv("LLM_STAGE_PROFILES", "") or "{}")
+
+# HTTP connection pool (shared per base URL, keep-alive enabled)
+LM_STUDIO_MAX_CONNECTIONS = int(os.getenv("LM_STUDIO_MAX_CONNECTIONS", "100"))
+LM_STUDIO_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LM_STUDIO_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LM_STUDIO_KEEPALIVE_EXPIRY = float(os.getenv("LM_STUDIO_KEEPALIVE_EXPIRY", "30"))
+
+# Scheduler: max concurrent LLM calls per backend (excess calls queue by priority class)
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "4"))
+# Adaptive limit: "off", "aimd" or "gradient". LLM_MAX_IN_FLIGHT becomes the starting point, bounded by MIN/MAX below
+LLM_ADAPTIVE_LIMIT = os.getenv("LLM_ADAPTIVE_LIMIT", "off")
+LLM_ADAPTIVE_MIN_LIMIT = int(os.getenv("LLM_ADAPTIVE_MIN_LIMIT", "1"))
+LLM_ADAPTIVE_MAX_LIMIT = int(os.getenv("LLM_ADAPTIVE_MAX_LIMIT", "64"))
+
+# Request admission for SSE streams: concurrent requests, and waiting requests before new ones get 503 + Retry-After
+STREAM_MAX_ACTIVE = int(os.getenv("STREAM_MAX_ACTIVE", "8"))
+STREAM_MAX_QUEUE = int(os.getenv("STREAM_MAX_QUEUE", "32"))
+
+# LLM response cache (memory LRU + SQLite/zstd on disk). Disabled unless a cache is passed to the client.
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "./llm_cache.db")  # "" -> memory only
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024"))
+LLM_CACHE_TTL_SECONDS = float(os.getenv("LLM_CACHE_TTL_SECONDS", "86400"))
+LLM_CACHE_MAX_DISK_BYTES = int(os.getenv("LLM_CACHE_MAX_DISK_BYTES", str(256 * 1024 * 1024)))
+
+# Cassette: record upstream LLM traffic to a file, or replay it without a model ("" = off)
+LLM_CASSETTE_MODE = os.getenv("LLM_CASSETTE_MODE", "")  # "record" | "replay"
+LLM_CASSETTE_PATH = os.getenv("LLM_CASSETTE_PATH", "./llm_traffic.cassette.zst")
+LLM_CASSETTE_TIME_SCALE = float(os.getenv("LLM_CASSETTE_TIME_SCALE", "1.0"))  # replay latency multiplier, 0 = instant
 
 # Embedding model to use for sentence-transformers
 EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "all-MiniLM-L6-v2")
+# "local" = in-process SentenceTransformer, "onnx" = the same model exported to ONNX and run with onnxruntime
+# (no torch at serving time), "remote" = /v1/embeddings on the LLM endpoints
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "local")
+# ONNX backend: exported artifacts (fp32 + dynamically quantized int8) are cached under ONNX_MODEL_DIR
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "./onnx_models")
+ONNX_QUANTIZE_INT8 = os.getenv("ONNX_QUANTIZE_INT8", "true").lower() in ("1", "true", "yes")
+ONNX_INTRA_OP_THREADS = int(os.getenv("ONNX_INTRA_OP_THREADS", "0"))  # 0 = onnxruntime default (all cores)
+ONNX_BATCH_SIZE = int(os.getenv("ONNX_BATCH_SIZE", "32"))
+REMOTE_EMBEDDING_MODEL = os.getenv("REMOTE_EMBEDDING_MODEL", "text-embedding-3-small")
+# Remote embedding requests are split into chunks (by item count and total characters) sent concurrently
+EMBEDDING_BATCH_MAX_ITEMS = int(os.getenv("EMBEDDING_BATCH_MAX_ITEMS", "64"))
+EMBEDDING_BATCH_MAX_CHARS = int(os.getenv("EMBEDDING_BATCH_MAX_CHARS", "32000"))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "4"))
+# Embedding cache keyed by (model, text hash): memory LRU + append-only memory-mapped shards under EMBEDDING_CACHE_PATH
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./embedding_cache")  # "" -> memory only
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "10000"))
+# Concurrent query encodes are coalesced into one encode() call: the first request waits up to the window
+# (0 disables micro-batching) for others, up to EMBEDDING_MICROBATCH_MAX_SIZE texts per call
+EMBEDDING_MICROBATCH_WINDOW_MS = float(os.getenv("EMBEDDING_MICROBATCH_WINDOW_MS", "2"))
+EMBEDDING_MICROBATCH_MAX_SIZE = int(os.getenv("EMBEDDING_MICROBATCH_MAX_SIZE", "32"))
 
 # Vector DB config
+# RAGStorage.save_batch: texts per encode call / vector-store write
+STORAGE_BATCH_SIZE = int(os.getenv("STORAGE_BATCH_SIZE", "64"))
 VECTOR_DB_TYPE = os.getenv("VECTOR_DB_TYPE", "chroma")  # "chroma" or "faiss"
 CHROMA_PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", "./chroma_db")
 FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH", "./faiss.index")
-METADATA_STORE_PATH = os.getenv("METADATA_STORE_PATH", "./faiss_metadata.json")
+# SQLite table of FAISS metadata (an existing faiss_metadata.json next to it is imported once)
+METADATA_STORE_PATH = os.getenv("METADATA_STORE_PATH", "./faiss_metadata.db")
+# Rewrite the FAISS index file after this many new vectors (and after every save_batch / on shutdown)
+FAISS_PERSIST_EVERY = int(os.getenv("FAISS_PERSIST_EVERY", "256"))
+# Deletes stay tombstones until this fraction of the index is dead, then the index is compacted
+FAISS_COMPACT_TOMBSTONE_RATIO = float(os.getenv("FAISS_COMPACT_TOMBSTONE_RATIO", "0.2"))
+# FAISS index kind once the corpus reaches FAISS_ANN_THRESHOLD documents: "flat" (exact), "ivfpq" or "hnsw".
+# Smaller corpora stay flat; the index is retrained/rebuilt automatically when the threshold is crossed.
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat")
+FAISS_ANN_THRESHOLD = int(os.getenv("FAISS_ANN_THRESHOLD", "50000"))
+FAISS_IVF_NLIST = int(os.getenv("FAISS_IVF_NLIST", "0"))  # 0 = about 4*sqrt(corpus size)
+FAISS_PQ_M = int(os.getenv("FAISS_PQ_M", "48"))  # sub-quantizers (bytes per vector); lowered to divide the dim
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+# Search-time defaults; search_similar(nprobe=..., ef_search=...) overrides them per call
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+# Compact FAISS vectors, applied once a storage holds FAISS_CODEC_MIN_VECTORS documents (they need training data):
+# "float32" | "float16" | "int8" (scalar quantization with a per-dimension range; flat and hnsw indexes),
+# and an optional PCA projection to FAISS_PCA_DIM dimensions (0 = off) fitted on the corpus.
+# Lossy indexes (these, and ivfpq) rescore their top top_k*FAISS_RESCORE_FACTOR candidates against
+# full-precision vectors kept in the metadata database on disk (0 = no rescoring, vectors not kept).
+FAISS_VECTOR_CODEC = os.getenv("FAISS_VECTOR_CODEC", "float32")
+FAISS_PCA_DIM = int(os.getenv("FAISS_PCA_DIM", "0"))
+FAISS_CODEC_MIN_VECTORS = int(os.getenv("FAISS_CODEC_MIN_VECTORS", "1000"))
+FAISS_RESCORE_FACTOR = int(os.getenv("FAISS_RESCORE_FACTOR", "4"))
+# Metadata fields search_similar(where=...) can filter on before the k-NN scan (indexed per value for FAISS)
+METADATA_FILTER_FIELDS = tuple(f.strip() for f in os.getenv(
+    "METADATA_FILTER_FIELDS", "category,source,user_id,sensitivity_level").split(",") if f.strip())
+# Per-user partitions (PartitionedStorage): FAISS files under PARTITION_DIR/<partition>/, Chroma one collection each.
+# Resident partitions are an LRU bounded by estimated memory and by count; evicted ones are persisted and reloaded lazily.
+PARTITION_DIR = os.getenv("PARTITION_DIR", "./partitions")
+PARTITION_CACHE_MAX_BYTES = int(os.getenv("PARTITION_CACHE_MAX_BYTES", str(1 << 30)))
+PARTITION_CACHE_MAX_COUNT = int(os.getenv("PARTITION_CACHE_MAX_COUNT", "256"))
+
+# RAG service mode: one process (python -m lm_studio_rag.rag_service) owns the embedding model and vector store;
+# API workers connect over this Unix socket. "" -> each process builds its own RAGStorage
+RAG_SERVICE_SOCKET = os.getenv("RAG_SERVICE_SOCKET", "")
+RAG_SERVICE_POOL_SIZE = int(os.getenv("RAG_SERVICE_POOL_SIZE", "8"))  # idle connections kept per client
+RAG_SERVICE_MAX_FRAME_BYTES = int(os.getenv("RAG_SERVICE_MAX_FRAME_BYTES", str(256 << 20)))
 
 # Other
 DEFAULT_EMBEDDING_DIM = 384  # all-MiniLM-L6-v2 -> 384
@@ -7,6 +7,7 @@ from datetime import datetime
 import logging
 from .utils import now_iso, save_json, load_json
 from .lm_studio_client import LMStudioClient
+from .scheduler import PRIORITY_BACKGROUND
 from .classifier import ContentClassifier
 from .storage import RAGStorage
 
@@ -122,7 +123,7 @@ class ConversationManager:
         ]
         
         try:
-            response = self.llm.chat(messages, temperature=0.1, max_tokens=500)
+            response = self.llm.chat(messages, temperature=0.1, max_tokens=500, priority=PRIORITY_BACKGROUND)
             content = response["choices"][0]["message"]["content"]
             parsed = json.loads(content)
             return parsed.get("extracted_info", [])
@@ -130,15 +131,18 @@ class ConversationManager:
             logger.error(f"情報抽出に失敗: {e}")
             return []
     
-    def identify_knowledge_gaps(self, thread_id: str, current_query: str) -> List[Dict[str, Any]]:
+    def identify_knowledge_gaps(self, thread_id: str, current_query: str,
+                                related: Optional[Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]] = None) -> List[Dict[str, Any]]:
         """
         現在の会話とRAGの内容を比較して、不足している情報を特定
+        related: 検索済みの (人格情報, 体験情報)。省略時はここで両カテゴリを1回の一括検索で取得する
         """
         thread = self.threads[thread_id]
         
         # 現在のクエリに対する関連情報を検索
-        similar_personality = self.storage.search_similar(current_query, category="personality", top_k=5)
-        similar_experience = self.storage.search_similar(current_query, category="experience", top_k=5)
+        if related is None:
+            related = self.storage.search_similar_many([current_query] * 2, ["personality", "experience"], top_k=5)
+        similar_personality, similar_experience = related
         
         # 会話履歴の要約
         conversation_summary = self._summarize_conversation(thread)
@@ -180,7 +184,7 @@ class ConversationManager:
         ]
         
         try:
-            response = self.llm.chat(messages, temperature=0.2, max_tokens=600)
+            response = self.llm.chat(messages, temperature=0.2, max_tokens=600, priority=PRIORITY_BACKGROUND)
             content = response["choices"][0]["message"]["content"]
             parsed = json.loads(content)
             return parsed.get("knowledge_gaps", [])
@@ -234,12 +238,14 @@ class ConversationManager:
         # 1. 情報抽出
         extracted_info = self.extract_information_from_message(user_message)
         
-        # 2. RAG検索
-        similar_docs = self.storage.search_similar(user_message, top_k=5)
+        # 2. RAG検索（全体・人格・体験の3検索を、1回のエンコードと1回のインデックス検索にまとめる）
+        similar_docs, similar_personality, similar_experience = self.storage.search_similar_many(
+            [user_message] * 3, [None, "personality", "experience"], top_k=5)
         context = "\n".join([f"- {doc['text']}" for doc in similar_docs])
         
         # 3. 情報不足の特定
-        knowledge_gaps = self.identify_knowledge_gaps(thread_id, user_message)
+        knowledge_gaps = self.identify_knowledge_gaps(thread_id, user_message,
+                                                      related=(similar_personality, similar_experience))
         
         # 4. フォローアップ質問生成
         follow_up_questions = []
@@ -326,7 +332,8 @@ class ConversationManager:
             {"role": "user", "content": user_content}
         ]
         
-        response = self.llm.chat(messages, temperature=0.7, max_tokens=800)
+        # 会話応答は毎回バリエーションが欲しいのでキャッシュしない
+        response = self.llm.chat(messages, temperature=0.7, max_tokens=800, use_cache=False)
         return response["choices"][0]["message"]["content"]
     
     def get_thread_summary(self, thread_id: str) -> Dict[str, Any]:
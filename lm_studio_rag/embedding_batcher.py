@@ -0,0 +1,170 @@
+# embedding_batcher.py
+import bisect
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Deque, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .config import EMBEDDING_MICROBATCH_WINDOW_MS, EMBEDDING_MICROBATCH_MAX_SIZE
+
+logger = logging.getLogger("embedding_batcher")
+
+WAIT_BUCKETS_MS = (0.25, 0.5, 1, 2, 5, 10, 20, 50)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+_LATENCY_SAMPLES = 1000
+_STOP = object()
+
+
+class Histogram:
+    """Fixed-bucket counts; bucket "<=b" holds values in (previous bound, b], ">last" the rest."""
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        labels = [f"<={b:g}" for b in self.bounds] + [f">{self.bounds[-1]:g}"]
+        return {"buckets": dict(zip(labels, self.counts)), "count": self.count,
+                "avg": self.total / self.count if self.count else 0.0}
+
+
+class _Request:
+    __slots__ = ("texts", "future", "enqueued_at")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.future: Future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class MicroBatchEmbedder:
+    """
+    Coalesces concurrent small encode() calls (one query per request thread) into one encode() of the wrapped
+    embedder: the first waiting request opens a window of `window_ms`; requests arriving within it, up to
+    `max_batch` texts, run in the same call, and each caller gets its own rows back.
+    Calls with max_batch texts or more (bulk saves) bypass the window. A single worker thread runs the
+    batched calls, which also keeps concurrent callers from contending inside the model.
+    stats(): histograms of the time requests waited for their batch and of batch sizes, plus end-to-end
+    latency percentiles, to tune the window against p50 latency.
+    """
+
+    def __init__(self, embedder, window_ms: float = EMBEDDING_MICROBATCH_WINDOW_MS,
+                 max_batch: int = EMBEDDING_MICROBATCH_MAX_SIZE):
+        self.embedder = embedder
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._queue: "queue.Queue" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._wait_ms = Histogram(WAIT_BUCKETS_MS)
+        self._batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self._latencies: Deque[float] = deque(maxlen=_LATENCY_SAMPLES)
+        self._bypassed = 0
+
+    def encode(self, texts: List[str], show_progress_bar: bool = False, **kwargs) -> np.ndarray:
+        texts = list(texts)
+        if kwargs or not texts or len(texts) >= self.max_batch:
+            with self._lock:
+                self._bypassed += 1
+            return self.embedder.encode(texts, show_progress_bar=show_progress_bar, **kwargs)
+        request = _Request(texts)
+        self._ensure_worker()
+        self._queue.put(request)
+        vectors = request.future.result()
+        with self._lock:
+            self._latencies.append(time.perf_counter() - request.enqueued_at)
+        return vectors
+
+    def get_sentence_embedding_dimension(self) -> Optional[int]:
+        return self.embedder.get_sentence_embedding_dimension()
+
+    # --- worker ---
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def _collect(self, first: _Request) -> (List[_Request], bool):
+        batch, size = [first], len(first.texts)
+        deadline = first.enqueued_at + self.window
+        while size < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                # past the deadline, still take what queued up while the previous batch was encoding
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+            size += len(item.texts)
+        return batch, False
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                return
+            batch, stop = self._collect(first)
+            started = time.perf_counter()
+            texts = [text for request in batch for text in request.texts]
+            with self._lock:
+                for request in batch:
+                    self._wait_ms.add((started - request.enqueued_at) * 1000)
+                self._batch_sizes.add(len(texts))
+            try:
+                vectors = np.asarray(self.embedder.encode(texts, show_progress_bar=False))
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+            else:
+                offset = 0
+                for request in batch:
+                    request.future.set_result(vectors[offset:offset + len(request.texts)])
+                    offset += len(request.texts)
+            if stop:
+                return
+
+    def close(self):
+        """Stop the worker after the requests already queued have been served."""
+        with self._lock:
+            worker = self._worker
+        if worker is not None and worker.is_alive():
+            self._queue.put(_STOP)
+            worker.join()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            n = len(latencies)
+            return {
+                "window_ms": self.window * 1000,
+                "max_batch": self.max_batch,
+                "wait_ms": self._wait_ms.snapshot(),
+                "batch_size": self._batch_sizes.snapshot(),
+                "bypassed": self._bypassed,
+                "latency_p50_ms": latencies[int(0.50 * (n - 1))] * 1000 if n else 0.0,
+                "latency_p95_ms": latencies[int(0.95 * (n - 1))] * 1000 if n else 0.0,
+            }
+
+
+def find_batcher(embedder) -> Optional[MicroBatchEmbedder]:
+    """The MicroBatchEmbedder in a chain of wrappers (e.g. CachedEmbedder), if any."""
+    while embedder is not None:
+        if isinstance(embedder, MicroBatchEmbedder):
+            return embedder
+        embedder = getattr(embedder, "embedder", None)
+    return None
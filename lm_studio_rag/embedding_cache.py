@@ -0,0 +1,189 @@
+# embedding_cache.py
+import hashlib
+import logging
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from .config import EMBEDDING_CACHE_MAX_ENTRIES
+
+logger = logging.getLogger("embedding_cache")
+
+
+def text_digest(text: str) -> str:
+    """sha256 of the NFC-normalized text with line endings unified and outer whitespace stripped."""
+    normalized = unicodedata.normalize("NFC", text).replace("\r\n", "\n").strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class _DiskShard:
+    """
+    Append-only store for one model:
+     - vectors.f32: float32 rows of `dim`, read through np.memmap
+     - index.tsv:   "<digest>\\t<row>\\t<dim>" lines
+    A row is only indexed after its vector has been written, so a crash leaves at most an unindexed tail.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.index_path = os.path.join(directory, "index.tsv")
+        self.rows: Dict[str, int] = {}
+        self.dim: Optional[int] = None
+        self._mapped: Optional[np.memmap] = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r", encoding="utf-8") as fh:
+                for line in fh:
+                    parts = line.rstrip("\n").split("\t")
+                    if len(parts) == 3:
+                        self.rows[parts[0]] = int(parts[1])
+                        self.dim = int(parts[2])
+
+    def _remap(self):
+        count = os.path.getsize(self.vectors_path) // (4 * self.dim)
+        self._mapped = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(count, self.dim)) if count else None
+
+    def get(self, digest: str) -> Optional[np.ndarray]:
+        row = self.rows.get(digest)
+        if row is None:
+            return None
+        if self._mapped is None or row >= self._mapped.shape[0]:
+            self._remap()
+        return np.array(self._mapped[row])
+
+    def put(self, digests: List[str], vectors: np.ndarray):
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"embedding width changed from {self.dim} to {vectors.shape[1]}")
+        row_bytes = 4 * self.dim
+        with open(self.vectors_path, "ab") as fh:
+            size = fh.tell()
+            if size % row_bytes:
+                # drop a half-written row left by a crash so rows stay aligned
+                fh.truncate(size - size % row_bytes)
+                fh.seek(0, os.SEEK_END)
+            start = fh.tell() // row_bytes
+            fh.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with open(self.index_path, "a", encoding="utf-8") as fh:
+            for offset, digest in enumerate(digests):
+                fh.write(f"{digest}\t{start + offset}\t{self.dim}\n")
+                self.rows[digest] = start + offset
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache keyed by (model name, hash of normalized text).
+     - memory: LRU of at most `max_entries` vectors
+     - disk (when `path` is set): one append-only shard per model under `path`, so restarts
+       do not re-encode texts that were already seen. A disk hit is promoted to memory.
+    Thread-safe; shared by RAGStorage and ContentClassifier through CachedEmbedder.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+        self._shards: Dict[str, _DiskShard] = {}
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def _shard(self, model: str) -> Optional[_DiskShard]:
+        if not self.path:
+            return None
+        shard = self._shards.get(model)
+        if shard is None:
+            shard = self._shards[model] = _DiskShard(os.path.join(self.path, re.sub(r"[^\w.-]+", "_", model)))
+            logger.info("Embedding cache for %s: %d vectors on disk", model, len(shard.rows))
+        return shard
+
+    def _remember(self, key: tuple, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, model: str, digest: str) -> Optional[np.ndarray]:
+        """Caller holds the lock."""
+        key = (model, digest)
+        vector = self._memory.get(key)
+        if vector is not None:
+            self._memory.move_to_end(key)
+            self._counters["memory_hits"] += 1
+            return vector
+        shard = self._shard(model)
+        vector = shard.get(digest) if shard is not None else None
+        if vector is not None:
+            self._remember(key, vector)
+            self._counters["disk_hits"] += 1
+            return vector
+        self._counters["misses"] += 1
+        return None
+
+    def encode(self, model: str, texts: List[str], encode_fn: Callable[[List[str]], Any]) -> np.ndarray:
+        """
+        Embeddings of `texts` (float32, input order). Only texts missing from the cache are passed
+        to encode_fn, once each, in a single call.
+        """
+        digests = [text_digest(t) for t in texts]
+        found: Dict[str, np.ndarray] = {}
+        missing: Dict[str, str] = {}
+        with self._lock:
+            for digest, text in zip(digests, texts):
+                if digest in found or digest in missing:
+                    continue
+                vector = self._lookup(model, digest)
+                if vector is not None:
+                    found[digest] = vector
+                else:
+                    missing[digest] = text
+        if missing:
+            vectors = np.asarray(encode_fn(list(missing.values())), dtype=np.float32)
+            with self._lock:
+                shard = self._shard(model)
+                if shard is not None:
+                    # another thread may have stored the same text meanwhile
+                    new = [(i, d) for i, d in enumerate(missing) if d not in shard.rows]
+                    if new:
+                        shard.put([d for _, d in new], vectors[[i for i, _ in new]])
+                for digest, vector in zip(missing, vectors):
+                    self._remember((model, digest), vector)
+                    found[digest] = vector
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([found[d] for d in digests])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["memory_entries"] = len(self._memory)
+            lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+            stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+            stats["disk_entries"] = {model: len(shard.rows) for model, shard in self._shards.items()}
+            return stats
+
+
+class CachedEmbedder:
+    """
+    Wraps an embedder (SentenceTransformer or RemoteEmbedder) so encode() consults an EmbeddingCache first.
+    `model_name` is the cache namespace; use a different one whenever the vectors would differ.
+    """
+
+    def __init__(self, embedder, cache: EmbeddingCache, model_name: str):
+        self.embedder = embedder
+        self.cache = cache
+        self.model_name = model_name
+
+    def encode(self, texts: List[str], show_progress_bar: bool = False, **kwargs) -> np.ndarray:
+        return self.cache.encode(
+            self.model_name, list(texts),
+            lambda missing: self.embedder.encode(missing, show_progress_bar=show_progress_bar, **kwargs),
+        )
+
+    def get_sentence_embedding_dimension(self) -> Optional[int]:
+        return self.embedder.get_sentence_embedding_dimension()
@@ -0,0 +1,71 @@
+# embeddings.py
+import logging
+from typing import List, Optional
+
+import numpy as np
+
+from .config import EMBEDDING_BACKEND, EMBEDDING_MODEL_NAME, REMOTE_EMBEDDING_MODEL
+from .embedding_cache import EmbeddingCache, CachedEmbedder
+from .embedding_batcher import MicroBatchEmbedder
+
+logger = logging.getLogger("embeddings")
+
+
+class RemoteEmbedder:
+    """
+    Embeds through the OpenAI-compatible /v1/embeddings endpoint(s) of an LMStudioClient.
+    Exposes the subset of the SentenceTransformer API that RAGStorage uses (encode, get_sentence_embedding_dimension),
+    so embedding work can be moved off the API worker without touching the storage code.
+    """
+
+    def __init__(self, client=None, model: str = REMOTE_EMBEDDING_MODEL):
+        if client is None:
+            from .lm_studio_client import LMStudioClient
+            client = LMStudioClient()
+        self.client = client
+        self.model = model
+        self._dim: Optional[int] = None
+
+    def encode(self, texts: List[str], show_progress_bar: bool = False, **kwargs) -> np.ndarray:
+        vectors = self.client.embed_texts(list(texts), model=self.model)
+        if vectors.size:
+            self._dim = vectors.shape[1]
+        return vectors
+
+    def get_sentence_embedding_dimension(self) -> Optional[int]:
+        if self._dim is None:
+            self.encode(["dimension probe"])
+        return self._dim
+
+
+def create_embedder(backend: str = EMBEDDING_BACKEND, model_name: Optional[str] = None, client=None,
+                    cache: Optional[EmbeddingCache] = None, batch_window_ms: float = 0):
+    """
+    "local"  -> SentenceTransformer(model_name or EMBEDDING_MODEL_NAME), loaded in-process
+    "onnx"   -> OnnxEmbedder(model_name or EMBEDDING_MODEL_NAME): onnxruntime, int8 with ONNX_QUANTIZE_INT8
+    "remote" -> RemoteEmbedder over `client` (model_name or REMOTE_EMBEDDING_MODEL)
+    With batch_window_ms > 0, concurrent encodes are coalesced by a MicroBatchEmbedder.
+    With a cache, the embedder is wrapped in CachedEmbedder namespaced by "<backend>:<model>"
+    (outermost, so cache hits never wait for a batch window).
+    """
+    if backend == "remote":
+        model_name = model_name or REMOTE_EMBEDDING_MODEL
+        logger.info("Using remote embeddings (%s)", model_name)
+        embedder = RemoteEmbedder(client, model_name)
+    elif backend == "local":
+        from sentence_transformers import SentenceTransformer
+        model_name = model_name or EMBEDDING_MODEL_NAME
+        embedder = SentenceTransformer(model_name)
+    elif backend == "onnx":
+        from .onnx_embedder import OnnxEmbedder
+        model_name = model_name or EMBEDDING_MODEL_NAME
+        embedder = OnnxEmbedder(model_name)
+        # int8 vectors differ slightly from fp32 ones; keep them apart in the cache
+        model_name = f"{model_name}-int8" if embedder.quantized else model_name
+    else:
+        raise ValueError(f"unknown embedding backend: {backend}")
+    if batch_window_ms > 0:
+        embedder = MicroBatchEmbedder(embedder, window_ms=batch_window_ms)
+    if cache is not None:
+        return CachedEmbedder(embedder, cache, f"{backend}:{model_name}")
+    return embedder
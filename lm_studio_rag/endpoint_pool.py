@@ -0,0 +1,162 @@
+# endpoint_pool.py
+import contextlib
+import logging
+import threading
+import time
+from typing import Any, Callable, Collection, Dict, Iterable, List, Optional, Sequence, Union
+
+from .config import LLM_MAX_IN_FLIGHT, LLM_ADAPTIVE_LIMIT, LLM_HEALTH_CHECK_INTERVAL, LLM_EJECT_AFTER_FAILURES, LLM_EJECT_SECONDS
+from .scheduler import LLMScheduler, get_scheduler
+
+logger = logging.getLogger("endpoint_pool")
+
+
+def normalize_base_url(url: str) -> str:
+    """
+    "http://host:1234/v1/" -> "http://host:1234".
+    Request paths already start with /v1, so a base URL ending in /v1 would produce /v1/v1/... paths.
+    """
+    url = url.strip().rstrip("/")
+    if url.endswith("/v1"):
+        url = url[:-len("/v1")]
+    return url
+
+
+class Endpoint:
+    """One LLM backend (LM Studio / llama.cpp server) and its routing state."""
+
+    def __init__(self, base_url: str, scheduler: LLMScheduler):
+        self.base_url = base_url
+        self.scheduler = scheduler
+        self.outstanding = 0
+        self.healthy = True
+        self.models: Optional[set] = None  # None until the first successful probe -> assume it serves anything
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.last_error: Optional[str] = None
+        self.served = 0
+
+    def available(self, now: float) -> bool:
+        # an ejected node is re-admitted on trial once its ejection expires (a success restores it fully)
+        return self.healthy or self.ejected_until <= now
+
+    def serves(self, model: Optional[str]) -> bool:
+        return model is None or self.models is None or model in self.models
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "served": self.served,
+            "failures": self.failures,
+            "models": sorted(self.models) if self.models is not None else None,
+            "last_error": self.last_error,
+            "scheduler": self.scheduler.stats(),
+        }
+
+
+class EndpointPool:
+    """
+    Routes requests over several OpenAI-compatible backends.
+     - least outstanding requests among available nodes that serve the requested model
+     - a node is ejected after `eject_after_failures` consecutive failures (probe or request)
+       and re-admitted on trial after `eject_seconds`
+     - model availability comes from periodic /v1/models probes (run by the client, see check_health)
+    If no available node advertises the model, any available node is used and the server decides;
+    if every node is ejected, the one due back first is tried rather than failing outright.
+    """
+
+    def __init__(self, base_urls: Union[str, Sequence[str]], max_in_flight: int = LLM_MAX_IN_FLIGHT,
+                 probe_interval: float = LLM_HEALTH_CHECK_INTERVAL,
+                 eject_after_failures: int = LLM_EJECT_AFTER_FAILURES, eject_seconds: float = LLM_EJECT_SECONDS,
+                 adaptive: str = LLM_ADAPTIVE_LIMIT):
+        if isinstance(base_urls, str):
+            base_urls = [base_urls]
+        urls = list(dict.fromkeys(normalize_base_url(u) for u in base_urls if u.strip()))
+        if not urls:
+            raise ValueError("EndpointPool needs at least one base URL")
+        self.endpoints: List[Endpoint] = [Endpoint(u, get_scheduler(u, max_in_flight, adaptive)) for u in urls]
+        self.probe_interval = probe_interval
+        self.eject_after_failures = eject_after_failures
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+
+    @property
+    def primary(self) -> Endpoint:
+        return self.endpoints[0]
+
+    # --- routing ---
+    def acquire(self, model: Optional[str] = None, exclude: Collection[Endpoint] = ()) -> Endpoint:
+        """
+        Pick an endpoint for `model` and count the request as outstanding on it.
+        `exclude` (e.g. the node a hedged call is already waiting on) is avoided when another node is available.
+        """
+        now = time.monotonic()
+        with self._lock:
+            available = [e for e in self.endpoints if e.available(now)]
+            if exclude:
+                available = [e for e in available if e not in exclude] or available
+            if not available:
+                available = [min(self.endpoints, key=lambda e: e.ejected_until)]
+                logger.warning("All LLM endpoints are ejected; trying %s", available[0].base_url)
+            candidates = [e for e in available if e.serves(model)] or available
+            endpoint = min(candidates, key=lambda e: e.outstanding)
+            endpoint.outstanding += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, error: Optional[BaseException] = None, failed: bool = False):
+        with self._lock:
+            endpoint.outstanding -= 1
+            if failed:
+                self._record_failure(endpoint, error)
+            elif error is None:
+                endpoint.served += 1
+                self._record_success(endpoint)
+
+    @contextlib.contextmanager
+    def lease(self, model: Optional[str], is_failure: Callable[[BaseException], bool], exclude: Collection[Endpoint] = ()):
+        """
+        with pool.lease(model, is_failure) as endpoint: ...
+        Exceptions for which is_failure() is true count against the endpoint (connection errors, 5xx);
+        others (4xx, cancellation) just end the lease.
+        """
+        endpoint = self.acquire(model, exclude)
+        try:
+            yield endpoint
+        except BaseException as e:
+            self.release(endpoint, e, failed=is_failure(e))
+            raise
+        self.release(endpoint)
+
+    # --- health ---
+    def record_probe(self, endpoint: Endpoint, models: Optional[Iterable[str]] = None,
+                     error: Optional[BaseException] = None):
+        with self._lock:
+            if error is not None:
+                self._record_failure(endpoint, error)
+                return
+            endpoint.models = set(models or [])
+            self._record_success(endpoint)
+
+    def _record_success(self, endpoint: Endpoint):
+        if not endpoint.healthy:
+            logger.info("LLM endpoint %s re-admitted", endpoint.base_url)
+        endpoint.healthy = True
+        endpoint.failures = 0
+        endpoint.ejected_until = 0.0
+        endpoint.last_error = None
+
+    def _record_failure(self, endpoint: Endpoint, error: Optional[BaseException]):
+        endpoint.failures += 1
+        endpoint.last_error = repr(error) if error is not None else None
+        if endpoint.failures >= self.eject_after_failures:
+            if endpoint.healthy:
+                logger.warning("LLM endpoint %s ejected after %d failures: %s",
+                               endpoint.base_url, endpoint.failures, endpoint.last_error)
+            endpoint.healthy = False
+            endpoint.ejected_until = time.monotonic() + self.eject_seconds
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [e.stats() for e in self.endpoints]
@@ -0,0 +1,241 @@
+# fake_server.py
+"""
+Stand-in for LM Studio: an OpenAI-compatible server with synthetic, reproducible latency.
+Implements /v1/chat/completions (streaming and non-streaming), /v1/embeddings and /v1/models,
+so benchmarks and load tests (counter_request.py, test/client/test_many_run.py) can run without a GPU.
+
+    python -m lm_studio_rag.fake_server --port 1234 --ttft 0.3 --tokens-per-sec 40 --max-concurrency 4
+    LM_STUDIO_BASE_URL=http://127.0.0.1:1234 python main_api.py
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import time
+from dataclasses import dataclass, field, asdict
+from typing import AsyncIterator, Dict, List, Optional
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from sse_starlette.sse import EventSourceResponse
+
+logger = logging.getLogger("fake_server")
+
+
+@dataclass
+class FakeServerConfig:
+    models: List[str] = field(default_factory=lambda: ["gemma-3-1b-it", "text-embedding-3-small"])
+    ttft: float = 0.2                # seconds until the first token (after getting a slot)
+    tokens_per_sec: float = 50.0     # decode speed; 0 = emit everything at once
+    max_concurrency: int = 4         # requests generating at the same time (like LM Studio's parallel slots)
+    reject_when_busy: bool = False   # True: 429 instead of queueing once all slots are busy
+    error_rate: float = 0.0          # share of requests answered with `error_status`
+    error_status: int = 500
+    stream_abort_rate: float = 0.0   # share of streams cut off halfway (connection drop)
+    embedding_dim: int = 384
+    seed: int = 0                    # error injection is reproducible for a given seed and request order
+
+
+# --- canned outputs ---
+_USER_RESPONSE = """--- 思考プロセス ---
+- **感情的トリガー (Emotional Trigger)**: 相手の悩みに、以前の自分の迷いが重なった。
+- **情報的インプット (Informational Input)**: 過去に似た状況で一歩踏み出せた経験がある。
+- **思考の変遷 (Thought Process Shift)**: 不安はあるが、小さく試すことから始めればよいと考えた。
+
+--- 最終出力 ---
+- **DECISION**: まずは小さく試してみることに決めた。
+- **ACTION**: 今週中に具体的な一歩を一つ書き出す。
+- **NUANCE**: 少し考え込むように
+- **DIALOGUE**: 「焦らなくていいと思う。まずは一つだけ試してみよう」
+- **BEHAVIOR**: ノートを開き、ペンを取った。"""
+
+_CLASSIFICATION = '{"label": "experience", "score": 0.8, "reason": "fake server"}'
+
+_GENERIC = [
+    "過去の経験から考えると、まずは状況を整理することが大切だと感じます。",
+    "少し不安もありますが、前向きに取り組もうと思います。",
+    "以前にも似たことがあり、そのときは時間をかけて答えを出しました。",
+]
+
+
+def canned_completion(messages: List[Dict[str, str]]) -> str:
+    """Pick a canned answer shaped like what the caller's parser expects."""
+    text = "\n".join(str(m.get("content", "")) for m in messages)
+    if "DECISION" in text and "DIALOGUE" in text:
+        return _USER_RESPONSE
+    if '"label"' in text:
+        return _CLASSIFICATION
+    digest = int(hashlib.sha256(text.encode("utf-8")).hexdigest(), 16)
+    return _GENERIC[digest % len(_GENERIC)]
+
+
+def split_tokens(text: str, size: int = 2) -> List[str]:
+    # rough stand-in for a tokenizer: a couple of characters per token also works for Japanese text
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def fake_embedding(text: str, dim: int) -> List[float]:
+    """Deterministic unit vector derived from the text."""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vec = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return (vec / np.linalg.norm(vec)).tolist()
+
+
+class _Stats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.aborted = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.tokens = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(vars(self))
+
+
+def create_app(config: Optional[FakeServerConfig] = None) -> FastAPI:
+    config = config or FakeServerConfig()
+    app = FastAPI(title="Fake OpenAI-compatible LLM server")
+    slots = asyncio.Semaphore(config.max_concurrency)
+    rng = random.Random(config.seed)
+    stats = _Stats()
+    app.state.config = config
+    app.state.stats = stats
+
+    def injected_error() -> Optional[JSONResponse]:
+        if config.error_rate and rng.random() < config.error_rate:
+            stats.errors += 1
+            return JSONResponse({"error": {"message": "injected failure"}}, status_code=config.error_status)
+        return None
+
+    def busy() -> bool:
+        return config.reject_when_busy and slots.locked()
+
+    async def emit(tokens: List[str]) -> AsyncIterator[str]:
+        await asyncio.sleep(config.ttft)
+        interval = 1.0 / config.tokens_per_sec if config.tokens_per_sec > 0 else 0.0
+        for i, token in enumerate(tokens):
+            if i and interval:
+                await asyncio.sleep(interval)
+            stats.tokens += 1
+            yield token
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": m, "object": "model", "owned_by": "fake"} for m in config.models]}
+
+    @app.get("/fake/stats")
+    async def fake_stats():
+        return {"config": asdict(config), "stats": stats.as_dict()}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats.requests += 1
+        error = injected_error()
+        if error is not None:
+            return error
+        if busy():
+            stats.rejected += 1
+            return JSONResponse({"error": {"message": "all slots busy"}}, status_code=429)
+
+        model = body.get("model", config.models[0])
+        text = canned_completion(body.get("messages", []))
+        max_tokens = int(body.get("max_tokens") or 0)
+        tokens = split_tokens(text)
+        finish_reason = "length" if 0 < max_tokens < len(tokens) else "stop"
+        if max_tokens > 0:
+            tokens = tokens[:max_tokens]
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 2
+        created = int(time.time())
+        completion_id = f"chatcmpl-fake-{stats.requests}"
+
+        if not body.get("stream"):
+            async with slots:
+                stats.in_flight += 1
+                stats.peak_in_flight = max(stats.peak_in_flight, stats.in_flight)
+                try:
+                    content = "".join([t async for t in emit(tokens)])
+                finally:
+                    stats.in_flight -= 1
+            return {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                          "total_tokens": prompt_tokens + len(tokens)},
+            }
+
+        abort_at = len(tokens) // 2 if config.stream_abort_rate and rng.random() < config.stream_abort_rate else None
+
+        async def stream():
+            async with slots:
+                stats.in_flight += 1
+                stats.peak_in_flight = max(stats.peak_in_flight, stats.in_flight)
+                try:
+                    i = 0
+                    async for token in emit(tokens):
+                        if abort_at is not None and i == abort_at:
+                            stats.aborted += 1
+                            raise ConnectionResetError("injected stream abort")
+                        chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                                 "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                        yield {"data": json.dumps(chunk, ensure_ascii=False)}
+                        i += 1
+                    yield {"data": "[DONE]"}
+                finally:
+                    stats.in_flight -= 1
+
+        return EventSourceResponse(stream())
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        stats.requests += 1
+        error = injected_error()
+        if error is not None:
+            return error
+        inputs = body.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        async with slots:
+            await asyncio.sleep(config.ttft)
+        return {
+            "object": "list", "model": body.get("model", config.models[-1]),
+            "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(t, config.embedding_dim)}
+                     for i, t in enumerate(inputs)],
+        }
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible LLM server for offline benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--ttft", type=float, default=0.2, help="seconds to first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0)
+    parser.add_argument("--max-concurrency", type=int, default=4)
+    parser.add_argument("--reject-when-busy", action="store_true", help="answer 429 instead of queueing")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--stream-abort-rate", type=float, default=0.0)
+    parser.add_argument("--embedding-dim", type=int, default=384)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = FakeServerConfig(
+        ttft=args.ttft, tokens_per_sec=args.tokens_per_sec, max_concurrency=args.max_concurrency,
+        reject_when_busy=args.reject_when_busy, error_rate=args.error_rate, error_status=args.error_status,
+        stream_abort_rate=args.stream_abort_rate, embedding_dim=args.embedding_dim, seed=args.seed,
+    )
+    import uvicorn
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+# llm_cache.py
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import zstandard
+from .config import LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS, LLM_CACHE_MAX_DISK_BYTES
+
+logger = logging.getLogger("llm_cache")
+
+# Only these fields decide what the model produces; anything else (stream flag, headers) is ignored.
+_KEY_FIELDS = ("model", "messages", "temperature", "max_tokens")
+
+
+def request_cache_key(payload: Dict[str, Any]) -> str:
+    """
+    Hash of the normalized request payload: (model, messages, temperature, max_tokens).
+    Message contents are stripped and newlines normalized so that cosmetic differences
+    (indentation of triple-quoted prompts, CRLF) still hit the same entry.
+    """
+    normalized = {
+        "model": payload.get("model"),
+        "messages": [
+            {"role": m.get("role"), "content": _normalize_text(m.get("content", ""))}
+            for m in payload.get("messages", [])
+        ],
+        "temperature": round(float(payload.get("temperature", 0.0)), 4),
+        "max_tokens": payload.get("max_tokens"),
+    }
+    for field in payload:
+        if field not in _KEY_FIELDS and field != "stream":
+            normalized[field] = payload[field]
+    blob = json.dumps(normalized, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def _normalize_text(text: str) -> str:
+    lines = text.replace("\r\n", "\n").split("\n")
+    return "\n".join(line.strip() for line in lines).strip()
+
+
+class LLMResponseCache:
+    """
+    Two-tier cache for LLM completions.
+     - memory: LRU of at most `max_entries` responses
+     - disk:   SQLite table with zstd-compressed JSON, bounded by `max_disk_bytes`
+    Entries expire after `ttl_seconds` in both tiers. A disk hit is promoted to memory.
+    Thread-safe; the same instance can be shared by the sync and async clients.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: int = LLM_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = LLM_CACHE_TTL_SECONDS, max_disk_bytes: int = LLM_CACHE_MAX_DISK_BYTES):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, response)
+        self._lock = threading.Lock()
+        self._compressor = zstandard.ZstdCompressor(level=3)
+        self._decompressor = zstandard.ZstdDecompressor()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self._conn: Optional[sqlite3.Connection] = None
+        if path:
+            self._init_disk(path)
+
+    def _init_disk(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL,"
+            " expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_access ON llm_cache(last_access)")
+        self._conn.commit()
+        logger.info("LLM response cache on disk at %s", path)
+
+    # --- public API ---
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, response = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    return response
+                del self._memory[key]
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[1] > now:
+                    self._conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+                    self._conn.commit()
+                    response = json.loads(self._decompressor.decompress(row[0]))
+                    self._remember(key, row[1], response)
+                    self._counters["disk_hits"] += 1
+                    return response
+            self._counters["misses"] += 1
+            return None
+
+    def set(self, key: str, response: Dict[str, Any]):
+        now = time.time()
+        expires_at = now + self.ttl_seconds
+        with self._lock:
+            self._remember(key, expires_at, response)
+            self._counters["stores"] += 1
+            if self._conn is not None:
+                blob = self._compressor.compress(json.dumps(response, ensure_ascii=False).encode("utf-8"))
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, value, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, blob, len(blob), expires_at, now),
+                )
+                self._evict_disk(now)
+                self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["memory_entries"] = len(self._memory)
+            lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+            stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+            if self._conn is not None:
+                count, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache").fetchone()
+                stats["disk_entries"] = count
+                stats["disk_bytes"] = size
+            return stats
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM llm_cache")
+                self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # --- internals (caller holds the lock) ---
+    def _remember(self, key: str, expires_at: float, response: Dict[str, Any]):
+        self._memory[key] = (expires_at, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def _evict_disk(self, now: float):
+        expired = self._conn.execute("DELETE FROM llm_cache WHERE expires_at <= ?", (now,)).rowcount
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        evicted = 0
+        while total > self.max_disk_bytes:
+            row = self._conn.execute("SELECT key, size FROM llm_cache ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (row[0],))
+            total -= row[1]
+            evicted += 1
+        self._counters["evictions"] += expired + evicted
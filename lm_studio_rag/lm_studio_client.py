@@ -1,98 +1,761 @@
 # lm_studio_client.py
+import abc
+import asyncio
+import json
+import threading
+import time
 import requests
+import httpx
 import logging
-from typing import List, Dict, Any, Optional
-from .config import LM_STUDIO_BASE_URL, LM_STUDIO_API_KEY
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from tenacity import Retrying, AsyncRetrying, RetryCallState, stop_after_attempt, wait_random_exponential
+from typing import List, Dict, Any, Optional, Tuple, Iterator, AsyncIterator, Union, Sequence
+from .config import (
+    LM_STUDIO_BASE_URLS, LM_STUDIO_API_KEY,
+    LM_STUDIO_MAX_CONNECTIONS, LM_STUDIO_MAX_KEEPALIVE_CONNECTIONS, LM_STUDIO_KEEPALIVE_EXPIRY,
+    LLM_MAX_IN_FLIGHT, LLM_RETRY_ATTEMPTS, LLM_RETRY_BACKOFF_BASE, LLM_RETRY_BACKOFF_MAX,
+    LLM_HEDGE_ENABLED, LLM_HEDGE_QUANTILE,
+    EMBEDDING_BATCH_MAX_ITEMS, EMBEDDING_BATCH_MAX_CHARS, EMBEDDING_MAX_CONCURRENCY,
+)
+from .llm_cache import LLMResponseCache, request_cache_key
+from .single_flight import SingleFlight, AsyncSingleFlight
+from .scheduler import PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from .endpoint_pool import EndpointPool, Endpoint
+from .resilience import RetryBudget, LatencyTracker, get_retry_budget, backoff_delay
+from .cassette import Cassette
+from .routing import ModelRouter, StageProfile, STAGE_CLASSIFICATION
 
 logger = logging.getLogger("lmstudio")
 
-class LMStudioClient:
+# --- shared connection pools (one per base URL) ---
+_sync_sessions: Dict[str, requests.Session] = {}
+_async_clients: Dict[Tuple[str, int], httpx.AsyncClient] = {}
+_pool_lock = threading.Lock()
+
+
+def _get_sync_session(base_url: str, max_connections: int) -> requests.Session:
+    with _pool_lock:
+        session = _sync_sessions.get(base_url)
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sync_sessions[base_url] = session
+        return session
+
+
+def _get_async_client(base_url: str, limits: httpx.Limits, timeout: float) -> httpx.AsyncClient:
+    # httpx.AsyncClient の接続はイベントループに紐づくため、ループごとにプールを分ける
+    key = (base_url, id(asyncio.get_running_loop()))
+    with _pool_lock:
+        client = _async_clients.get(key)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout)
+            _async_clients[key] = client
+        return client
+
+
+async def aclose_all_pools():
+    """Close every async connection pool bound to the running event loop (call on app shutdown)."""
+    loop_id = id(asyncio.get_running_loop())
+    with _pool_lock:
+        keys = [k for k in _async_clients if k[1] == loop_id]
+        clients = [_async_clients.pop(k) for k in keys]
+    for client in clients:
+        await client.aclose()
+
+
+class _LMStudioBase(abc.ABC):
     """
-    Minimal OpenAI-compatible client for LM Studio (chat + embeddings).
-    Uses requests to talk to /v1/chat/completions and /v1/embeddings.
+    Payload builders and response parsers shared by the sync and async clients.
+    Subclasses say which of their transport's errors are transient (_is_retryable).
     """
 
-    def __init__(self, base_url: str = LM_STUDIO_BASE_URL, api_key: str = LM_STUDIO_API_KEY, timeout: int = 30):
-        self.base_url = base_url.rstrip("/")
+    # generation settings of a chat call made without a stage, for arguments left as None
+    UNROUTED_PROFILE = StageProfile(model="gpt-4o-mini", max_tokens=512, temperature=0.2)
+
+    def __init__(self, base_url: Union[str, Sequence[str]], api_key: str, timeout: float, cache: Optional[LLMResponseCache] = None,
+                 pool: Optional[EndpointPool] = None, max_in_flight: int = LLM_MAX_IN_FLIGHT,
+                 retry_attempts: int = LLM_RETRY_ATTEMPTS, retry_budget: Optional[RetryBudget] = None,
+                 cassette: Optional[Cassette] = None, router: Optional[ModelRouter] = None):
+        # base_url may be a list of backends; requests are routed over them by the endpoint pool,
+        # and every call takes a slot from the chosen endpoint's scheduler
+        self.pool = pool if pool is not None else EndpointPool(base_url, max_in_flight=max_in_flight)
+        self.base_url = self.pool.primary.base_url
         self.api_key = api_key
         self.timeout = timeout
+        self.cache = cache
+        # record/replay of upstream traffic (see cassette.py); sits below the cache and request coalescing
+        self.cassette = cassette
+        self.retry_attempts = max(1, retry_attempts)
+        self.retry_budget = retry_budget if retry_budget is not None else get_retry_budget()
+        # stage -> model / max_tokens / temperature / stop, plus per-stage token usage
+        self.router = router if router is not None else ModelRouter()
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
         }
 
-    def _post(self, path: str, payload: dict) -> dict:
-        url = f"{self.base_url}{path}"
-        try:
-            r = requests.post(url, json=payload, headers=self.headers, timeout=self.timeout)
-            r.raise_for_status()
-            return r.json()
-        except requests.RequestException as e:
-            logger.exception("Request to LM Studio failed: %s", e)
-            raise
+    def stats(self) -> Dict[str, Any]:
+        """Counters of the layers in front of LM Studio (cache, request coalescing, per-endpoint routing and scheduling)."""
+        return {
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "single_flight": self.flight.stats(),
+            "endpoints": self.pool.stats(),
+            "retry_budget": self.retry_budget.stats(),
+            "cassette": self.cassette.stats() if self.cassette is not None else None,
+            "routing": self.router.stats(),
+        }
 
-    # --- embeddings ---
-    def embed_texts(self, texts: List[str], model: str = "text-embedding-3-small") -> List[List[float]]:
-        """
-        Call embeddings endpoint. model name may vary by LMStudio install; adjust accordingly.
-        Returns: list of embeddings (list of floats).
-        """
-        payload = {
+    # --- retries ---
+    @abc.abstractmethod
+    def _is_retryable(self, e: BaseException) -> bool:
+        """Whether `e` is a transient failure (429, 5xx, connection errors, timeouts) worth retrying."""
+
+    def _may_retry(self, e: BaseException, attempt: int) -> bool:
+        """Retry transient failures while attempts remain and the global retry budget allows it."""
+        if attempt >= self.retry_attempts or not self._is_retryable(e):
+            return False
+        if not self.retry_budget.try_spend():
+            logger.warning("Retry budget exhausted; not retrying: %s", e)
+            return False
+        logger.warning("LM Studio call failed (attempt %d/%d), retrying: %s", attempt, self.retry_attempts, e)
+        return True
+
+    def _should_retry(self, state: RetryCallState) -> bool:
+        return state.outcome.failed and self._may_retry(state.outcome.exception(), state.attempt_number)
+
+    def _retry_policy(self, retrying_cls):
+        """tenacity Retrying / AsyncRetrying with full-jitter exponential backoff."""
+        return retrying_cls(
+            stop=stop_after_attempt(self.retry_attempts),
+            wait=wait_random_exponential(multiplier=LLM_RETRY_BACKOFF_BASE, max=LLM_RETRY_BACKOFF_MAX),
+            retry=self._should_retry,
+            reraise=True,
+        )
+
+    @staticmethod
+    def _retry_delay(attempt: int) -> float:
+        return backoff_delay(attempt, LLM_RETRY_BACKOFF_BASE, LLM_RETRY_BACKOFF_MAX)
+
+    @staticmethod
+    def _flight_key(path: str, payload: dict) -> str:
+        return f"{path}:{request_cache_key(payload)}"
+
+    # --- response cache helpers ---
+    @staticmethod
+    def _cacheable(payload: dict, use_cache: Optional[bool]) -> bool:
+        """use_cache=None caches only deterministic (temperature 0) calls; sampled calls must opt in explicitly."""
+        if use_cache is None:
+            return payload.get("temperature") == 0
+        return use_cache
+
+    def _cache_lookup(self, payload: dict, use_cache: Optional[bool]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """Returns (key, cached_response); key is None when caching is off for this call."""
+        if self.cache is None or not self._cacheable(payload, use_cache):
+            return None, None
+        key = request_cache_key(payload)
+        return key, self.cache.get(key)
+
+    def _cache_store(self, key: Optional[str], resp: Dict[str, Any]):
+        if key is not None:
+            self.cache.set(key, resp)
+
+    @staticmethod
+    def _completion_from_text(text: str, model: str) -> Dict[str, Any]:
+        # a streamed completion is cached in the same shape as a non-streamed one
+        return {"model": model, "choices": [{"index": 0, "message": {"role": "assistant", "content": text}}]}
+
+    @staticmethod
+    def _completion_text(resp: Dict[str, Any]) -> str:
+        return resp["choices"][0]["message"]["content"]
+
+    @staticmethod
+    def _parse_models(resp: dict) -> List[str]:
+        # /v1/models: {'data': [{'id': 'gemma-3-1b-it', ...}, ...]}
+        return [m["id"] for m in resp.get("data", []) if "id" in m]
+
+    @staticmethod
+    def _embeddings_payload(texts: List[str], model: str) -> dict:
+        return {
             "model": model,
             "input": texts
         }
-        resp = self._post("/v1/embeddings", payload)
+
+    @staticmethod
+    def _parse_embeddings(resp: dict) -> List[List[float]]:
         # Response format assumed: {'data': [{'embedding': [...], 'index': 0}, ...], ...}
-        embeddings = [d["embedding"] for d in resp.get("data", [])]
-        return embeddings
+        data = sorted(resp.get("data", []), key=lambda d: d.get("index", 0))
+        return [d["embedding"] for d in data]
 
-    # --- chat completions (for generating RAG responses or classification via prompt) ---
-    def chat(self, messages: List[Dict[str, str]], model: str = "gpt-4o-mini", temperature: float = 0.2, max_tokens: int = 512) -> Dict[str, Any]:
+    @staticmethod
+    def _embedding_chunks(texts: List[str], max_items: int = EMBEDDING_BATCH_MAX_ITEMS,
+                          max_chars: int = EMBEDDING_BATCH_MAX_CHARS) -> List[List[str]]:
+        """Split texts into consecutive chunks bounded by item count and total characters (a single long text gets its own chunk)."""
+        chunks, current, chars = [], [], 0
+        for text in texts:
+            if current and (len(current) >= max_items or chars + len(text) > max_chars):
+                chunks.append(current)
+                current, chars = [], 0
+            current.append(text)
+            chars += len(text)
+        if current:
+            chunks.append(current)
+        return chunks
+
+    @staticmethod
+    def _dedupe(texts: List[str]) -> Tuple[List[str], List[int]]:
+        """Unique texts (first-seen order) and, for every input, the position of its unique text."""
+        positions: Dict[str, int] = {}
+        inverse = [positions.setdefault(t, len(positions)) for t in texts]
+        return list(positions), inverse
+
+    @staticmethod
+    def _assemble_embeddings(chunk_results: List[List[List[float]]], inverse: List[int]) -> np.ndarray:
+        vectors = [v for chunk in chunk_results for v in chunk]
+        if not vectors:
+            return np.zeros((0, 0), dtype=np.float32)
+        unique = np.asarray(vectors, dtype=np.float32)
+        return unique[inverse]
+
+    @staticmethod
+    def _chat_payload(messages: List[Dict[str, str]], model: str, temperature: float, max_tokens: int, stream: bool = False,
+                      stop: Sequence[str] = ()) -> dict:
         payload = {
             "model": model,
             "messages": messages,
             "temperature": temperature,
             "max_tokens": max_tokens
         }
-        resp = self._post("/v1/chat/completions", payload)
-        # assumed response: {'choices': [{'message': {'role':'assistant','content':'...'}}], ...}
-        return resp
+        if stop:
+            payload["stop"] = list(stop)
+        if stream:
+            payload["stream"] = True
+        return payload
 
-    def classify_content_via_llm(self, text: str, labels: List[str] = ["personality", "experience"]) -> Dict[str, Any]:
+    def _routed_chat_payload(self, messages: List[Dict[str, str]], model: Optional[str], temperature: Optional[float],
+                             max_tokens: Optional[int], stream: bool, stage: Optional[str]) -> dict:
         """
-        Use an LLM prompt to classify text into 'personality' or 'experience', returning label and confidence-like score.
-        Note: LLM-based confidence is heuristic (we extract numeric if provided).
+        Explicit model / temperature / max_tokens win; those left as None come from the stage's routing profile
+        (UNROUTED_PROFILE without a stage), which also supplies the stop sequences.
+        """
+        profile = self.router.profile(stage) if stage is not None else self.UNROUTED_PROFILE
+        return self._chat_payload(messages, model if model is not None else profile.model,
+                                  temperature if temperature is not None else profile.temperature,
+                                  max_tokens if max_tokens is not None else profile.max_tokens,
+                                  stream=stream, stop=profile.stop)
+
+    @staticmethod
+    def _parse_stream_line(line: str) -> Optional[str]:
+        """
+        Parse one SSE line of a streamed chat completion.
+        Returns the content delta ("" for keep-alives / role-only chunks), or None at `data: [DONE]`.
         """
+        line = line.strip()
+        if not line.startswith("data:"):
+            return ""
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return None
+        try:
+            chunk = json.loads(data)
+            return chunk["choices"][0].get("delta", {}).get("content") or ""
+        except (ValueError, KeyError, IndexError):
+            logger.warning("Unparseable stream chunk from LM Studio: %s", data[:200])
+            return ""
+
+    @staticmethod
+    def _classification_messages(text: str) -> List[Dict[str, str]]:
         system = (
             "あなたは短いテキストを「人格情報(personality)」か「体験情報(experience)」に分類するアシスタントです。"
             " 出力は必ずJSONのみで返してください： {\"label\":\"personality|experience\", \"score\":0.0, \"reason\":\"...\"}"
             " scoreは0.0〜1.0の推定信頼度で簡潔に答えてください。"
         )
         user_msg = f"テキストを分類してください:\n\n\"\"\"\n{text}\n\"\"\"\n\n"
-        messages = [
+        return [
             {"role": "system", "content": system},
             {"role": "user", "content": user_msg}
         ]
-        resp = self.chat(messages, temperature=0.0, max_tokens=200)
+
+    @staticmethod
+    def _parse_classification(resp: Dict[str, Any]) -> Dict[str, Any]:
         # extract assistant content
         try:
             assistant = resp["choices"][0]["message"]["content"]
-            import json
             parsed = json.loads(assistant)
             return parsed
         except Exception:
             # fallback: return naive default if parsing fails
             return {"label": "personality", "score": 0.5, "reason": "parsing_failed; returned fallback"}
 
-    def generate_response(self, query: str, context: str, model: str = "gpt-4o-mini", temperature: float = 0.2, max_tokens: int = 512) -> str:
-        """
-        Simple RAG-style prompt: system prompt sets behavior, context is appended.
-        """
+    @staticmethod
+    def _rag_messages(query: str, context: str) -> List[Dict[str, str]]:
         system = "あなたは知識ベースと会話文脈を統合して正確で簡潔な回答を作成するアシスタントです。"
         user = f"Context:\n{context}\n\nQuestion:\n{query}\n\nAnswer concisely and cite context snippets if helpful."
-        messages = [
+        return [
             {"role": "system", "content": system},
             {"role": "user", "content": user}
         ]
-        resp = self.chat(messages, model=model, temperature=temperature, max_tokens=max_tokens)
-        return resp["choices"][0]["message"]["content"]
\ No newline at end of file
+
+
+class LMStudioClient(_LMStudioBase):
+    """
+    Minimal OpenAI-compatible client for LM Studio (chat + embeddings).
+    Uses a pooled requests.Session (HTTP keep-alive) to talk to /v1/chat/completions and /v1/embeddings.
+    """
+
+    def __init__(self, base_url: Union[str, Sequence[str]] = LM_STUDIO_BASE_URLS, api_key: str = LM_STUDIO_API_KEY, timeout: int = 30,
+                 max_connections: int = LM_STUDIO_MAX_CONNECTIONS, cache: Optional[LLMResponseCache] = None,
+                 pool: Optional[EndpointPool] = None, retry_attempts: int = LLM_RETRY_ATTEMPTS,
+                 retry_budget: Optional[RetryBudget] = None, cassette: Optional[Cassette] = None,
+                 router: Optional[ModelRouter] = None):
+        super().__init__(base_url, api_key, timeout, cache, pool, retry_attempts=retry_attempts, retry_budget=retry_budget,
+                         cassette=cassette, router=router)
+        self.max_connections = max_connections
+        self.session = self._session_for(self.pool.primary)
+        # identical concurrent requests (and streams) share one upstream call
+        self.flight = SingleFlight()
+
+    def _session_for(self, endpoint: Endpoint) -> requests.Session:
+        return _get_sync_session(endpoint.base_url, self.max_connections)
+
+    @staticmethod
+    def _is_endpoint_failure(e: BaseException) -> bool:
+        if isinstance(e, requests.HTTPError):
+            return e.response is not None and e.response.status_code >= 500
+        return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+    def _is_retryable(self, e: BaseException) -> bool:
+        if isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code == 429:
+            return True
+        return self._is_endpoint_failure(e)
+
+    def check_health(self):
+        """Probe /v1/models on every endpoint: refreshes model availability, ejects / re-admits nodes."""
+        for endpoint in self.pool.endpoints:
+            try:
+                r = self._session_for(endpoint).get(f"{endpoint.base_url}/v1/models", headers=self.headers, timeout=self.timeout)
+                r.raise_for_status()
+                self.pool.record_probe(endpoint, self._parse_models(r.json()))
+            except (requests.RequestException, ValueError) as e:
+                logger.warning("Health probe of %s failed: %s", endpoint.base_url, e)
+                self.pool.record_probe(endpoint, error=e)
+
+    def _post(self, path: str, payload: dict, coalesce: bool = True, priority: str = PRIORITY_INTERACTIVE) -> dict:
+        if not coalesce:
+            return self._send(path, payload, priority)
+        return self.flight.do(self._flight_key(path, payload), lambda: self._send(path, payload, priority))
+
+    def _post_stream(self, path: str, payload: dict, coalesce: bool = True, priority: str = PRIORITY_INTERACTIVE) -> Iterator[str]:
+        if not coalesce:
+            return self._send_stream(path, payload, priority)
+        return self.flight.stream(self._flight_key(path, payload), lambda: self._send_stream(path, payload, priority))
+
+    def _send(self, path: str, payload: dict, priority: str = PRIORITY_INTERACTIVE) -> dict:
+        if self.cassette is not None:
+            return self.cassette.wrap_call(path, payload, lambda: self._send_upstream(path, payload, priority))
+        return self._send_upstream(path, payload, priority)
+
+    def _send_upstream(self, path: str, payload: dict, priority: str) -> dict:
+        self.retry_budget.record_request()
+        try:
+            return self._retry_policy(Retrying)(self._attempt, path, payload, priority)
+        except requests.RequestException as e:
+            logger.exception("Request to LM Studio failed: %s", e)
+            raise
+
+    def _attempt(self, path: str, payload: dict, priority: str) -> dict:
+        with self.pool.lease(payload.get("model"), self._is_endpoint_failure) as endpoint, \
+                endpoint.scheduler.slot(priority, self._is_retryable):
+            r = self._session_for(endpoint).post(f"{endpoint.base_url}{path}", json=payload, headers=self.headers, timeout=self.timeout)
+            r.raise_for_status()
+        return r.json()
+
+    def _send_stream(self, path: str, payload: dict, priority: str = PRIORITY_INTERACTIVE) -> Iterator[str]:
+        if self.cassette is not None:
+            return self.cassette.wrap_stream(path, payload, lambda: self._send_stream_upstream(path, payload, priority))
+        return self._send_stream_upstream(path, payload, priority)
+
+    def _send_stream_upstream(self, path: str, payload: dict, priority: str) -> Iterator[str]:
+        self.retry_budget.record_request()
+        attempt = 1
+        while True:
+            started = False
+            try:
+                for delta in self._attempt_stream(path, payload, priority):
+                    started = True
+                    yield delta
+                return
+            except requests.RequestException as e:
+                # once deltas have been relayed a retry would repeat them, so only failures before the first delta are retried
+                if started or not self._may_retry(e, attempt):
+                    logger.exception("Streaming request to LM Studio failed: %s", e)
+                    raise
+            time.sleep(self._retry_delay(attempt))
+            attempt += 1
+
+    def _attempt_stream(self, path: str, payload: dict, priority: str) -> Iterator[str]:
+        with self.pool.lease(payload.get("model"), self._is_endpoint_failure) as endpoint, \
+                endpoint.scheduler.slot(priority, self._is_retryable) as slot, \
+                self._session_for(endpoint).post(f"{endpoint.base_url}{path}", json=payload, headers=self.headers,
+                                                 timeout=self.timeout, stream=True) as r:
+            r.raise_for_status()
+            for line in r.iter_lines(decode_unicode=True):
+                slot.mark()
+                delta = self._parse_stream_line(line or "")
+                if delta is None:
+                    break
+                if delta:
+                    yield delta
+
+    # --- embeddings ---
+    def embed_texts(self, texts: List[str], model: str = "text-embedding-3-small", priority: str = PRIORITY_INTERACTIVE,
+                    max_concurrency: int = EMBEDDING_MAX_CONCURRENCY) -> np.ndarray:
+        """
+        Call embeddings endpoint. model name may vary by LMStudio install; adjust accordingly.
+        Duplicate texts are embedded once; the rest is split into chunks (EMBEDDING_BATCH_MAX_ITEMS / _CHARS)
+        sent on up to `max_concurrency` threads.
+        Returns: float32 array of shape (len(texts), dim), in input order.
+        """
+        unique, inverse = self._dedupe(texts)
+        chunks = self._embedding_chunks(unique)
+
+        def embed(chunk: List[str]) -> List[List[float]]:
+            return self._parse_embeddings(self._post("/v1/embeddings", self._embeddings_payload(chunk, model), priority=priority))
+
+        if len(chunks) <= 1 or max_concurrency <= 1:
+            results = [embed(chunk) for chunk in chunks]
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_concurrency, len(chunks))) as executor:
+                results = list(executor.map(embed, chunks))
+        return self._assemble_embeddings(results, inverse)
+
+    def _stream_chat(self, payload: dict, use_cache: Optional[bool], priority: str, stage: Optional[str] = None) -> Iterator[str]:
+        key, cached = self._cache_lookup(payload, use_cache)
+        if cached is not None:
+            self.router.record_stream(stage, payload, 0, cached=True)
+            yield self._completion_text(cached)
+            return
+        parts = []
+        for delta in self._post_stream("/v1/chat/completions", payload, coalesce=use_cache is not False, priority=priority):
+            parts.append(delta)
+            yield delta
+        self.router.record_stream(stage, payload, len(parts))
+        self._cache_store(key, self._completion_from_text("".join(parts), payload["model"]))
+
+    # --- chat completions (for generating RAG responses or classification via prompt) ---
+    def chat(self, messages: List[Dict[str, str]], model: Optional[str] = None, temperature: Optional[float] = None,
+             max_tokens: Optional[int] = None, stream: bool = False, use_cache: Optional[bool] = None,
+             priority: str = PRIORITY_INTERACTIVE, stage: Optional[str] = None) -> Union[Dict[str, Any], Iterator[str]]:
+        """
+        stream=False: returns the raw completion response.
+        stream=True: returns an iterator of content deltas as they arrive.
+        use_cache: None (default) caches the response only at temperature 0, True caches a sampled call too,
+        False bypasses the response cache and request coalescing for this call.
+        priority: scheduler class (PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND).
+        stage: pipeline stage (routing.STAGE_*); its profile fills in model, temperature and max_tokens left as None,
+        and adds stop sequences.
+        """
+        payload = self._routed_chat_payload(messages, model, temperature, max_tokens, stream, stage)
+        if stream:
+            return self._stream_chat(payload, use_cache, priority, stage)
+        key, cached = self._cache_lookup(payload, use_cache)
+        if cached is not None:
+            self.router.record_completion(stage, payload, cached, cached=True)
+            return cached
+        resp = self._post("/v1/chat/completions", payload, coalesce=use_cache is not False, priority=priority)
+        # assumed response: {'choices': [{'message': {'role':'assistant','content':'...'}}], ...}
+        self.router.record_completion(stage, payload, resp)
+        self._cache_store(key, resp)
+        return resp
+
+    def classify_content_via_llm(self, text: str, labels: List[str] = ["personality", "experience"], use_cache: Optional[bool] = None,
+                                 priority: str = PRIORITY_BACKGROUND) -> Dict[str, Any]:
+        """
+        Use an LLM prompt to classify text into 'personality' or 'experience', returning label and confidence-like score.
+        Note: LLM-based confidence is heuristic (we extract numeric if provided).
+        """
+        resp = self.chat(self._classification_messages(text), use_cache=use_cache, priority=priority, stage=STAGE_CLASSIFICATION)
+        return self._parse_classification(resp)
+
+    def generate_response(self, query: str, context: str, model: Optional[str] = None, temperature: Optional[float] = None,
+                          max_tokens: Optional[int] = None, use_cache: Optional[bool] = None,
+                          priority: str = PRIORITY_INTERACTIVE, stage: Optional[str] = None) -> str:
+        """
+        Simple RAG-style prompt: system prompt sets behavior, context is appended.
+        """
+        resp = self.chat(self._rag_messages(query, context), model=model, temperature=temperature, max_tokens=max_tokens,
+                         use_cache=use_cache, priority=priority, stage=stage)
+        return self._completion_text(resp)
+
+    def generate_response_stream(self, query: str, context: str, model: Optional[str] = None,
+                                 temperature: Optional[float] = None, max_tokens: Optional[int] = None,
+                                 use_cache: Optional[bool] = None, priority: str = PRIORITY_INTERACTIVE,
+                                 stage: Optional[str] = None) -> Iterator[str]:
+        """
+        Streaming variant of generate_response: yields content deltas.
+        """
+        return self.chat(self._rag_messages(query, context), model=model, temperature=temperature, max_tokens=max_tokens,
+                         stream=True, use_cache=use_cache, priority=priority, stage=stage)
+
+
+class AsyncLMStudioClient(_LMStudioBase):
+    """
+    asyncio版のLM Studioクライアント。
+    httpx.AsyncClient を base URL ごとに共有し、keep-alive 接続をプールして再利用します。
+    メソッドは LMStudioClient と同じシグネチャで、すべて await して使います。
+    """
+
+    def __init__(self, base_url: Union[str, Sequence[str]] = LM_STUDIO_BASE_URLS, api_key: str = LM_STUDIO_API_KEY, timeout: float = 30,
+                 max_connections: int = LM_STUDIO_MAX_CONNECTIONS,
+                 max_keepalive_connections: int = LM_STUDIO_MAX_KEEPALIVE_CONNECTIONS,
+                 keepalive_expiry: float = LM_STUDIO_KEEPALIVE_EXPIRY,
+                 cache: Optional[LLMResponseCache] = None, pool: Optional[EndpointPool] = None,
+                 retry_attempts: int = LLM_RETRY_ATTEMPTS, retry_budget: Optional[RetryBudget] = None,
+                 hedge: bool = LLM_HEDGE_ENABLED, hedge_quantile: float = LLM_HEDGE_QUANTILE,
+                 cassette: Optional[Cassette] = None, router: Optional[ModelRouter] = None):
+        super().__init__(base_url, api_key, timeout, cache, pool, retry_attempts=retry_attempts, retry_budget=retry_budget,
+                         cassette=cassette, router=router)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        # identical concurrent requests (and streams) share one upstream call
+        self.flight = AsyncSingleFlight()
+        # hedging: a non-streaming interactive call still running after the observed p95 gets a duplicate on another endpoint
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.latency = LatencyTracker()
+        self._hedge_counters = {"fired": 0, "won": 0}
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats["hedging"] = dict(self._hedge_counters, enabled=self.hedge,
+                                threshold_s=self.latency.quantile(self.hedge_quantile))
+        return stats
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        return self._http_for(self.pool.primary)
+
+    def _http_for(self, endpoint: Endpoint) -> httpx.AsyncClient:
+        return _get_async_client(endpoint.base_url, self.limits, self.timeout)
+
+    @staticmethod
+    def _is_endpoint_failure(e: BaseException) -> bool:
+        if isinstance(e, httpx.HTTPStatusError):
+            return e.response.status_code >= 500
+        return isinstance(e, httpx.TransportError)
+
+    def _is_retryable(self, e: BaseException) -> bool:
+        if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 429:
+            return True
+        return self._is_endpoint_failure(e)
+
+    async def check_health(self):
+        """Probe /v1/models on every endpoint concurrently (see LMStudioClient.check_health)."""
+        await asyncio.gather(*[self._probe(endpoint) for endpoint in self.pool.endpoints])
+
+    async def _probe(self, endpoint: Endpoint):
+        try:
+            r = await self._http_for(endpoint).get("/v1/models", headers=self.headers)
+            r.raise_for_status()
+            self.pool.record_probe(endpoint, self._parse_models(r.json()))
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning("Health probe of %s failed: %s", endpoint.base_url, e)
+            self.pool.record_probe(endpoint, error=e)
+
+    async def run_health_checks(self):
+        """Probe every `pool.probe_interval` seconds until cancelled (start as a task on app startup)."""
+        while True:
+            await self.check_health()
+            await asyncio.sleep(self.pool.probe_interval)
+
+    async def _post(self, path: str, payload: dict, coalesce: bool = True, priority: str = PRIORITY_INTERACTIVE) -> dict:
+        if not coalesce:
+            return await self._send(path, payload, priority)
+        return await self.flight.do(self._flight_key(path, payload), lambda: self._send(path, payload, priority))
+
+    def _post_stream(self, path: str, payload: dict, coalesce: bool = True, priority: str = PRIORITY_INTERACTIVE) -> AsyncIterator[str]:
+        if not coalesce:
+            return self._send_stream(path, payload, priority)
+        return self.flight.stream(self._flight_key(path, payload), lambda: self._send_stream(path, payload, priority))
+
+    async def _send(self, path: str, payload: dict, priority: str = PRIORITY_INTERACTIVE) -> dict:
+        if self.cassette is not None:
+            return await self.cassette.awrap_call(path, payload, lambda: self._send_upstream(path, payload, priority))
+        return await self._send_upstream(path, payload, priority)
+
+    async def _send_upstream(self, path: str, payload: dict, priority: str) -> dict:
+        self.retry_budget.record_request()
+        try:
+            return await self._retry_policy(AsyncRetrying)(self._attempt_hedged, path, payload, priority)
+        except httpx.HTTPError as e:
+            logger.exception("Request to LM Studio failed: %s", e)
+            raise
+
+    async def _attempt_hedged(self, path: str, payload: dict, priority: str) -> dict:
+        delay = self.latency.quantile(self.hedge_quantile) if self.hedge else None
+        if delay is None or priority != PRIORITY_INTERACTIVE or len(self.pool.endpoints) < 2:
+            return await self._attempt(path, payload, priority)
+        tried: set = set()
+        hedge = None
+        tasks = {asyncio.ensure_future(self._attempt(path, payload, priority, tried))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and self.retry_budget.try_spend():
+                self._hedge_counters["fired"] += 1
+                hedge = asyncio.ensure_future(self._attempt(path, payload, priority, tried))
+                tasks.add(hedge)
+            # first successful response wins; an error only counts once every copy has failed
+            pending, error = tasks, None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._hedge_counters["won"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _attempt(self, path: str, payload: dict, priority: str, tried: Optional[set] = None) -> dict:
+        started = time.monotonic()
+        with self.pool.lease(payload.get("model"), self._is_endpoint_failure, exclude=tried or ()) as endpoint:
+            if tried is not None:
+                tried.add(endpoint)
+            async with endpoint.scheduler.aslot(priority, self._is_retryable):
+                r = await self._http_for(endpoint).post(path, json=payload, headers=self.headers)
+                r.raise_for_status()
+        self.latency.observe(time.monotonic() - started)
+        return r.json()
+
+    def _send_stream(self, path: str, payload: dict, priority: str = PRIORITY_INTERACTIVE) -> AsyncIterator[str]:
+        if self.cassette is not None:
+            return self.cassette.awrap_stream(path, payload, lambda: self._send_stream_upstream(path, payload, priority))
+        return self._send_stream_upstream(path, payload, priority)
+
+    async def _send_stream_upstream(self, path: str, payload: dict, priority: str) -> AsyncIterator[str]:
+        self.retry_budget.record_request()
+        attempt = 1
+        while True:
+            started = False
+            try:
+                async for delta in self._attempt_stream(path, payload, priority):
+                    started = True
+                    yield delta
+                return
+            except httpx.HTTPError as e:
+                # once deltas have been relayed a retry would repeat them, so only failures before the first delta are retried
+                if started or not self._may_retry(e, attempt):
+                    logger.exception("Streaming request to LM Studio failed: %s", e)
+                    raise
+            await asyncio.sleep(self._retry_delay(attempt))
+            attempt += 1
+
+    async def _attempt_stream(self, path: str, payload: dict, priority: str) -> AsyncIterator[str]:
+        with self.pool.lease(payload.get("model"), self._is_endpoint_failure) as endpoint:
+            async with endpoint.scheduler.aslot(priority, self._is_retryable) as slot, \
+                    self._http_for(endpoint).stream("POST", path, json=payload, headers=self.headers) as r:
+                r.raise_for_status()
+                async for line in r.aiter_lines():
+                    slot.mark()
+                    delta = self._parse_stream_line(line)
+                    if delta is None:
+                        break
+                    if delta:
+                        yield delta
+
+    async def aclose(self):
+        """Close the connection pools of this client's endpoints on the running loop."""
+        loop_id = id(asyncio.get_running_loop())
+        with _pool_lock:
+            clients = [_async_clients.pop((e.base_url, loop_id), None) for e in self.pool.endpoints]
+        for client in clients:
+            if client is not None:
+                await client.aclose()
+
+    # --- embeddings ---
+    async def embed_texts(self, texts: List[str], model: str = "text-embedding-3-small", priority: str = PRIORITY_INTERACTIVE,
+                          max_concurrency: int = EMBEDDING_MAX_CONCURRENCY) -> np.ndarray:
+        """Chunked, concurrent embedding (see LMStudioClient.embed_texts); returns float32 (len(texts), dim)."""
+        unique, inverse = self._dedupe(texts)
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def embed(chunk: List[str]) -> List[List[float]]:
+            async with semaphore:
+                resp = await self._post("/v1/embeddings", self._embeddings_payload(chunk, model), priority=priority)
+            return self._parse_embeddings(resp)
+
+        results = await asyncio.gather(*[embed(chunk) for chunk in self._embedding_chunks(unique)])
+        return self._assemble_embeddings(list(results), inverse)
+
+    async def _stream_chat(self, payload: dict, use_cache: Optional[bool], priority: str, stage: Optional[str] = None) -> AsyncIterator[str]:
+        key, cached = self._cache_lookup(payload, use_cache)
+        if cached is not None:
+            self.router.record_stream(stage, payload, 0, cached=True)
+            yield self._completion_text(cached)
+            return
+        parts = []
+        async for delta in self._post_stream("/v1/chat/completions", payload, coalesce=use_cache is not False, priority=priority):
+            parts.append(delta)
+            yield delta
+        self.router.record_stream(stage, payload, len(parts))
+        self._cache_store(key, self._completion_from_text("".join(parts), payload["model"]))
+
+    # --- chat completions ---
+    async def chat(self, messages: List[Dict[str, str]], model: Optional[str] = None, temperature: Optional[float] = None,
+                   max_tokens: Optional[int] = None, stream: bool = False, use_cache: Optional[bool] = None,
+                   priority: str = PRIORITY_INTERACTIVE,
+                   stage: Optional[str] = None) -> Union[Dict[str, Any], AsyncIterator[str]]:
+        """
+        stream=False: returns the raw completion response.
+        stream=True: returns an async iterator of content deltas (`async for d in await client.chat(..., stream=True)`).
+        use_cache: None caches only temperature-0 calls, True opts a sampled call in, False also skips coalescing.
+        priority: scheduler class (PRIORITY_INTERACTIVE or PRIORITY_BACKGROUND).
+        stage: pipeline stage (routing.STAGE_*); its profile fills in model, temperature and max_tokens left as None,
+        and adds stop sequences.
+        """
+        payload = self._routed_chat_payload(messages, model, temperature, max_tokens, stream, stage)
+        if stream:
+            return self._stream_chat(payload, use_cache, priority, stage)
+        key, cached = self._cache_lookup(payload, use_cache)
+        if cached is not None:
+            self.router.record_completion(stage, payload, cached, cached=True)
+            return cached
+        resp = await self._post("/v1/chat/completions", payload, coalesce=use_cache is not False, priority=priority)
+        self.router.record_completion(stage, payload, resp)
+        self._cache_store(key, resp)
+        return resp
+
+    async def classify_content_via_llm(self, text: str, labels: List[str] = ["personality", "experience"], use_cache: Optional[bool] = None,
+                                       priority: str = PRIORITY_BACKGROUND) -> Dict[str, Any]:
+        resp = await self.chat(self._classification_messages(text), use_cache=use_cache, priority=priority,
+                               stage=STAGE_CLASSIFICATION)
+        return self._parse_classification(resp)
+
+    async def generate_response(self, query: str, context: str, model: Optional[str] = None,
+                                temperature: Optional[float] = None, max_tokens: Optional[int] = None,
+                                use_cache: Optional[bool] = None, priority: str = PRIORITY_INTERACTIVE,
+                                stage: Optional[str] = None) -> str:
+        resp = await self.chat(self._rag_messages(query, context), model=model, temperature=temperature, max_tokens=max_tokens,
+                               use_cache=use_cache, priority=priority, stage=stage)
+        return self._completion_text(resp)
+
+    async def generate_response_stream(self, query: str, context: str, model: Optional[str] = None,
+                                       temperature: Optional[float] = None, max_tokens: Optional[int] = None,
+                                       use_cache: Optional[bool] = None, priority: str = PRIORITY_INTERACTIVE,
+                                       stage: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Streaming variant of generate_response: `async for delta in client.generate_response_stream(...)`.
+        """
+        deltas = await self.chat(self._rag_messages(query, context), model=model, temperature=temperature, max_tokens=max_tokens,
+                                 stream=True, use_cache=use_cache, priority=priority, stage=stage)
+        async for delta in deltas:
+            yield delta
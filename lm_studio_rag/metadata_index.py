@@ -0,0 +1,142 @@
+# metadata_index.py
+import datetime
+import math
+from typing import Any, Dict, List, Optional, Sequence, Set, Union
+
+import numpy as np
+
+from .config import METADATA_FILTER_FIELDS
+
+TimeBound = Union[None, str, float, int, datetime.datetime]
+
+
+def to_timestamp(value: TimeBound) -> Optional[float]:
+    """Epoch seconds of an ISO-8601 string (as written by now_iso), a datetime or a number."""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)  # now_iso() is UTC
+    return value.timestamp()
+
+
+def saved_timestamp(meta: Dict[str, Any]) -> float:
+    """`saved_ts` of a document, or its parsed `saved_at` for rows stored before saved_ts existed; NaN if neither."""
+    if meta.get("saved_ts") is not None:
+        return float(meta["saved_ts"])
+    try:
+        return to_timestamp(meta["saved_at"])
+    except (KeyError, TypeError, ValueError):
+        return math.nan
+
+
+def as_list(value: Any) -> List[Any]:
+    """A filter value as the list of accepted values."""
+    return list(value) if isinstance(value, (list, tuple, set, frozenset)) else [value]
+
+
+def chroma_where(where: Dict[str, Any], saved_after: TimeBound = None, saved_before: TimeBound = None) -> Optional[Dict]:
+    """The same filter as a Chroma `where` clause (time bounds on the numeric saved_ts field)."""
+    clauses = []
+    for field, value in where.items():
+        wanted = as_list(value)
+        clauses.append({field: wanted[0]} if len(wanted) == 1 else {field: {"$in": wanted}})
+    if saved_after is not None:
+        clauses.append({"saved_ts": {"$gte": to_timestamp(saved_after)}})
+    if saved_before is not None:
+        clauses.append({"saved_ts": {"$lt": to_timestamp(saved_before)}})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+class MetadataIndex:
+    """
+    In-memory filter index over the FAISS documents, so search_similar can restrict the k-NN scan to matching
+    ids instead of filtering a fixed top_k afterwards.
+     - one set of slots per (field, value) for the fields in `fields` (METADATA_FILTER_FIELDS), so memory
+       follows the number of indexed values rather than distinct values x documents (e.g. many user_ids)
+     - a float64 column of saved timestamps for time ranges
+    Documents occupy slots; freed slots are reused. Not thread-safe: RAGStorage calls it under its lock.
+    """
+
+    def __init__(self, fields: Sequence[str] = METADATA_FILTER_FIELDS, capacity: int = 1024):
+        self.fields = tuple(fields)
+        self._slots: Dict[int, int] = {}  # faiss id -> slot
+        self._free: List[int] = []
+        self._size = 0  # slots ever used
+        self._fids = np.zeros(capacity, dtype=np.int64)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._saved_ts = np.full(capacity, math.nan)
+        self._values: List[Optional[Dict[str, Any]]] = [None] * capacity  # indexed values per slot, to clear bits
+        self._postings: Dict[str, Dict[Any, Set[int]]] = {field: {} for field in self.fields}
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def _grow(self):
+        capacity = 2 * len(self._fids)
+        self._fids = np.resize(self._fids, capacity)
+        self._alive = np.concatenate([self._alive, np.zeros(capacity - len(self._alive), dtype=bool)])
+        self._saved_ts = np.concatenate([self._saved_ts, np.full(capacity - len(self._saved_ts), math.nan)])
+        self._values.extend([None] * (capacity - len(self._values)))
+
+    def add(self, fid: int, meta: Dict[str, Any]):
+        """Index (or re-index) one document."""
+        self.remove(fid)
+        if self._free:
+            slot = self._free.pop()
+        else:
+            if self._size == len(self._fids):
+                self._grow()
+            slot = self._size
+            self._size += 1
+        self._slots[fid] = slot
+        self._fids[slot] = fid
+        self._alive[slot] = True
+        self._saved_ts[slot] = saved_timestamp(meta)
+        values = {}
+        for field in self.fields:
+            value = meta.get(field)
+            if value is None:
+                continue
+            self._postings[field].setdefault(value, set()).add(slot)
+            values[field] = value
+        self._values[slot] = values
+
+    def remove(self, fid: int):
+        slot = self._slots.pop(fid, None)
+        if slot is None:
+            return
+        self._alive[slot] = False
+        for field, value in self._values[slot].items():
+            slots = self._postings[field][value]
+            slots.discard(slot)
+            if not slots:
+                del self._postings[field][value]
+        self._values[slot] = None
+        self._free.append(slot)
+
+    def select(self, where: Dict[str, Any], saved_after: TimeBound = None, saved_before: TimeBound = None) -> np.ndarray:
+        """
+        Faiss ids of the documents matching every condition: `where` maps a field to a value or a list of
+        accepted values; saved_after (inclusive) / saved_before (exclusive) bound the saved time.
+        """
+        n = self._size
+        mask = self._alive[:n].copy()
+        for field, value in where.items():
+            if field not in self._postings:
+                raise ValueError(f"metadata field {field!r} is not indexed; METADATA_FILTER_FIELDS={self.fields}")
+            matched = np.zeros(n, dtype=bool)
+            for wanted in as_list(value):
+                slots = self._postings[field].get(wanted)
+                if slots:
+                    matched[np.fromiter(slots, dtype=np.int64, count=len(slots))] = True
+            mask &= matched
+        # comparisons with NaN are False, so undated rows drop out of any time range
+        if saved_after is not None:
+            mask &= self._saved_ts[:n] >= to_timestamp(saved_after)
+        if saved_before is not None:
+            mask &= self._saved_ts[:n] < to_timestamp(saved_before)
+        return self._fids[:n][mask]
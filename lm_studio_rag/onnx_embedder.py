@@ -0,0 +1,285 @@
+# onnx_embedder.py
+"""
+CPU embedding backend (EMBEDDING_BACKEND="onnx"): a sentence-transformers model exported once to ONNX,
+optionally dynamically quantized to int8, and run with onnxruntime and the `tokenizers` fast tokenizer.
+Serving needs neither torch nor sentence-transformers; exporting the artifact does (torch + transformers),
+so export on a build machine and ship ONNX_MODEL_DIR, or let the first start export it.
+Artifacts under ONNX_MODEL_DIR/<model>/: model.onnx (fp32), model.int8.onnx, tokenizer.json, pipeline.json.
+
+    python -m lm_studio_rag.onnx_embedder --export                  # build the artifacts
+    python -m lm_studio_rag.onnx_embedder --texts 2000 --batch 32   # parity and throughput against torch
+"""
+import argparse
+import inspect
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .config import (
+    EMBEDDING_MODEL_NAME, ONNX_MODEL_DIR, ONNX_QUANTIZE_INT8, ONNX_INTRA_OP_THREADS, ONNX_BATCH_SIZE,
+)
+
+logger = logging.getLogger("onnx_embedder")
+
+_FP32_FILE = "model.onnx"
+_INT8_FILE = "model.int8.onnx"
+_TOKENIZER_FILE = "tokenizer.json"
+_PIPELINE_FILE = "pipeline.json"
+_INPUT_NAMES = ("input_ids", "attention_mask", "token_type_ids")
+
+
+def _repo_id(model_name: str) -> str:
+    # SentenceTransformer resolves bare names under the sentence-transformers organization
+    return model_name if "/" in model_name or os.path.isdir(model_name) else f"sentence-transformers/{model_name}"
+
+
+def artifact_dir(model_name: str, root: str = ONNX_MODEL_DIR) -> str:
+    return os.path.join(root, _repo_id(model_name).strip("/").replace("/", "__"))
+
+
+def _model_file(model_name: str, filename: str) -> Optional[str]:
+    """Path of a file of the sentence-transformers model (local directory or Hugging Face Hub); None if absent."""
+    repo = _repo_id(model_name)
+    if os.path.isdir(repo):
+        path = os.path.join(repo, filename)
+        return path if os.path.exists(path) else None
+    from huggingface_hub import hf_hub_download
+    from huggingface_hub.utils import EntryNotFoundError
+    try:
+        return hf_hub_download(repo, filename)
+    except EntryNotFoundError:
+        return None
+
+
+def _read_pipeline(model_name: str) -> Dict[str, Any]:
+    """Pooling, normalization and max length of the sentence-transformers pipeline (modules.json and friends)."""
+    def load(filename, default):
+        path = _model_file(model_name, filename)
+        if path is None:
+            return default
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    modules = load("modules.json", [])
+    pooling_dir = next((m["path"] for m in modules if m["type"].endswith("Pooling")), "1_Pooling")
+    pooling = load(f"{pooling_dir}/config.json", {"pooling_mode_mean_tokens": True})
+    return {
+        "pooling": "cls" if pooling.get("pooling_mode_cls_token") else "mean",
+        "normalize": any(m["type"].endswith("Normalize") for m in modules),
+        "max_seq_length": load("sentence_bert_config.json", {}).get("max_seq_length", 256),
+        "dim": pooling.get("word_embedding_dimension"),
+    }
+
+
+def export_onnx(model_name: str = EMBEDDING_MODEL_NAME, root: str = ONNX_MODEL_DIR, quantize: bool = True) -> str:
+    """
+    Export the model's transformer to ONNX (dynamic batch and sequence axes) and, with `quantize`,
+    a dynamically int8-quantized copy. Files are written to a temporary name and renamed, so concurrent
+    workers exporting at the same start never load a partial artifact. Returns the artifact directory.
+    """
+    import torch
+    from transformers import AutoModel
+
+    directory = artifact_dir(model_name, root)
+    os.makedirs(directory, exist_ok=True)
+    fp32_path = os.path.join(directory, _FP32_FILE)
+    if not os.path.exists(fp32_path):
+        model = AutoModel.from_pretrained(_repo_id(model_name)).eval()
+        # models without segment embeddings (e.g. MPNet) take no token_type_ids
+        input_names = [name for name in _INPUT_NAMES if name in inspect.signature(model.forward).parameters]
+
+        class Encoder(torch.nn.Module):
+            """Positional inputs -> last_hidden_state, so the traced graph does not depend on forward()'s keywords."""
+
+            def __init__(self):
+                super().__init__()
+                self.model = model
+
+            def forward(self, *inputs):
+                return self.model(**dict(zip(input_names, inputs))).last_hidden_state
+
+        dummy = tuple((torch.zeros if name == "token_type_ids" else torch.ones)((1, 8), dtype=torch.long)
+                      for name in input_names)
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in (*input_names, "last_hidden_state")}
+        tmp = _temp_path(directory, _FP32_FILE)
+        with torch.no_grad():
+            # the TorchScript exporter: newer torch defaults to the dynamo one, which ignores dynamic_axes
+            # and needs onnxscript
+            torch.onnx.export(Encoder().eval(), dummy, tmp, input_names=input_names, output_names=["last_hidden_state"],
+                              dynamic_axes=dynamic_axes, opset_version=17, dynamo=False)
+        os.replace(tmp, fp32_path)
+        logger.info("Exported %s to %s", model_name, fp32_path)
+    int8_path = os.path.join(directory, _INT8_FILE)
+    if quantize and not os.path.exists(int8_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        tmp = _temp_path(directory, _INT8_FILE)
+        quantize_dynamic(fp32_path, tmp, weight_type=QuantType.QInt8)
+        os.replace(tmp, int8_path)
+        logger.info("Quantized %s to int8 (%s)", model_name, int8_path)
+    for filename, content in ((_TOKENIZER_FILE, None), (_PIPELINE_FILE, _read_pipeline(model_name))):
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            continue
+        tmp = _temp_path(directory, filename)
+        if content is None:
+            shutil.copyfile(_model_file(model_name, _TOKENIZER_FILE), tmp)
+        else:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(content, f)
+        os.replace(tmp, path)
+    return directory
+
+
+def _temp_path(directory: str, filename: str) -> str:
+    fd, path = tempfile.mkstemp(prefix=f".{filename}.", dir=directory)
+    os.close(fd)
+    return path
+
+
+def pool(hidden: np.ndarray, attention_mask: np.ndarray, mode: str = "mean", normalize: bool = True) -> np.ndarray:
+    """Sentence vectors from token states (batch, seq, dim), as the sentence-transformers Pooling/Normalize modules."""
+    if mode == "cls":
+        vectors = hidden[:, 0]
+    else:
+        mask = attention_mask[:, :, None].astype(np.float32)
+        vectors = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+    if normalize:
+        vectors = vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+    return vectors.astype(np.float32)
+
+
+class OnnxEmbedder:
+    """
+    SentenceTransformer-compatible embedder (encode, get_sentence_embedding_dimension) over an onnxruntime
+    session. Missing artifacts are exported on construction (which needs torch once).
+    Inputs are sorted by length and run in `batch_size` chunks, so short queries are not padded to long documents.
+    Sessions are thread-safe; onnxruntime parallelizes each run over `intra_op_threads` (0 = all cores).
+    """
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME, root: str = ONNX_MODEL_DIR,
+                 quantize: bool = ONNX_QUANTIZE_INT8, intra_op_threads: int = ONNX_INTRA_OP_THREADS,
+                 batch_size: int = ONNX_BATCH_SIZE):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        directory = artifact_dir(model_name, root)
+        model_path = os.path.join(directory, _INT8_FILE if quantize else _FP32_FILE)
+        if not all(os.path.exists(os.path.join(directory, name))
+                   for name in (os.path.basename(model_path), _TOKENIZER_FILE, _PIPELINE_FILE)):
+            export_onnx(model_name, root, quantize=quantize)
+        with open(os.path.join(directory, _PIPELINE_FILE), encoding="utf-8") as f:
+            self.pipeline = json.load(f)
+
+        self.model_name = model_name
+        self.quantized = quantize
+        self.batch_size = batch_size
+        self.tokenizer = Tokenizer.from_file(os.path.join(directory, _TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(max_length=self.pipeline["max_seq_length"])
+        padding = self.tokenizer.padding or {}
+        self.tokenizer.enable_padding(pad_id=padding.get("pad_id", 0), pad_token=padding.get("pad_token", "[PAD]"))
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self._inputs = {i.name for i in self.session.get_inputs()}
+        logger.info("Loaded ONNX embedder %s (%s)", model_name, "int8" if quantize else "fp32")
+
+    def _run(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        feed = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {name: value for name, value in feed.items() if name in self._inputs})[0]
+        return pool(hidden, feed["attention_mask"], self.pipeline["pooling"], self.pipeline["normalize"])
+
+    def encode(self, texts: List[str], show_progress_bar: bool = False, batch_size: Optional[int] = None,
+               **kwargs) -> np.ndarray:
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        batch_size = batch_size or self.batch_size
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = np.empty((len(texts), self.get_sentence_embedding_dimension()), dtype=np.float32)
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            vectors[rows] = self._run([texts[i] for i in rows])
+        return vectors
+
+    def get_sentence_embedding_dimension(self) -> Optional[int]:
+        if self.pipeline.get("dim") is None:
+            self.pipeline["dim"] = int(self._run(["dimension probe"]).shape[1])
+        return self.pipeline["dim"]
+
+
+# --- parity / throughput report ---
+def _throughput(embedder, texts: List[str], batch_size: int) -> float:
+    embedder.encode(texts[:batch_size], batch_size=batch_size)  # warm-up
+    start = time.perf_counter()
+    embedder.encode(texts, batch_size=batch_size)
+    return len(texts) / (time.perf_counter() - start)
+
+
+def parity_report(model_name: str = EMBEDDING_MODEL_NAME, texts: Optional[List[str]] = None,
+                  batch_size: int = ONNX_BATCH_SIZE, root: str = ONNX_MODEL_DIR) -> List[Dict[str, Any]]:
+    """
+    Cosine similarity of the fp32 and int8 ONNX embeddings to the torch (sentence-transformers) ones,
+    and the texts/s of each, single process on this CPU.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    texts = texts or _sample_texts(1000)
+    torch_model = SentenceTransformer(model_name, device="cpu")
+    reference = torch_model.encode(texts, batch_size=batch_size, normalize_embeddings=True)
+    rows = [{"backend": "torch", "min_cosine": 1.0, "mean_cosine": 1.0,
+             "texts_per_s": _throughput(torch_model, texts, batch_size)}]
+    export_onnx(model_name, root, quantize=True)
+    for quantize in (False, True):
+        embedder = OnnxEmbedder(model_name, root, quantize=quantize, batch_size=batch_size)
+        vectors = embedder.encode(texts)
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        cosine = np.sum(vectors * reference, axis=1)
+        rows.append({"backend": "onnx-int8" if quantize else "onnx-fp32", "min_cosine": float(cosine.min()),
+                     "mean_cosine": float(cosine.mean()), "texts_per_s": _throughput(embedder, texts, batch_size)})
+    return rows
+
+
+def _sample_texts(n: int) -> List[str]:
+    # query- and memory-like sentences of varied length, like the texts RAGStorage embeds
+    rng = np.random.default_rng(0)
+    words = ("I", "visited", "the", "museum", "yesterday", "prefer", "quiet", "mornings", "and", "coffee",
+             "project", "deadline", "my", "team", "presentation", "went", "well", "learned", "python", "trip")
+    return [" ".join(rng.choice(words, rng.integers(4, 60))) for _ in range(n)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the embedding model to ONNX and compare it with torch")
+    parser.add_argument("--model", default=EMBEDDING_MODEL_NAME)
+    parser.add_argument("--root", default=ONNX_MODEL_DIR)
+    parser.add_argument("--export", action="store_true", help="only build the fp32 and int8 artifacts")
+    parser.add_argument("--texts", type=int, default=1000)
+    parser.add_argument("--batch", type=int, default=ONNX_BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.export:
+        print(export_onnx(args.model, args.root, quantize=True))
+        return
+    rows = parity_report(args.model, _sample_texts(args.texts), args.batch, args.root)
+    print(f"{args.model}, {args.texts} texts, batch={args.batch}")
+    print(f"{'backend':<10} {'min cos':>8} {'mean cos':>9} {'texts/s':>9} {'speedup':>8}")
+    for row in rows:
+        print(f"{row['backend']:<10} {row['min_cosine']:>8.4f} {row['mean_cosine']:>9.4f} "
+              f"{row['texts_per_s']:>9.1f} {row['texts_per_s'] / rows[0]['texts_per_s']:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+# partitions.py
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from .config import PARTITION_DIR, PARTITION_CACHE_MAX_BYTES, PARTITION_CACHE_MAX_COUNT
+from .storage import RAGStorage, _chroma_settings
+
+logger = logging.getLogger("partitions")
+
+
+class PartitionedStorage:
+    """
+    Per-user partitions over RAGStorage: a user's documents live in their own partition, so a query scans
+    that user's history (plus the shared partition holding seed data) and never another user's.
+     - FAISS: each partition has its own index and metadata files under `root`/<partition key>/
+     - Chroma: each partition is a collection of the shared client
+    Partitions load lazily on first use and stay resident in an LRU bounded by `max_bytes`
+    (RAGStorage.memory_estimate) and `max_resident`. Evicted FAISS partitions are persisted and closed;
+    evicting a Chroma partition only drops its collection handle, and the client's own segment cache
+    (see storage._chroma_settings) decides what stays loaded.
+    A partition is pinned while a call uses it, so eviction never closes one under a running call
+    (the cache may briefly exceed its bounds instead).
+    In-memory runs keep user partitions in a temporary directory instead of `root` (for Chroma, a persistent
+    client there rather than the shared in-memory one), so they spill to disk instead of staying in RAM;
+    close() removes it.
+    user_id=None addresses the shared partition.
+    """
+
+    def __init__(self, shared: RAGStorage, root: str = PARTITION_DIR, max_bytes: int = PARTITION_CACHE_MAX_BYTES,
+                 max_resident: int = PARTITION_CACHE_MAX_COUNT):
+        self.shared = shared
+        self._spill_dir = None
+        self._chroma_client = getattr(shared, "client", None)
+        if shared.use_memory_run:
+            self._spill_dir = root = tempfile.mkdtemp(prefix="rag_partitions_")
+            if shared.vector_db_type == "chroma":
+                import chromadb
+                self._chroma_client = chromadb.PersistentClient(
+                    path=os.path.join(root, "chroma"), settings=_chroma_settings(chromadb.config.Settings, max_bytes))
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_resident = max_resident
+        self._resident: "OrderedDict[str, RAGStorage]" = OrderedDict()
+        self._pins: Dict[str, int] = {}
+        # per-partition [lock, holders + waiters]: a partition is never opened while it is still being loaded or
+        # closed elsewhere; an entry is dropped once nobody holds or waits for it
+        self._key_locks: Dict[str, list] = {}
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "loads": 0, "evictions": 0}
+
+    @staticmethod
+    def partition_key(user_id: str) -> str:
+        """File-system and Chroma-safe name of a user's partition."""
+        return "user_" + hashlib.blake2b(str(user_id).encode("utf-8"), digest_size=8).hexdigest()
+
+    # --- residency ---
+    def _open(self, key: str) -> RAGStorage:
+        shared = self.shared
+        kwargs = dict(dim=shared.dim, vector_db_type=shared.vector_db_type, embedding_backend=shared.embedding_backend,
+                      embedding_model=shared.embedding_model)
+        if shared.vector_db_type == "chroma":
+            return RAGStorage(**kwargs, USE_MEMORY_RUN=shared.use_memory_run, chroma_client=self._chroma_client,
+                              collection_name=key)
+        directory = os.path.join(self.root, key)
+        os.makedirs(directory, exist_ok=True)
+        return RAGStorage(**kwargs, index_path=os.path.join(directory, "faiss.index"),
+                          metadata_path=os.path.join(directory, "meta.db"))
+
+    def _enter_key(self, key: str) -> list:
+        """Register as a holder or waiter of `key`'s lock entry. Caller holds self._lock."""
+        entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+        return entry
+
+    def _exit_key(self, key: str, entry: list):
+        with self._lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._key_locks[key]
+
+    def _pin(self, key: str) -> Optional[RAGStorage]:
+        """Caller holds self._lock."""
+        storage = self._resident.get(key)
+        if storage is not None:
+            self._resident.move_to_end(key)
+            self._pins[key] = self._pins.get(key, 0) + 1
+        return storage
+
+    def _acquire(self, key: str) -> RAGStorage:
+        with self._lock:
+            storage = self._pin(key)
+            if storage is not None:
+                self._counters["hits"] += 1
+                return storage
+            entry = self._enter_key(key)
+        try:
+            with entry[0]:
+                with self._lock:
+                    storage = self._pin(key)  # loaded by another caller meanwhile
+                    if storage is not None:
+                        self._counters["hits"] += 1
+                        return storage
+                # opening can re-embed an unsaved tail; keep other partitions usable meanwhile
+                storage = self._open(key)
+                with self._lock:
+                    self._resident[key] = storage
+                    self._pins[key] = 1
+                    self._counters["loads"] += 1
+        finally:
+            self._exit_key(key, entry)
+        self._evict()
+        return storage
+
+    def _release(self, key: str):
+        with self._lock:
+            self._pins[key] -= 1
+            if not self._pins[key]:
+                del self._pins[key]
+        self._evict()  # writes grow partitions
+
+    def _evict(self):
+        victims = []
+        with self._lock:
+            total = sum(storage.memory_estimate() for storage in self._resident.values())
+            for key in list(self._resident):  # least recently used first
+                if total <= self.max_bytes and len(self._resident) <= self.max_resident:
+                    break
+                if self._pins.get(key):
+                    continue
+                # take the partition's lock before it leaves the cache, so nobody reopens its files mid-close;
+                # it is only busy while a concurrent _acquire re-checks residency, which will pin it
+                entry = self._enter_key(key)
+                if not entry[0].acquire(blocking=False):
+                    entry[1] -= 1
+                    continue
+                storage = self._resident.pop(key)
+                total -= storage.memory_estimate()
+                victims.append((key, storage, entry))
+                self._counters["evictions"] += 1
+        for key, storage, entry in victims:
+            try:
+                storage.close()
+            finally:
+                entry[0].release()
+                self._exit_key(key, entry)
+            logger.debug("Evicted partition %s", key)
+
+    @contextmanager
+    def partition(self, user_id: Optional[str]) -> Iterator[RAGStorage]:
+        """The (pinned) storage of `user_id`; the shared partition for None."""
+        if user_id is None:
+            yield self.shared
+            return
+        key = self.partition_key(user_id)
+        storage = self._acquire(key)
+        try:
+            yield storage
+        finally:
+            self._release(key)
+
+    # --- RAGStorage API, routed by user_id ---
+    def search_similar(self, query: str, category: Optional[str] = None, top_k: int = 5,
+                       user_id: Optional[str] = None, include_shared: bool = True, **filters) -> List[Dict[str, Any]]:
+        """
+        RAGStorage.search_similar over the user's partition, merged with the shared partition when
+        `include_shared` (the query is encoded once). `filters`: nprobe, ef_search, where, saved_after, saved_before.
+        """
+        return self.search_similar_many([query], [category], top_k, user_id, include_shared, **filters)[0]
+
+    def search_similar_many(self, queries: List[str], categories: Optional[List[Optional[str]]] = None,
+                            top_k: int = 5, user_id: Optional[str] = None, include_shared: bool = True,
+                            **filters) -> List[List[Dict[str, Any]]]:
+        """RAGStorage.search_similar_many routed like search_similar: one encode pass, one index call per partition."""
+        if user_id is None:
+            return self.shared.search_similar_many(queries, categories, top_k, **filters)
+        categories = list(categories) if categories is not None else [None] * len(queries)
+        if not queries:
+            return []
+        q_embs = self.shared.embedding_model.encode(list(queries), show_progress_bar=False)
+        with self.partition(user_id) as storage:
+            results = storage.search_many_by_embedding(q_embs, categories, top_k, **filters)
+        if include_shared:
+            shared = self.shared.search_many_by_embedding(q_embs, categories, top_k, **filters)
+            # FAISS scores are similarities, Chroma's are distances
+            descending = self.shared.vector_db_type == "faiss"
+            results = [sorted(own + common, key=lambda doc: doc["score"], reverse=descending)
+                       for own, common in zip(results, shared)]
+        return [docs[:top_k] for docs in results]
+
+    @staticmethod
+    def _owned(metadata: Optional[Dict[str, Any]], user_id: Optional[str]) -> Dict[str, Any]:
+        metadata = dict(metadata or {})
+        if user_id is not None:
+            metadata["user_id"] = user_id
+        return metadata
+
+    def save_personality_data(self, text: str, metadata: Dict[str, Any], user_id: Optional[str] = None):
+        with self.partition(user_id) as storage:
+            storage.save_personality_data(text, self._owned(metadata, user_id))
+
+    def save_experience_data(self, text: str, metadata: Dict[str, Any], user_id: Optional[str] = None):
+        with self.partition(user_id) as storage:
+            storage.save_experience_data(text, self._owned(metadata, user_id))
+
+    def save_batch(self, texts: List[str], metadatas: Optional[List[Dict[str, Any]]] = None,
+                   category: str = "experience", user_id: Optional[str] = None, **kwargs) -> List[str]:
+        metadatas = [self._owned(meta, user_id) for meta in (metadatas or [{} for _ in texts])]
+        with self.partition(user_id) as storage:
+            return storage.save_batch(texts, metadatas, category=category, **kwargs)
+
+    def upsert(self, ids: List[str], texts: List[str], metadatas: Optional[List[Dict[str, Any]]] = None,
+               user_id: Optional[str] = None) -> List[str]:
+        metadatas = [self._owned(meta, user_id) for meta in (metadatas or [{} for _ in texts])]
+        with self.partition(user_id) as storage:
+            return storage.upsert(ids, texts, metadatas)
+
+    def delete(self, ids: List[str], user_id: Optional[str] = None) -> int:
+        with self.partition(user_id) as storage:
+            return storage.delete(ids)
+
+    # --- lifecycle ---
+    def persist(self):
+        """Persist the shared partition and every resident one."""
+        self.shared.persist()
+        with self._lock:
+            resident = list(self._resident.values())
+        for storage in resident:
+            storage.persist()
+
+    def close(self):
+        """
+        Persist and close resident user partitions (the shared one stays open) and persist the shared one.
+        An in-memory run's spilled partitions are deleted.
+        """
+        with self._lock:
+            resident = [(key, storage, self._enter_key(key)) for key, storage in self._resident.items()]
+            self._resident.clear()
+        for key, storage, entry in resident:
+            try:
+                with entry[0]:
+                    storage.close()
+            finally:
+                self._exit_key(key, entry)
+        self.shared.persist()
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(
+                self._counters,
+                resident=len(self._resident),
+                pinned=len(self._pins),
+                memory_estimate_bytes=sum(storage.memory_estimate() for storage in self._resident.values()),
+                max_bytes=self.max_bytes,
+                max_resident=self.max_resident,
+            )
@@ -0,0 +1,390 @@
+# rag_service.py
+"""
+RAG service mode: one local process owns the embedding model and the vector store (a PartitionedStorage),
+and every API worker talks to it over a Unix domain socket through RAGServiceClient. N uvicorn workers
+then share one model copy and see the same data, also with in-memory storage.
+
+Protocol: each message is one frame
+    !I  length of everything after this field
+    !B  opcode (request) or status (response)
+    !I  length of the JSON header
+    header (UTF-8 JSON), then an optional raw float32 matrix whose shape is header["shape"]
+Embeddings travel as raw float32, never as JSON numbers. A connection carries any number of
+request/response pairs, one at a time.
+
+    python -m lm_studio_rag.rag_service --socket ./rag_service.sock [--memory] [--seed sample_test_data.json]
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import struct
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .config import (
+    RAG_SERVICE_SOCKET, RAG_SERVICE_MAX_FRAME_BYTES, RAG_SERVICE_POOL_SIZE, EMBEDDING_CACHE_ENABLED,
+    EMBEDDING_CACHE_PATH, STORAGE_BATCH_SIZE,
+)
+
+logger = logging.getLogger("rag_service")
+
+OP_EMBED = 1    # {"texts"} -> float32 matrix
+OP_SEARCH = 2   # {"queries", "categories", "top_k", "user_id", "include_shared", "filters"} -> {"results"}
+OP_INGEST = 3   # {"method", "kwargs"} -> {"result"}; method in INGEST_METHODS
+OP_ADMIN = 4    # {"action": "info" | "stats" | "persist"}
+STATUS_OK = 0
+STATUS_ERROR = 255
+
+INGEST_METHODS = ("save_personality_data", "save_experience_data", "save_batch", "upsert", "delete")
+
+_PREFIX = struct.Struct("!IBI")
+_LENGTH = struct.Struct("!I")
+
+
+class RAGServiceError(RuntimeError):
+    """An operation failed inside the RAG service (the message carries the remote exception)."""
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()  # time bounds: metadata_index.to_timestamp parses ISO strings
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def encode_frame(code: int, header: Dict[str, Any], matrix: Optional[np.ndarray] = None) -> bytes:
+    if matrix is not None:
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        header = dict(header, shape=list(matrix.shape))
+    head = json.dumps(header, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+    body = matrix.tobytes() if matrix is not None else b""
+    return _PREFIX.pack(1 + 4 + len(head) + len(body), code, len(head)) + head + body
+
+
+def _recv_exactly(sock: socket.socket, n: int) -> Optional[bytes]:
+    chunks, remaining = [], n
+    while remaining:
+        chunk = sock.recv(min(remaining, 1 << 20))
+        if not chunk:
+            if remaining == n:
+                return None  # clean close between frames
+            raise ConnectionError("connection closed mid-frame")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_frame(sock: socket.socket, max_bytes: int = RAG_SERVICE_MAX_FRAME_BYTES
+               ) -> Optional[Tuple[int, Dict[str, Any], Optional[np.ndarray]]]:
+    """(code, header, matrix or None) of the next frame; None when the peer closed the connection."""
+    raw = _recv_exactly(sock, _LENGTH.size)
+    if raw is None:
+        return None
+    (length,) = _LENGTH.unpack(raw)
+    if length > max_bytes:
+        raise ConnectionError(f"frame of {length} bytes exceeds RAG_SERVICE_MAX_FRAME_BYTES")
+    payload = _recv_exactly(sock, length)
+    if payload is None:
+        raise ConnectionError("connection closed mid-frame")
+    code, head_len = payload[0], _LENGTH.unpack_from(payload, 1)[0]
+    header = json.loads(payload[5:5 + head_len])
+    matrix = None
+    if "shape" in header:
+        matrix = np.frombuffer(payload[5 + head_len:], dtype=np.float32).reshape(header.pop("shape"))
+    return code, header, matrix
+
+
+# --- server ---
+class _Handler(socketserver.BaseRequestHandler):
+    def setup(self):
+        with self.server.lock:
+            self.server.connections.add(self.request)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self.request)
+
+    def handle(self):
+        service: "RAGService" = self.server.service
+        while True:
+            try:
+                frame = read_frame(self.request)
+            except (ConnectionError, OSError, ValueError) as e:
+                logger.warning("Dropping RAG service connection: %s", e)
+                return
+            if frame is None:
+                return
+            code, header, _ = frame
+            try:
+                response = service.dispatch(code, header)
+            except Exception as e:
+                logger.exception("RAG service op %s failed", code)
+                response = encode_frame(STATUS_ERROR, {"type": type(e).__name__, "message": str(e)})
+            self.request.sendall(response)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, service: "RAGService"):
+        super().__init__(path, _Handler)
+        self.service = service
+        self.lock = threading.Lock()
+        self.connections = set()
+
+
+class RAGService:
+    """
+    Serves a PartitionedStorage (user partitions plus the shared one) over a Unix socket, one thread per
+    connection. Concurrent searches from different workers meet in the storage's embedding micro-batcher,
+    so they are encoded together.
+    """
+
+    def __init__(self, storage, path: str = RAG_SERVICE_SOCKET):
+        self.storage = storage
+        self.path = path
+        self._server: Optional[_Server] = None
+
+    def dispatch(self, code: int, header: Dict[str, Any]) -> bytes:
+        storage = self.storage
+        if code == OP_EMBED:
+            vectors = storage.shared.embedding_model.encode(header["texts"], show_progress_bar=False)
+            return encode_frame(STATUS_OK, {}, np.asarray(vectors))
+        if code == OP_SEARCH:
+            results = storage.search_similar_many(
+                header["queries"], header.get("categories"), header.get("top_k", 5), header.get("user_id"),
+                header.get("include_shared", True), **header.get("filters", {}))
+            return encode_frame(STATUS_OK, {"results": results})
+        if code == OP_INGEST:
+            if header["method"] not in INGEST_METHODS:
+                raise ValueError(f"unknown ingest method {header['method']!r}")
+            result = getattr(storage, header["method"])(**header["kwargs"])
+            return encode_frame(STATUS_OK, {"result": result})
+        if code == OP_ADMIN:
+            action = header["action"]
+            if action == "info":
+                shared = storage.shared
+                return encode_frame(STATUS_OK, {"dim": shared.dim, "vector_db_type": shared.vector_db_type})
+            if action == "stats":
+                return encode_frame(STATUS_OK, {"partitions": storage.stats(),
+                                                "embedding_batch": storage.shared.embedding_batch_stats()})
+            if action == "persist":
+                storage.persist()
+                return encode_frame(STATUS_OK, {})
+            raise ValueError(f"unknown admin action {action!r}")
+        raise ValueError(f"unknown opcode {code}")
+
+    def start(self):
+        """Bind the socket (replacing a stale one) and serve on a background thread."""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = _Server(self.path, self)
+        os.chmod(self.path, 0o660)  # the API workers run as the same user or group
+        threading.Thread(target=self._server.serve_forever, name="rag-service", daemon=True).start()
+        logger.info("RAG service listening on %s", self.path)
+
+    def stop(self):
+        """Stop accepting, and close open connections (a request being served still gets its response)."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            with self._server.lock:
+                for conn in self._server.connections:
+                    conn.shutdown(socket.SHUT_RD)
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+# --- client ---
+class ServiceEmbedder:
+    """SentenceTransformer-compatible embedder (encode, get_sentence_embedding_dimension) backed by the service."""
+
+    def __init__(self, client: "RAGServiceClient"):
+        self.client = client
+
+    def encode(self, texts: List[str], show_progress_bar: bool = False, **kwargs) -> np.ndarray:
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        _, matrix = self.client.call(OP_EMBED, {"texts": texts})
+        return matrix
+
+    def get_sentence_embedding_dimension(self) -> Optional[int]:
+        return self.client.info()["dim"]
+
+
+class RAGServiceClient:
+    """
+    Thin client for a RAGService, with the RAGStorage / PartitionedStorage API the API workers use
+    (search_similar[_many] with user_id routing, save_*, upsert, delete). It holds no model or index.
+    `embedding_model` exposes the service's embedder, e.g. for ContentClassifier.
+    Thread-safe: each call borrows a connection from a small pool (up to `pool_size` kept idle).
+    Reads that fail on a pooled connection are retried once on a fresh one (e.g. after a service restart);
+    writes are not, since the service may have applied them.
+    """
+
+    def __init__(self, path: str = RAG_SERVICE_SOCKET, pool_size: int = RAG_SERVICE_POOL_SIZE,
+                 timeout: Optional[float] = 60.0):
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._idle: List[socket.socket] = []
+        self._lock = threading.Lock()
+        self._info: Optional[Dict[str, Any]] = None
+        self.embedding_model = ServiceEmbedder(self)
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        return sock
+
+    def _roundtrip(self, sock: socket.socket, frame: bytes):
+        sock.sendall(frame)
+        response = read_frame(sock)
+        if response is None:
+            raise ConnectionError("RAG service closed the connection")
+        return response
+
+    def call(self, code: int, header: Dict[str, Any], retry: bool = True) -> Tuple[Dict[str, Any], Optional[np.ndarray]]:
+        frame = encode_frame(code, header)
+        with self._lock:
+            sock = self._idle.pop() if self._idle else None
+        reused = sock is not None
+        try:
+            if sock is None:
+                sock = self._connect()
+            try:
+                status, body, matrix = self._roundtrip(sock, frame)
+            except (ConnectionError, OSError):
+                # a pooled connection goes stale when the service restarts
+                if not (reused and retry):
+                    raise
+                sock.close()
+                sock = self._connect()
+                status, body, matrix = self._roundtrip(sock, frame)
+        except BaseException:
+            if sock is not None:
+                sock.close()
+            raise
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(sock)
+                sock = None
+        if sock is not None:
+            sock.close()
+        if status == STATUS_ERROR:
+            if body.get("type") == "ValueError":
+                raise ValueError(body["message"])
+            raise RAGServiceError(f"{body.get('type')}: {body.get('message')}")
+        return body, matrix
+
+    # --- storage API ---
+    def info(self) -> Dict[str, Any]:
+        if self._info is None:
+            self._info = self.call(OP_ADMIN, {"action": "info"})[0]
+        return self._info
+
+    def search_similar(self, query: str, category: Optional[str] = None, top_k: int = 5,
+                       user_id: Optional[str] = None, include_shared: bool = True, **filters) -> List[Dict[str, Any]]:
+        return self.search_similar_many([query], [category], top_k, user_id, include_shared, **filters)[0]
+
+    def search_similar_many(self, queries: List[str], categories: Optional[List[Optional[str]]] = None,
+                            top_k: int = 5, user_id: Optional[str] = None, include_shared: bool = True,
+                            **filters) -> List[List[Dict[str, Any]]]:
+        if not queries:
+            return []
+        body, _ = self.call(OP_SEARCH, {"queries": list(queries), "categories": categories, "top_k": top_k,
+                                        "user_id": user_id, "include_shared": include_shared, "filters": filters})
+        return body["results"]
+
+    def _ingest(self, method: str, **kwargs):
+        return self.call(OP_INGEST, {"method": method, "kwargs": kwargs}, retry=False)[0]["result"]
+
+    def save_personality_data(self, text: str, metadata: Dict[str, Any], user_id: Optional[str] = None):
+        self._ingest("save_personality_data", text=text, metadata=metadata, user_id=user_id)
+
+    def save_experience_data(self, text: str, metadata: Dict[str, Any], user_id: Optional[str] = None):
+        self._ingest("save_experience_data", text=text, metadata=metadata, user_id=user_id)
+
+    def save_batch(self, texts: List[str], metadatas: Optional[List[Dict[str, Any]]] = None,
+                   category: str = "experience", user_id: Optional[str] = None, batch_size: int = STORAGE_BATCH_SIZE,
+                   progress: Optional[Callable[[int, int], None]] = None) -> List[str]:
+        """RAGStorage.save_batch, sent in `batch_size` chunks so `progress` still reports per chunk."""
+        metadatas = metadatas or [{} for _ in texts]
+        ids: List[str] = []
+        for start in range(0, len(texts), batch_size):
+            ids += self._ingest("save_batch", texts=texts[start:start + batch_size],
+                                metadatas=metadatas[start:start + batch_size], category=category,
+                                user_id=user_id, batch_size=batch_size)
+            if progress is not None:
+                progress(min(start + batch_size, len(texts)), len(texts))
+        return ids
+
+    def upsert(self, ids: List[str], texts: List[str], metadatas: Optional[List[Dict[str, Any]]] = None,
+               user_id: Optional[str] = None) -> List[str]:
+        return self._ingest("upsert", ids=ids, texts=texts, metadatas=metadatas, user_id=user_id)
+
+    def delete(self, ids: List[str], user_id: Optional[str] = None) -> int:
+        return self._ingest("delete", ids=ids, user_id=user_id)
+
+    # --- lifecycle ---
+    def persist(self):
+        self.call(OP_ADMIN, {"action": "persist"})
+
+    def stats(self) -> Dict[str, Any]:
+        return self.call(OP_ADMIN, {"action": "stats"})[0]
+
+    def embedding_batch_stats(self) -> Optional[Dict[str, Any]]:
+        return self.stats()["embedding_batch"]
+
+    def close(self):
+        """Close pooled connections; the service keeps running (it persists on its own shutdown)."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sock in idle:
+            sock.close()
+
+
+def main():
+    from .embedding_cache import EmbeddingCache
+    from .partitions import PartitionedStorage
+    from .storage import RAGStorage
+
+    parser = argparse.ArgumentParser(description="Serve RAGStorage to the API workers over a Unix socket")
+    parser.add_argument("--socket", default=RAG_SERVICE_SOCKET or "./rag_service.sock")
+    parser.add_argument("--memory", action="store_true", help="in-memory storage (USE_MEMORY_RUN)")
+    parser.add_argument("--seed", help="JSON file with sample_experience_data to load into the shared partition")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    cache = EmbeddingCache(path=EMBEDDING_CACHE_PATH or None) if EMBEDDING_CACHE_ENABLED else None
+    storage = PartitionedStorage(RAGStorage(USE_MEMORY_RUN=args.memory, embedding_cache=cache))
+    service = RAGService(storage, args.socket)
+    service.start()
+    if args.seed:
+        with open(args.seed, encoding="utf-8") as f:
+            texts = json.load(f)["sample_experience_data"]
+        storage.save_batch(texts, [{"source": "initial"} for _ in texts], category="experience")
+        logger.info("Seeded %d experiences from %s", len(texts), args.seed)
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    signal.signal(signal.SIGINT, lambda *_: stopped.set())
+    stopped.wait()
+    service.stop()
+    storage.close()
+    logger.info("RAG service stopped: %s", storage.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# resilience.py
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from .config import LLM_RETRY_BUDGET_RATIO, LLM_RETRY_BUDGET_MIN_PER_SECOND
+
+_LATENCY_SAMPLES = 500
+_LATENCY_MIN_SAMPLES = 20
+
+
+class RetryBudget:
+    """
+    Token bucket that caps retries (and hedged duplicates) to a fraction of normal traffic,
+    so a struggling backend does not get hit by a retry storm.
+     - every original request deposits `ratio` tokens (up to `max_tokens`)
+     - `min_per_second` tokens trickle in regardless, so retries stay possible at low traffic
+     - every retry / hedge spends one token; with none left, the error is raised as is
+    """
+
+    def __init__(self, ratio: float = LLM_RETRY_BUDGET_RATIO, min_per_second: float = LLM_RETRY_BUDGET_MIN_PER_SECOND,
+                 max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._counters = {"requests": 0, "spent": 0, "denied": 0}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._refilled_at) * self.min_per_second)
+        self._refilled_at = now
+
+    def record_request(self):
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+            self._counters["requests"] += 1
+
+    def try_spend(self) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                self._counters["spent"] += 1
+                return True
+            self._counters["denied"] += 1
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._refill()
+            return dict(self._counters, tokens=round(self._tokens, 2))
+
+
+class LatencyTracker:
+    """Sliding window of recent call latencies (seconds); quantile() is None until enough samples exist."""
+
+    def __init__(self, window: int = _LATENCY_SAMPLES, min_samples: int = _LATENCY_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[int(q * (len(ordered) - 1))]
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Full-jitter exponential backoff for the given 1-based attempt (same curve as tenacity's wait_random_exponential)."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+# one budget for the whole process, shared by every client unless one is passed explicitly
+_global_retry_budget = RetryBudget()
+
+
+def get_retry_budget() -> RetryBudget:
+    return _global_retry_budget
@@ -0,0 +1,113 @@
+# routing.py
+import dataclasses
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Mapping, Optional, Tuple, Union
+
+from .config import LM_STUDIO_MODEL, LLM_STAGE_PROFILES
+
+# Pipeline stages that pick their generation settings from the routing table
+STAGE_RAG_QUERY = "rag_query"
+STAGE_EMOTION_ESTIMATION = "emotion_estimation"
+STAGE_THINK_ESTIMATION = "think_estimation"
+STAGE_FINAL_RESPONSE = "final_response"
+STAGE_DECISION_INFERENCE = "decision_inference"
+STAGE_STRUCTURED_RESPONSE = "structured_response"
+STAGE_CLASSIFICATION = "classification"
+# calls made without a stage are counted here
+STAGE_UNROUTED = "unrouted"
+
+
+@dataclass(frozen=True)
+class StageProfile:
+    """Generation settings of one stage."""
+    model: str = LM_STUDIO_MODEL
+    max_tokens: int = 512
+    temperature: float = 0.2
+    stop: Tuple[str, ...] = ()
+
+
+# Built-in table; LLM_STAGE_PROFILES / ModelRouter(profiles=...) override individual fields per stage
+DEFAULT_STAGE_PROFILES: Dict[str, Dict[str, Any]] = {
+    STAGE_CLASSIFICATION: {"max_tokens": 200, "temperature": 0.0},
+}
+
+
+class ModelRouter:
+    """
+    Maps pipeline stages to a model and its generation settings (max_tokens, temperature, stop sequences),
+    so cheap stages (query rewrite, classification) can run on a small model with short caps while the
+    final response keeps the larger one.
+    `profiles` is {stage: {field: value}}; fields not given fall back to the built-in table, then to `default`.
+    Also accumulates per-stage token usage so the caps can be tuned: prompt/completion tokens from the
+    server's `usage` block, and for streams the number of content deltas (about one token each).
+    `truncated` counts completions that stopped at max_tokens.
+    """
+
+    def __init__(self, profiles: Optional[Mapping[str, Union[StageProfile, Mapping[str, Any]]]] = LLM_STAGE_PROFILES,
+                 default: Optional[StageProfile] = None):
+        self.default = default if default is not None else StageProfile()
+        self._profiles: Dict[str, StageProfile] = {}
+        for stage, overrides in DEFAULT_STAGE_PROFILES.items():
+            self._profiles[stage] = dataclasses.replace(self.default, **overrides)
+        for stage, profile in (profiles or {}).items():
+            if isinstance(profile, StageProfile):
+                self._profiles[stage] = profile
+            else:
+                overrides = dict(profile)
+                if "stop" in overrides:
+                    overrides["stop"] = tuple(overrides["stop"] or ())
+                self._profiles[stage] = dataclasses.replace(self._profiles.get(stage, self.default), **overrides)
+        self._lock = threading.Lock()
+        self._usage: Dict[str, Dict[str, Any]] = {}
+
+    def profile(self, stage: Optional[str]) -> StageProfile:
+        return self._profiles.get(stage, self.default) if stage is not None else self.default
+
+    def profiles(self) -> Dict[str, StageProfile]:
+        return dict(self._profiles)
+
+    # --- usage ---
+    def _entry(self, stage: Optional[str], model: str) -> Dict[str, Any]:
+        entry = self._usage.get(stage or STAGE_UNROUTED)
+        if entry is None:
+            entry = self._usage[stage or STAGE_UNROUTED] = {
+                "calls": 0, "cached": 0, "truncated": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "max_completion_tokens": 0, "models": {},
+            }
+        entry["calls"] += 1
+        entry["models"][model] = entry["models"].get(model, 0) + 1
+        return entry
+
+    def record_completion(self, stage: Optional[str], payload: dict, resp: Dict[str, Any], cached: bool = False):
+        usage = resp.get("usage") or {}
+        choices = resp.get("choices") or [{}]
+        completion_tokens = int(usage.get("completion_tokens") or 0)
+        with self._lock:
+            entry = self._entry(stage, payload.get("model"))
+            entry["cached"] += int(cached)
+            if cached:
+                return
+            entry["prompt_tokens"] += int(usage.get("prompt_tokens") or 0)
+            entry["completion_tokens"] += completion_tokens
+            entry["max_completion_tokens"] = max(entry["max_completion_tokens"], completion_tokens)
+            entry["truncated"] += int(choices[0].get("finish_reason") == "length")
+
+    def record_stream(self, stage: Optional[str], payload: dict, deltas: int, cached: bool = False):
+        with self._lock:
+            entry = self._entry(stage, payload.get("model"))
+            entry["cached"] += int(cached)
+            if cached:
+                return
+            entry["completion_tokens"] += deltas
+            entry["max_completion_tokens"] = max(entry["max_completion_tokens"], deltas)
+            entry["truncated"] += int(deltas >= payload.get("max_tokens", float("inf")))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            usage = {stage: dict(entry, models=dict(entry["models"])) for stage, entry in self._usage.items()}
+        return {
+            "profiles": {stage: dataclasses.asdict(p) for stage, p in self._profiles.items()},
+            "default": dataclasses.asdict(self.default),
+            "usage": usage,
+        }
@@ -0,0 +1,234 @@
+# scheduler.py
+import asyncio
+import contextlib
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from .config import LLM_MAX_IN_FLIGHT, LLM_ADAPTIVE_LIMIT
+from .adaptive_limit import AdaptiveLimit
+
+logger = logging.getLogger("scheduler")
+
+# Priority classes, highest first. Interactive = phases of a live SSE stream;
+# background = classification, extraction, knowledge-gap analysis and other work nobody is waiting on.
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BACKGROUND = "background"
+PRIORITY_CLASSES = (PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND)
+
+_WAIT_SAMPLES = 1000
+
+
+class _Waiter:
+    __slots__ = ("priority", "enqueued_at", "granted", "cancelled", "_event", "_loop", "_future")
+
+    def __init__(self, priority: str, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.cancelled = False
+        self._loop = loop
+        if loop is None:
+            self._event = threading.Event()
+            self._future = None
+        else:
+            self._event = None
+            self._future = loop.create_future()
+
+    def wake(self):
+        if self._loop is None:
+            self._event.set()
+        else:
+            self._loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self._future.done():
+            self._future.set_result(None)
+
+
+class _SlotLease:
+    """Handed out by slot()/aslot(); mark() records the first-token time of a stream for the adaptive limit."""
+    __slots__ = ("granted_at", "marked_at")
+
+    def __init__(self):
+        self.granted_at = time.monotonic()
+        self.marked_at: Optional[float] = None
+
+    def mark(self):
+        if self.marked_at is None:
+            self.marked_at = time.monotonic()
+
+    def rtt(self) -> float:
+        return (self.marked_at or time.monotonic()) - self.granted_at
+
+
+class LLMScheduler:
+    """
+    Admission control for one LLM backend.
+     - at most `max_in_flight` calls run at once
+     - waiting calls are served by priority class (PRIORITY_CLASSES order), FIFO within a class
+     - works for threads (slot) and asyncio tasks (aslot) at the same time, so the sync and
+       async clients of the same backend share one limit
+    With a `limiter` (AdaptiveLimit), max_in_flight follows the limit discovered from observed latency.
+    slot()/aslot() take `is_drop`, the caller's test for errors that signal overload (transport errors, timeouts,
+    429, 5xx); other errors, such as a 400 for a bad payload, are reported as completed samples. Without it
+    every error counts as a drop.
+    Metrics: in-flight count, queue depth per class, wait-time distribution per class.
+    """
+
+    def __init__(self, max_in_flight: int = LLM_MAX_IN_FLIGHT, name: str = "default",
+                 limiter: Optional[AdaptiveLimit] = None):
+        self.name = name
+        self.max_in_flight = limiter.limit if limiter is not None else max_in_flight
+        self.limiter = limiter
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._queue: List[tuple] = []  # heap of (class_rank, seq, waiter)
+        self._seq = itertools.count()
+        self._queued: Dict[str, int] = {p: 0 for p in PRIORITY_CLASSES}
+        self._waits: Dict[str, Deque[float]] = {p: deque(maxlen=_WAIT_SAMPLES) for p in PRIORITY_CLASSES}
+        self._served: Dict[str, int] = {p: 0 for p in PRIORITY_CLASSES}
+
+    # --- acquire / release ---
+    def _enqueue_or_grant(self, waiter: _Waiter) -> bool:
+        """Grant immediately if there is capacity and nobody is queued; otherwise queue. Caller holds the lock."""
+        if waiter.priority not in self._queued:
+            raise ValueError(f"unknown priority class: {waiter.priority}")
+        if self._in_flight < self.max_in_flight and not self._queue:
+            self._grant(waiter)
+            return True
+        heapq.heappush(self._queue, (PRIORITY_CLASSES.index(waiter.priority), next(self._seq), waiter))
+        self._queued[waiter.priority] += 1
+        return False
+
+    def _grant(self, waiter: _Waiter):
+        self._in_flight += 1
+        waiter.granted = True
+        self._waits[waiter.priority].append(time.monotonic() - waiter.enqueued_at)
+        self._served[waiter.priority] += 1
+
+    def _dispatch(self):
+        """Hand free slots to queued waiters in priority order. Caller holds the lock."""
+        while self._queue and self._in_flight < self.max_in_flight:
+            _, _, waiter = heapq.heappop(self._queue)
+            self._queued[waiter.priority] -= 1
+            if waiter.cancelled:
+                continue
+            self._grant(waiter)
+            waiter.wake()
+
+    def acquire(self, priority: str = PRIORITY_INTERACTIVE):
+        waiter = _Waiter(priority)
+        with self._lock:
+            if self._enqueue_or_grant(waiter):
+                return
+        waiter._event.wait()
+
+    async def acquire_async(self, priority: str = PRIORITY_INTERACTIVE):
+        waiter = _Waiter(priority, asyncio.get_running_loop())
+        with self._lock:
+            if self._enqueue_or_grant(waiter):
+                return
+        try:
+            await waiter._future
+        except asyncio.CancelledError:
+            with self._lock:
+                if not waiter.granted:
+                    waiter.cancelled = True
+                    waiter = None
+            if waiter is not None:
+                # the slot was handed over just as we were cancelled; give it back
+                self.release()
+            raise
+
+    def release(self, lease: Optional[_SlotLease] = None, dropped: bool = False):
+        with self._lock:
+            if lease is not None and self.limiter is not None:
+                # sample taken while the call still counts as in flight
+                self.max_in_flight = self.limiter.update(lease.rtt(), self._in_flight, dropped)
+            self._in_flight -= 1
+            self._dispatch()
+
+    def set_limit(self, max_in_flight: int):
+        with self._lock:
+            self.max_in_flight = max_in_flight
+            self._dispatch()
+
+    @contextlib.contextmanager
+    def slot(self, priority: str = PRIORITY_INTERACTIVE, is_drop: Optional[Callable[[BaseException], bool]] = None):
+        self.acquire(priority)
+        lease, dropped = _SlotLease(), False
+        try:
+            yield lease
+        except Exception as e:
+            dropped = is_drop is None or is_drop(e)
+            raise
+        finally:
+            self.release(lease, dropped)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, priority: str = PRIORITY_INTERACTIVE, is_drop: Optional[Callable[[BaseException], bool]] = None):
+        await self.acquire_async(priority)
+        lease, dropped = _SlotLease(), False
+        try:
+            yield lease
+        except Exception as e:
+            dropped = is_drop is None or is_drop(e)
+            raise
+        finally:
+            self.release(lease, dropped)
+
+    # --- metrics ---
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = {p: sorted(w) for p, w in self._waits.items()}
+            return {
+                "name": self.name,
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self._in_flight,
+                "queue_depth": dict(self._queued),
+                "served": dict(self._served),
+                "wait_ms": {p: _summarize_ms(w) for p, w in waits.items()},
+                "adaptive": self.limiter.stats() if self.limiter is not None else None,
+            }
+
+
+def _summarize_ms(sorted_waits: List[float]) -> Dict[str, float]:
+    if not sorted_waits:
+        return {"count": 0, "avg": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+    n = len(sorted_waits)
+    return {
+        "count": n,
+        "avg": sum(sorted_waits) / n * 1000,
+        "p50": sorted_waits[int(0.50 * (n - 1))] * 1000,
+        "p95": sorted_waits[int(0.95 * (n - 1))] * 1000,
+        "max": sorted_waits[-1] * 1000,
+    }
+
+
+# --- one scheduler per backend, shared by every client that talks to it ---
+_schedulers: Dict[str, LLMScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(backend: str, max_in_flight: int = LLM_MAX_IN_FLIGHT, adaptive: str = LLM_ADAPTIVE_LIMIT) -> LLMScheduler:
+    """
+    adaptive: "" / "off" keeps max_in_flight fixed; "aimd" or "gradient" starts at max_in_flight
+    and lets AdaptiveLimit move it.
+    """
+    with _schedulers_lock:
+        scheduler = _schedulers.get(backend)
+        if scheduler is None:
+            limiter = AdaptiveLimit(adaptive, initial_limit=max_in_flight) if adaptive not in ("", "off") else None
+            scheduler = _schedulers[backend] = LLMScheduler(max_in_flight=max_in_flight, name=backend, limiter=limiter)
+        return scheduler
+
+
+def all_scheduler_stats() -> Dict[str, Dict[str, Any]]:
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return {s.name: s.stats() for s in schedulers}
@@ -0,0 +1,261 @@
+# single_flight.py
+import asyncio
+import logging
+import threading
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger("single_flight")
+
+
+class _Counters:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def count(self, leader: bool):
+        with self._lock:
+            if leader:
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+    def stats(self, in_flight: int) -> Dict[str, int]:
+        with self._lock:
+            return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": in_flight}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class _ThreadBroadcast:
+    """
+    Buffered fan-out of one upstream iterator to subscriber threads. There is no pump thread: whichever
+    subscriber needs a chunk nobody has fetched yet pulls it from upstream, so a subscriber leaving early
+    does not stall the others.
+    """
+
+    def __init__(self, open_upstream: Callable[[], Iterator[str]]):
+        self._open_upstream = open_upstream
+        self.upstream: Optional[Iterator[str]] = None  # opened by the first pull, outside any lock
+        self.chunks: List[str] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._pulling = False
+        self._cond = threading.Condition()
+
+    def iterate(self) -> Iterator[str]:
+        # late subscribers replay everything buffered so far, then follow live chunks
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.chunks) and not self.finished and self._pulling:
+                    self._cond.wait()
+                if index < len(self.chunks):
+                    chunk = self.chunks[index]
+                elif self.finished:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    chunk = None
+                    self._pulling = True
+            if chunk is None:
+                self._pull()
+                continue
+            index += 1
+            yield chunk
+
+    def _pull(self):
+        chunk, finished, error = None, False, None
+        try:
+            if self.upstream is None:
+                self.upstream = self._open_upstream()
+            chunk = next(self.upstream)
+        except StopIteration:
+            finished = True
+        except BaseException as e:
+            finished, error = True, e
+        with self._cond:
+            if chunk is not None:
+                self.chunks.append(chunk)
+            if finished:
+                self.finished, self.error = True, error
+            self._pulling = False
+            self._cond.notify_all()
+
+    def abort(self):
+        """Close the upstream (last subscriber gone before the end)."""
+        with self._cond:
+            self.finished = True
+            self.error = ConnectionAbortedError("upstream stream abandoned")
+            self._cond.notify_all()
+        close = getattr(self.upstream, "close", None)
+        if close is not None:
+            close()
+
+
+class SingleFlight:
+    """
+    Thread-based single-flight for both plain calls and streamed deltas.
+     - do(key, fn): concurrent calls with the same key run fn once; every caller gets the same result
+       (or the same exception).
+     - stream(key, fn): concurrent subscribers of the same key share one upstream iterator; each receives
+       every delta from the start. The upstream is closed once every subscriber is gone.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._streams: Dict[str, _ThreadBroadcast] = {}
+        self._counters = _Counters()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        self._counters.count(leader)
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def stream(self, key: str, fn: Callable[[], Iterator[str]]) -> Iterator[str]:
+        with self._lock:
+            broadcast = self._streams.get(key)
+            leader = broadcast is None
+            if leader:
+                broadcast = self._streams[key] = _ThreadBroadcast(fn)
+            broadcast.subscribers += 1
+        self._counters.count(leader)
+        abandoned = False
+        try:
+            yield from broadcast.iterate()
+        finally:
+            with self._lock:
+                broadcast.subscribers -= 1
+                if self._streams.get(key) is broadcast and (broadcast.finished or broadcast.subscribers == 0):
+                    del self._streams[key]
+                abandoned = broadcast.subscribers == 0 and not broadcast.finished
+            if abandoned:
+                logger.info("All subscribers left stream %s; closing upstream", key[:16])
+                broadcast.abort()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            in_flight = len(self._calls) + len(self._streams)
+        return self._counters.stats(in_flight)
+
+
+class _Broadcast:
+    """Buffered fan-out of one upstream async iterator to any number of subscribers."""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.pump: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def run(self, upstream: AsyncIterator[str]):
+        try:
+            async for chunk in upstream:
+                self.chunks.append(chunk)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = ConnectionAbortedError("upstream stream cancelled")
+            raise
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.finished = True
+            self._notify()
+
+    async def iterate(self) -> AsyncIterator[str]:
+        # late subscribers replay everything buffered so far, then follow live chunks
+        index = 0
+        while True:
+            changed = self._changed
+            if index < len(self.chunks):
+                chunk = self.chunks[index]
+                index += 1
+                yield chunk
+            elif self.finished:
+                if self.error is not None:
+                    raise self.error
+                return
+            else:
+                await changed.wait()
+
+
+class AsyncSingleFlight:
+    """
+    asyncio single-flight for both plain awaitables and streamed deltas.
+     - do(key, fn): concurrent awaits of the same key share one fn() call.
+     - stream(key, fn): concurrent subscribers of the same key share one upstream async iterator;
+       each receives every delta from the start. The upstream is cancelled once every subscriber is gone.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, _Broadcast] = {}
+        self._counters = _Counters()
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        leader = task is None
+        if leader:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _t, k=key: self._calls.pop(k, None))
+        self._counters.count(leader)
+        # shield: one caller being cancelled (client disconnect) must not cancel the shared call
+        return await asyncio.shield(task)
+
+    async def stream(self, key: str, fn: Callable[[], AsyncIterator[str]]) -> AsyncIterator[str]:
+        broadcast = self._streams.get(key)
+        leader = broadcast is None
+        if leader:
+            broadcast = _Broadcast()
+            self._streams[key] = broadcast
+            broadcast.pump = asyncio.ensure_future(broadcast.run(fn()))
+            broadcast.pump.add_done_callback(lambda _t, k=key, b=broadcast: self._forget_stream(k, b))
+        self._counters.count(leader)
+        broadcast.subscribers += 1
+        try:
+            async for chunk in broadcast.iterate():
+                yield chunk
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.finished:
+                logger.info("All subscribers left stream %s; cancelling upstream", key[:16])
+                broadcast.pump.cancel()
+
+    def _forget_stream(self, key: str, broadcast: _Broadcast):
+        if self._streams.get(key) is broadcast:
+            del self._streams[key]
+
+    def stats(self) -> Dict[str, int]:
+        return self._counters.stats(len(self._calls) + len(self._streams))
@@ -1,15 +1,52 @@
 # storage.py
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Callable
 import numpy as np
 import os
+import hashlib
 import json
 import logging
-from sentence_transformers import SentenceTransformer
-from .config import VECTOR_DB_TYPE, CHROMA_PERSIST_DIR, FAISS_INDEX_PATH, METADATA_STORE_PATH, EMBEDDING_MODEL_NAME
-from .utils import save_json, load_json, now_iso
+import sqlite3
+import threading
+import time
+import uuid
+from .config import (
+    VECTOR_DB_TYPE, CHROMA_PERSIST_DIR, FAISS_INDEX_PATH, METADATA_STORE_PATH, EMBEDDING_MODEL_NAME,
+    EMBEDDING_BACKEND, DEFAULT_EMBEDDING_DIM, STORAGE_BATCH_SIZE, FAISS_PERSIST_EVERY,
+    FAISS_COMPACT_TOMBSTONE_RATIO, FAISS_INDEX_TYPE, FAISS_ANN_THRESHOLD, PARTITION_CACHE_MAX_BYTES,
+    EMBEDDING_MICROBATCH_WINDOW_MS, FAISS_VECTOR_CODEC, FAISS_PCA_DIM, FAISS_CODEC_MIN_VECTORS, FAISS_RESCORE_FACTOR,
+)
+from .ann_index import (
+    INDEX_FLAT, INDEX_IVFPQ, INDEX_KINDS, CODEC_FLOAT32, CODECS, base_index, build_index, index_codec, index_kind,
+    index_pca_dim, is_lossy, search_params, supports_remove, vector_bytes,
+)
+from .metadata_index import MetadataIndex, TimeBound, chroma_where, as_list
+from .embeddings import create_embedder
+from .embedding_cache import EmbeddingCache
+from .embedding_batcher import find_batcher
+from .utils import load_json, now_iso
 
 logger = logging.getLogger("storage")
 
+_DOC_OVERHEAD_BYTES = 1024  # id maps, metadata mirror and filter postings per FAISS document (rough)
+
+
+def _chroma_settings(settings_cls, memory_limit_bytes: int):
+    """
+    Chroma client settings that unload the segments of collections not used recently once they pass
+    `memory_limit_bytes`. Only set when the installed chromadb declares both keys, so a release without
+    them still opens; the Rust backend (chromadb >= 1.0's default) bounds its segment cache by open files instead.
+    """
+    fields = getattr(settings_cls, "__fields__", None) or getattr(settings_cls, "model_fields", {})
+    if memory_limit_bytes <= 0:
+        return settings_cls()
+    if "chroma_segment_cache_policy" not in fields or "chroma_memory_limit_bytes" not in fields:
+        logger.warning("This chromadb has no segment LRU cache; Chroma segments are not bounded by PARTITION_CACHE_MAX_BYTES")
+        return settings_cls()
+    settings = settings_cls(chroma_segment_cache_policy="LRU", chroma_memory_limit_bytes=memory_limit_bytes)
+    if getattr(settings, "chroma_api_impl", "").endswith("RustBindingsAPI"):
+        logger.info("Chroma's Rust backend ignores chroma_memory_limit_bytes and bounds its segment cache by open files")
+    return settings
+
 class RAGStorage:
     """
     Abstracted RAG storage that supports:
@@ -17,18 +54,43 @@ class RAGStorage:
      - Faiss (fallback)
     Each stored document has:
      - id, text, metadata (timestamp, label, score, source)
+    Embeddings come from an in-process SentenceTransformer (embedding_backend="local"), its ONNX Runtime
+    export (embedding_backend="onnx"), or the LLM endpoints' /v1/embeddings via `embedding_client`
+    (embedding_backend="remote").
+    With `embedding_cache`, texts already embedded (seed data, repeated queries) are not encoded again.
+    Concurrent query encodes are micro-batched for `embedding_batch_window_ms` (0 disables);
+    see embedding_batch_stats() to tune the window.
+    A storage can also be one partition of a PartitionedStorage: pass the shared `embedding_model` (and
+    `chroma_client`) plus its own `index_path` / `metadata_path` or `collection_name`.
     """
 
-    def __init__(self, embedding_model_name: str = EMBEDDING_MODEL_NAME, dim: int = None, vector_db_type: str = VECTOR_DB_TYPE, USE_MEMORY_RUN:bool = False):
+    def __init__(self, embedding_model_name: str = EMBEDDING_MODEL_NAME, dim: int = None, vector_db_type: str = VECTOR_DB_TYPE, USE_MEMORY_RUN:bool = False,
+                 embedding_backend: str = EMBEDDING_BACKEND, embedding_client=None,
+                 embedding_cache: Optional[EmbeddingCache] = None, embedding_model=None,
+                 index_path: Optional[str] = None, metadata_path: Optional[str] = None,
+                 chroma_client=None, collection_name: str = "rag_collection",
+                 embedding_batch_window_ms: float = EMBEDDING_MICROBATCH_WINDOW_MS):
         self.dim = dim
-        self.embedding_model = SentenceTransformer(embedding_model_name)
+        self.embedding_backend = embedding_backend
+        # FAISS index and metadata are not safe to read while another thread writes (e.g. background seeding)
+        self._lock = threading.RLock()
+        self.embedding_model = embedding_model or create_embedder(
+            embedding_backend, embedding_model_name if embedding_backend in ("local", "onnx") else None, embedding_client,
+            cache=embedding_cache, batch_window_ms=embedding_batch_window_ms
+        )
         self.vector_db_type = vector_db_type
+        self.use_memory_run = USE_MEMORY_RUN
+        self.index_path = None if USE_MEMORY_RUN else (index_path or FAISS_INDEX_PATH)
+        self.metadata_path = None if USE_MEMORY_RUN else (metadata_path or METADATA_STORE_PATH)
         if vector_db_type == "chroma":
             try:
                 import chromadb
-                if USE_MEMORY_RUN:                    
+                if chroma_client is not None:
+                    self.client = chroma_client
+                    self.collection = self.client.get_or_create_collection(name=collection_name)
+                elif USE_MEMORY_RUN:
                     self.client = chromadb.EphemeralClient()
-                    self.collection = self.client.get_or_create_collection(name="rag_collection")
+                    self.collection = self.client.get_or_create_collection(name=collection_name)
                     logger.info("ChromaDB initialized in-memory (ephemeral).")
                 else:
                     # データベースディレクトリが存在するかどうかで、新規作成かロードかを判断しログに出力
@@ -38,115 +100,614 @@ class RAGStorage:
                         logger.info("Loading ChromaDB from existing directory: '%s'", CHROMA_PERSIST_DIR)
 
                     # PersistentClientを使用すると、指定したパスのデータの読み込みと自動保存が行われます。
-                    self.client = chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
-                    self.collection = self.client.get_or_create_collection(name="rag_collection")
+                    self.client = chromadb.PersistentClient(
+                        path=CHROMA_PERSIST_DIR, settings=_chroma_settings(chromadb.config.Settings, PARTITION_CACHE_MAX_BYTES))
+                    self.collection = self.client.get_or_create_collection(name=collection_name)
                     logger.info("ChromaDB initialized successfully.")
             except Exception as e:
                 logger.warning("Chroma init failed: %s; falling back to faiss", e)
-                self._init_faiss(dim or 384)
+                self._init_faiss(dim or self._default_dim())
                 self.vector_db_type = "faiss"
         else:
-            self._init_faiss(dim or 384)
+            self._init_faiss(dim or self._default_dim())
+
+    def _default_dim(self) -> int:
+        # remote models have their own width; ask the endpoint once instead of assuming MiniLM's 384
+        if self.embedding_backend == "remote":
+            try:
+                return self.embedding_model.get_sentence_embedding_dimension() or DEFAULT_EMBEDDING_DIM
+            except Exception as e:
+                logger.warning("Could not probe remote embedding dimension: %s; using %d", e, DEFAULT_EMBEDDING_DIM)
+        return DEFAULT_EMBEDDING_DIM
 
     # --- FAISS simple implementation ---
+    # Vectors live in an index keyed by durable 64-bit ids (faiss_id(doc id)), written atomically to
+    # FAISS_INDEX_PATH and loaded with mmap. Documents are rows of a SQLite table at METADATA_STORE_PATH, each
+    # stamped with a write sequence number. Index writes are deferred (every FAISS_PERSIST_EVERY changes and on
+    # persist()); on load, rows written after the last persisted sequence are re-applied, so a crash loses nothing.
+    # Deletes are tombstones filtered at search time until compact() drops them from the index.
+    # The index starts flat (exact) and is rebuilt as FAISS_INDEX_TYPE ("ivfpq" / "hnsw", see ann_index.py) once
+    # the corpus reaches FAISS_ANN_THRESHOLD documents, and with compact vectors (FAISS_VECTOR_CODEC, FAISS_PCA_DIM)
+    # once it reaches FAISS_CODEC_MIN_VECTORS. Lossy indexes keep each document's normalized float32 vector in its
+    # SQLite row, to rescore search candidates exactly and to rebuild without re-embedding.
     def _init_faiss(self, dim: int):
         import faiss
+        if FAISS_INDEX_TYPE not in INDEX_KINDS:
+            raise ValueError(f"FAISS_INDEX_TYPE must be one of {INDEX_KINDS}, got {FAISS_INDEX_TYPE!r}")
+        if FAISS_VECTOR_CODEC not in CODECS:
+            raise ValueError(f"FAISS_VECTOR_CODEC must be one of {CODECS}, got {FAISS_VECTOR_CODEC!r}")
+        if FAISS_PCA_DIM and not 0 < FAISS_PCA_DIM < dim:
+            raise ValueError(f"FAISS_PCA_DIM must be between 1 and {dim - 1}, got {FAISS_PCA_DIM}")
         self.faiss = faiss
         self.dim = dim
-        self.index = faiss.IndexFlatIP(self.dim)  # inner product (need normalized vectors)
-        # metadata mapping: id -> metadata
-        self.metadata = load_json(METADATA_STORE_PATH) or {}
-        self.next_id = max([int(k) for k in self.metadata.keys()]) + 1 if self.metadata else 1
-        logger.info("Initialized FAISS index dim=%d", self.dim)
-
-    def _normalize(self, vecs: List[List[float]]) -> np.ndarray:
-        arr = np.array(vecs, dtype=np.float32)
+        self._unsaved = 0
+        # keep full-precision vectors whenever the configured layout is lossy
+        self._keep_vectors = FAISS_RESCORE_FACTOR > 0 and (
+            FAISS_VECTOR_CODEC != CODEC_FLOAT32 or bool(FAISS_PCA_DIM) or FAISS_INDEX_TYPE == INDEX_IVFPQ)
+        self._tombstones: set = set()  # faiss ids deleted from metadata but still in the index
+        self._purgeable: set = set()   # deleted rows whose vectors are gone; dropped from SQLite on the next persist
+        self._meta_index = MetadataIndex()
+        self._meta_db = self._open_metadata_db(self.metadata_path)
+        # metadata mapping: doc id -> {"text", "meta"} (in-memory mirror of the live rows), faiss id -> doc id
+        self.metadata: Dict[str, Dict[str, Any]] = {}
+        self._doc_ids: Dict[int, str] = {}
+        for fid, doc_id, text, meta in self._meta_db.execute(
+                "SELECT faiss_id, doc_id, text, meta FROM faiss_documents WHERE deleted = 0"):
+            self.metadata[doc_id] = {"text": text, "meta": json.loads(meta)}
+            self._doc_ids[fid] = doc_id
+            self._meta_index.add(fid, self.metadata[doc_id]["meta"])
+        self._seq = self._meta_db.execute("SELECT COALESCE(MAX(seq), 0) FROM faiss_documents").fetchone()[0]
+        self.index = self._load_faiss_index()
+        self._reconcile_faiss_index()
+        if self._needs_rebuild():
+            self._rebuild_faiss_index(*self._target_layout())
+        logger.info("Initialized %s FAISS index dim=%d with %d vectors", "/".join(map(str, self._layout())), self.dim,
+                    self.index.ntotal)
+
+    @staticmethod
+    def faiss_id(doc_id: str) -> int:
+        """Durable non-negative 64-bit FAISS id of a document / episode / vector id."""
+        digest = hashlib.blake2b(doc_id.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "little") & 0x7FFF_FFFF_FFFF_FFFF
+
+    def _open_metadata_db(self, path: Optional[str]) -> sqlite3.Connection:
+        conn = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS faiss_documents ("
+            " faiss_id INTEGER PRIMARY KEY, doc_id TEXT NOT NULL UNIQUE, text TEXT NOT NULL, meta TEXT NOT NULL,"
+            " deleted INTEGER NOT NULL DEFAULT 0, seq INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS faiss_state (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        if "vector" not in [column[1] for column in conn.execute("PRAGMA table_info(faiss_documents)")]:
+            # full-precision vectors for rescoring (NULL for rows written while they were not kept)
+            conn.execute("ALTER TABLE faiss_documents ADD COLUMN vector BLOB")
+        if not conn.execute("SELECT 1 FROM faiss_documents").fetchone():
+            # one-time import of the older layouts (ordinal ids): the metadata table, or the full-rewrite JSON file
+            legacy = {}
+            if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'faiss_metadata'").fetchone():
+                legacy = {str(i): {"text": t, "meta": json.loads(m)} for i, t, m in conn.execute("SELECT id, text, meta FROM faiss_metadata")}
+                # imported once: an emptied faiss_documents must not bring these back
+                conn.execute("DROP TABLE faiss_metadata")
+            elif path and os.path.exists(os.path.splitext(path)[0] + ".json"):
+                legacy_path = os.path.splitext(path)[0] + ".json"
+                legacy = load_json(legacy_path) or {}
+                os.replace(legacy_path, legacy_path + ".imported")
+            rows = [(self.faiss_id(k), k, v["text"], json.dumps(v["meta"], ensure_ascii=False), seq)
+                    for seq, (k, v) in enumerate(legacy.items(), start=1)]
+            conn.executemany("INSERT INTO faiss_documents (faiss_id, doc_id, text, meta, seq) VALUES (?, ?, ?, ?, ?)", rows)
+            if rows:
+                logger.info("Imported %d legacy metadata entries; their vectors will be re-embedded", len(rows))
+        conn.commit()
+        return conn
+
+    def _load_faiss_index(self):
+        if self.index_path and os.path.exists(self.index_path):
+            index = self.faiss.read_index(self.index_path, self.faiss.IO_FLAG_MMAP)
+            if index.d == self.dim and index_kind(index) == INDEX_IVFPQ:
+                # mmapped inverted lists are read-only; IVF indexes are loaded into memory
+                return self.faiss.read_index(self.index_path)
+            if isinstance(index, self.faiss.IndexIDMap2) and index.d == self.dim:
+                return index
+            logger.warning("FAISS index at %s is not an id-mapped dim=%d index; rebuilding from metadata", self.index_path, self.dim)
+            self._meta_db.execute("DELETE FROM faiss_state")
+        return build_index(INDEX_FLAT, self.dim)  # inner product (need normalized vectors)
+
+    def _reconcile_faiss_index(self):
+        """Re-apply rows written after the index file was last persisted (crash, lost or legacy index file)."""
+        row = self._meta_db.execute("SELECT value FROM faiss_state WHERE key = 'persisted_seq'").fetchone()
+        persisted_seq = row[0] if row else 0
+        pending = self._meta_db.execute(
+            "SELECT faiss_id, text, deleted, vector FROM faiss_documents WHERE seq > ? ORDER BY seq",
+            (persisted_seq,)).fetchall()
+        for (fid,) in self._meta_db.execute("SELECT faiss_id FROM faiss_documents WHERE deleted = 1 AND seq <= ?",
+                                          (persisted_seq,)):
+            self._tombstones.add(fid)
+        if not pending:
+            return
+        # the index may still hold an older version of these rows
+        self._drop_vectors([fid for fid, _, _, _ in pending])
+        self._purgeable.update(fid for fid, _, deleted, _ in pending if deleted)
+        stored = [(fid, vector) for fid, _, deleted, vector in pending if not deleted and vector is not None]
+        if stored:
+            self.index.add_with_ids(np.stack([np.frombuffer(vector, dtype=np.float32) for _, vector in stored]),
+                                    np.array([fid for fid, _ in stored], dtype=np.int64))
+        live = [(fid, text) for fid, text, deleted, vector in pending if not deleted and vector is None]
+        logger.info("Re-applying %d documents missing from the FAISS index (%d re-embedded)", len(stored) + len(live), len(live))
+        for start in range(0, len(live), STORAGE_BATCH_SIZE):
+            chunk = live[start:start + STORAGE_BATCH_SIZE]
+            embs = self.embedding_model.encode([text for _, text in chunk], show_progress_bar=False)
+            self.index.add_with_ids(self._normalize(embs), np.array([fid for fid, _ in chunk], dtype=np.int64))
+        self.persist()
+
+    def persist(self):
+        """Write the FAISS index to FAISS_INDEX_PATH atomically (temp file + rename). No-op for Chroma / memory runs."""
+        if self.vector_db_type != "faiss" or not self.index_path:
+            return
+        with self._lock:
+            directory = os.path.dirname(self.index_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.index_path}.tmp"
+            self.faiss.write_index(self.index, tmp_path)
+            os.replace(tmp_path, self.index_path)
+            self._meta_db.execute("INSERT OR REPLACE INTO faiss_state (key, value) VALUES ('persisted_seq', ?)", (self._seq,))
+            self._meta_db.executemany("DELETE FROM faiss_documents WHERE faiss_id = ? AND deleted = 1",
+                                      [(fid,) for fid in self._purgeable])
+            self._meta_db.commit()
+            self._purgeable.clear()
+            self._unsaved = 0
+
+    def compact(self):
+        """Drop tombstoned vectors from the FAISS index (runs automatically past FAISS_COMPACT_TOMBSTONE_RATIO)."""
+        if self.vector_db_type != "faiss":
+            return
+        with self._lock:
+            if not supports_remove(self.index) and self._dead_vectors():
+                self._rebuild_faiss_index(*self._layout())  # persists
+                return
+            if supports_remove(self.index) and self._tombstones:
+                logger.info("Compacting FAISS index: removing %d deleted vectors", len(self._tombstones))
+                self.index.remove_ids(np.array(sorted(self._tombstones), dtype=np.int64))
+                self._purgeable.update(self._tombstones)
+                self._tombstones.clear()
+            self.persist()
+
+    def close(self):
+        """Persist and release the FAISS metadata connection; the storage is unusable afterwards."""
+        if self.vector_db_type != "faiss":
+            return
+        with self._lock:
+            self.persist()
+            self._meta_db.close()
+
+    def embedding_batch_stats(self) -> Optional[Dict[str, Any]]:
+        """Wait-window and batch-size histograms of the query micro-batcher; None when batching is off."""
+        batcher = find_batcher(self.embedding_model)
+        return batcher.stats() if batcher is not None else None
+
+    def memory_estimate(self) -> int:
+        """Rough resident bytes of a FAISS storage (0 for Chroma, which manages its own segment cache)."""
+        if self.vector_db_type != "faiss":
+            return 0
+        return self.index.ntotal * (vector_bytes(self.index) + _DOC_OVERHEAD_BYTES)
+
+    def _drop_vectors(self, fids: List[int]):
+        """Remove vectors about to be replaced. HNSW cannot; its stale copies are skipped until the next rebuild."""
+        if fids and supports_remove(self.index):
+            self.index.remove_ids(np.array(fids, dtype=np.int64))
+
+    def _dead_vectors(self) -> int:
+        """Vectors in the index that no live document maps to (tombstones, stale HNSW copies)."""
+        return self.index.ntotal - len(self._doc_ids)
+
+    def _layout(self) -> tuple:
+        """(kind, codec, pca_dim) of the current index."""
+        return index_kind(self.index), index_codec(self.index), index_pca_dim(self.index)
+
+    def _target_layout(self) -> tuple:
+        """(kind, codec, pca_dim) the index should have for the live document count."""
+        live = len(self._doc_ids)
+        kind, codec, pca_dim = self._layout()
+        if kind == INDEX_IVFPQ and live < 256:
+            return kind, codec, pca_dim  # too few to retrain; an ivfpq index that shrank is still correct
+        # never demote to flat: an ANN index that shrank below the threshold is still correct
+        if live >= FAISS_ANN_THRESHOLD and not (FAISS_INDEX_TYPE == INDEX_IVFPQ and live < 256):
+            kind = FAISS_INDEX_TYPE
+        # likewise compact vectors stay compact, but follow a changed configuration
+        if live >= FAISS_CODEC_MIN_VECTORS or (codec, pca_dim) != (CODEC_FLOAT32, 0):
+            codec, pca_dim = FAISS_VECTOR_CODEC, FAISS_PCA_DIM
+        if kind == INDEX_IVFPQ:
+            codec = CODEC_FLOAT32  # product quantization is its own codec
+        return kind, codec, pca_dim
+
+    def _needs_rebuild(self) -> bool:
+        return self._target_layout() != self._layout()
+
+    def _full_vectors(self, fids: List[int]) -> Dict[int, np.ndarray]:
+        """Stored full-precision vectors of `fids` (those written while vectors were kept). Caller holds the lock."""
+        vectors = {}
+        for start in range(0, len(fids), 500):  # SQLite host parameter limit
+            chunk = fids[start:start + 500]
+            vectors.update((fid, np.frombuffer(vector, dtype=np.float32)) for fid, vector in self._meta_db.execute(
+                f"SELECT faiss_id, vector FROM faiss_documents WHERE vector IS NOT NULL"
+                f" AND faiss_id IN ({','.join('?' * len(chunk))})", chunk))
+        return vectors
+
+    def _live_vectors(self):
+        """(faiss ids, normalized vectors) of every live document, for rebuilding the index."""
+        if is_lossy(self.index):
+            # codes are lossy: use the stored full vectors, re-embed the rest (the embedding cache, when
+            # enabled, makes this a lookup)
+            fids = list(self._doc_ids)
+            stored = self._full_vectors(fids)
+            missing = [fid for fid in fids if fid not in stored]
+            texts = [self.metadata[self._doc_ids[fid]]["text"] for fid in missing]
+            for i in range(0, len(texts), STORAGE_BATCH_SIZE):
+                embs = self._normalize(self.embedding_model.encode(texts[i:i + STORAGE_BATCH_SIZE], show_progress_bar=False))
+                stored.update(zip(missing[i:i + STORAGE_BATCH_SIZE], embs))
+            vectors = np.stack([stored[fid] for fid in fids]) if fids else np.zeros((0, self.dim), dtype=np.float32)
+            return np.array(fids, dtype=np.int64), vectors
+        base = base_index(self.index)
+        vectors = base.reconstruct_n(0, base.ntotal)
+        rows = {}
+        for row, fid in enumerate(self.faiss.vector_to_array(self.index.id_map)):
+            if int(fid) in self._doc_ids:
+                rows[int(fid)] = row  # later rows win: a stale HNSW copy precedes its replacement
+        return np.array(list(rows), dtype=np.int64), vectors[list(rows.values())]
+
+    def _rebuild_faiss_index(self, kind: str, codec: str = CODEC_FLOAT32, pca_dim: int = 0):
+        """Build (and train) an index of the given layout over the live documents and swap it in. Holds the lock throughout."""
+        with self._lock:
+            start = time.perf_counter()
+            fids, vectors = self._live_vectors()
+            if len(fids) < max(pca_dim, 1) and (codec != CODEC_FLOAT32 or pca_dim or kind == INDEX_IVFPQ):
+                # too few vectors left to train on
+                kind, codec, pca_dim = INDEX_FLAT if kind == INDEX_IVFPQ else kind, CODEC_FLOAT32, 0
+            self.index = build_index(kind, self.dim, vectors, fids, codec=codec, pca_dim=pca_dim)
+            if self._keep_vectors:
+                # backfill rows written before vectors were kept, so rescoring covers every document
+                self._meta_db.executemany(
+                    "UPDATE faiss_documents SET vector = ? WHERE faiss_id = ? AND vector IS NULL",
+                    [(vector.tobytes(), int(fid)) for fid, vector in zip(fids, vectors)])
+            self._purgeable.update(self._tombstones)
+            self._tombstones.clear()
+            logger.info("Rebuilt FAISS index as %s/%s/%s over %d vectors in %.1fs", kind, codec, pca_dim, len(fids),
+                        time.perf_counter() - start)
+            self.persist()
+
+    def _after_faiss_write(self):
+        """Caller holds the lock."""
+        if self._needs_rebuild():
+            self._rebuild_faiss_index(*self._target_layout())
+        elif self._dead_vectors() and self._dead_vectors() >= FAISS_COMPACT_TOMBSTONE_RATIO * self.index.ntotal:
+            self.compact()
+        elif self._unsaved >= FAISS_PERSIST_EVERY:
+            self.persist()
+
+    def _normalize(self, vecs) -> np.ndarray:
+        """Contiguous float32 rows of unit length (one new array; the input is not modified)."""
+        arr = np.asarray(vecs, dtype=np.float32)
         # normalize for cosine similarity via inner product
         norms = np.linalg.norm(arr, axis=1, keepdims=True)
         norms[norms == 0] = 1.0
-        return arr / norms
+        return np.ascontiguousarray(arr / norms)
+
+    @staticmethod
+    def _saved_fields() -> Dict[str, Any]:
+        # saved_ts: numeric twin of saved_at, so time-range filters work in Chroma `where` clauses too
+        return {"saved_at": now_iso(), "saved_ts": int(time.time())}
+
+    @staticmethod
+    def _new_id(category: str) -> str:
+        # timestamp ids alone collide within a batch (second resolution)
+        return f"{category}_{now_iso()}_{uuid.uuid4().hex[:8]}"
 
     # --- Save helpers ---
-    def _upsert_chroma(self, texts: List[str], metadatas: List[Dict[str, Any]], ids: Optional[List[str]] = None):
+    def _upsert_chroma(self, texts: List[str], metadatas: List[Dict[str, Any]], ids: List[str],
+                       embeddings: Optional[np.ndarray] = None) -> List[str]:
         # chroma expects ids, metadatas, documents, embeddings optional
-        embs = self.embedding_model.encode(texts, show_progress_bar=False)
-        self.collection.add(documents=texts, metadatas=metadatas, ids=ids, embeddings=embs)
-        # PersistentClientを使用しているため、add操作は自動的に永続化されます。
+        embs = embeddings if embeddings is not None else self.embedding_model.encode(texts, show_progress_bar=False)
+        self.collection.upsert(documents=texts, metadatas=metadatas, ids=ids, embeddings=embs)
+        # PersistentClientを使用しているため、upsert操作は自動的に永続化されます。
+        return ids
 
-    def _upsert_faiss(self, texts: List[str], metadatas: List[Dict[str, Any]]):
-        embs = self.embedding_model.encode(texts, show_progress_bar=False)
+    def _upsert_faiss(self, texts: List[str], metadatas: List[Dict[str, Any]], ids: List[str],
+                      embeddings: Optional[np.ndarray] = None) -> List[str]:
+        embs = embeddings if embeddings is not None else self.embedding_model.encode(texts, show_progress_bar=False)
         embs_norm = self._normalize(embs)
-        self.index.add(embs_norm.astype('float32'))
-        # store metadata with generated ids incrementally (use simple integer IDs as strings)
-        for txt, meta in zip(texts, metadatas):
-            id_str = str(self.next_id)
-            self.metadata[id_str] = {"text": txt, "meta": meta}
-            self.next_id += 1
-        save_json(METADATA_STORE_PATH, self.metadata)
+        fids = [self.faiss_id(doc_id) for doc_id in ids]
+        with self._lock:
+            rows = []
+            for fid, doc_id, txt, meta, vector in zip(fids, ids, texts, metadatas, embs_norm):
+                self._seq += 1
+                rows.append((fid, doc_id, txt, json.dumps(meta, ensure_ascii=False), self._seq,
+                             vector.tobytes() if self._keep_vectors else None))
+            # metadata first: on restart, rows newer than the persisted index are re-applied
+            self._meta_db.executemany(
+                "INSERT INTO faiss_documents (faiss_id, doc_id, text, meta, seq, vector) VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(faiss_id) DO UPDATE SET doc_id = excluded.doc_id, text = excluded.text,"
+                " meta = excluded.meta, deleted = 0, seq = excluded.seq, vector = excluded.vector", rows)
+            self._meta_db.commit()
+            replaced = [fid for fid in fids if fid in self._doc_ids or fid in self._tombstones]
+            if replaced:
+                self._drop_vectors(replaced)
+                self._tombstones.difference_update(replaced)
+            self.index.add_with_ids(embs_norm, np.array(fids, dtype=np.int64))
+            for fid, doc_id, txt, meta in zip(fids, ids, texts, metadatas):
+                self.metadata[doc_id] = {"text": txt, "meta": meta}
+                self._doc_ids[fid] = doc_id
+                self._meta_index.add(fid, meta)
+            self._unsaved += len(texts)
+            self._after_faiss_write()
+        return ids
+
+    def _delete_faiss(self, ids: List[str]) -> int:
+        with self._lock:
+            fids = [self.faiss_id(doc_id) for doc_id in ids if doc_id in self.metadata]
+            rows = []
+            for fid in fids:
+                self._seq += 1
+                rows.append((self._seq, fid))
+            self._meta_db.executemany("UPDATE faiss_documents SET deleted = 1, seq = ? WHERE faiss_id = ?", rows)
+            self._meta_db.commit()
+            for fid in fids:
+                self.metadata.pop(self._doc_ids.pop(fid), None)
+                self._meta_index.remove(fid)
+                self._tombstones.add(fid)
+            self._unsaved += len(fids)
+            self._after_faiss_write()
+            return len(fids)
+
+    def upsert(self, ids: List[str], texts: List[str], metadatas: Optional[List[Dict[str, Any]]] = None) -> List[str]:
+        """
+        Insert or replace documents under caller-chosen durable ids (e.g. Episode.vector_id).
+        Metadata is stored as given (include "category" for category-filtered search).
+        """
+        if metadatas is None:
+            metadatas = [{} for _ in texts]
+        if not (len(ids) == len(texts) == len(metadatas)):
+            raise ValueError("ids, texts and metadatas must have the same length")
+        if self.vector_db_type == "chroma":
+            return self._upsert_chroma(texts, metadatas, ids=list(ids))
+        return self._upsert_faiss(texts, metadatas, list(ids))
+
+    def delete(self, ids: List[str]) -> int:
+        """Remove documents by id (e.g. when an Episode is archived or deleted). Returns how many existed (FAISS)."""
+        if self.vector_db_type == "chroma":
+            self.collection.delete(ids=list(ids))
+            return len(ids)
+        return self._delete_faiss(list(ids))
 
     def save_personality_data(self, text: str, metadata: Dict[str, Any]):
         metadata = metadata.copy()
-        metadata.update({"category": "personality", "saved_at": now_iso()})
+        metadata.update({"category": "personality", **self._saved_fields()})
         if self.vector_db_type == "chroma":
-            self._upsert_chroma([text], [metadata], ids=[f"personality_{now_iso()}"])
+            self._upsert_chroma([text], [metadata], ids=[self._new_id("personality")])
         else:
-            self._upsert_faiss([text], [metadata])
+            self._upsert_faiss([text], [metadata], [self._new_id("personality")])
 
     def save_experience_data(self, text: str, metadata: Dict[str, Any]):
         metadata = metadata.copy()
-        metadata.update({"category": "experience", "saved_at": now_iso()})
+        metadata.update({"category": "experience", **self._saved_fields()})
         if self.vector_db_type == "chroma":
-            self._upsert_chroma([text], [metadata], ids=[f"experience_{now_iso()}"])
+            self._upsert_chroma([text], [metadata], ids=[self._new_id("experience")])
         else:
-            self._upsert_faiss([text], [metadata])
+            self._upsert_faiss([text], [metadata], [self._new_id("experience")])
 
-    def search_similar(self, query: str, category: Optional[str] = None, top_k: int = 5) -> List[Dict[str, Any]]:
+    def save_batch(self, texts: List[str], metadatas: Optional[List[Dict[str, Any]]] = None, category: str = "experience",
+                   batch_size: int = STORAGE_BATCH_SIZE,
+                   progress: Optional[Callable[[int, int], None]] = None) -> List[str]:
+        """
+        Bulk variant of save_experience_data / save_personality_data.
+        Texts are sorted by length and encoded `batch_size` at a time, so each batch pads to similar lengths;
+        every batch is one encode call and one vector-store write (for FAISS, one metadata INSERT transaction).
+        progress(done, total) is called after each batch. Returns the stored ids in input order.
+        """
+        if metadatas is None:
+            metadatas = [{} for _ in texts]
+        if len(metadatas) != len(texts):
+            raise ValueError("texts and metadatas must have the same length")
+        saved = self._saved_fields()
+        metadatas = [dict(meta, category=category, **saved) for meta in metadatas]
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        ids: List[Optional[str]] = [None] * len(texts)
+        done = 0
+        for start in range(0, len(order), max(1, batch_size)):
+            batch = order[start:start + max(1, batch_size)]
+            batch_texts = [texts[i] for i in batch]
+            batch_metas = [metadatas[i] for i in batch]
+            embs = self.embedding_model.encode(batch_texts, batch_size=len(batch_texts), show_progress_bar=False)
+            batch_ids = [self._new_id(category) for _ in batch]
+            if self.vector_db_type == "chroma":
+                self._upsert_chroma(batch_texts, batch_metas, ids=batch_ids, embeddings=embs)
+            else:
+                self._upsert_faiss(batch_texts, batch_metas, batch_ids, embeddings=embs)
+            for i, id_str in zip(batch, batch_ids):
+                ids[i] = id_str
+            done += len(batch)
+            if progress is not None:
+                progress(done, len(texts))
+        self.persist()
+        return ids
+
+    def search_similar(self, query: str, category: Optional[str] = None, top_k: int = 5,
+                       nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                       where: Optional[Dict[str, Any]] = None,
+                       saved_after: TimeBound = None, saved_before: TimeBound = None) -> List[Dict[str, Any]]:
         """
         Return list of dicts: [{"id":..., "text":..., "metadata":..., "score":...}, ...]
+        where: {field: value or [values]} on METADATA_FILTER_FIELDS (category, source, user_id, sensitivity_level);
+        saved_after (inclusive) / saved_before (exclusive): ISO string, datetime or epoch seconds.
+        Filters apply before the k-NN scan (Chroma `where` clause, FAISS id selector), so top_k matches come back
+        whenever that many exist.
+        nprobe / ef_search tune recall against latency of an ivfpq / hnsw FAISS index for this call
+        (defaults FAISS_NPROBE / FAISS_EF_SEARCH; ignored by flat indexes and Chroma).
         """
         q_emb = self.embedding_model.encode([query], show_progress_bar=False)
+        return self.search_by_embedding(q_emb, category, top_k, nprobe, ef_search, where, saved_after, saved_before)
+
+    def search_by_embedding(self, q_emb, category: Optional[str] = None, top_k: int = 5,
+                            nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                            where: Optional[Dict[str, Any]] = None,
+                            saved_after: TimeBound = None, saved_before: TimeBound = None) -> List[Dict[str, Any]]:
+        """search_similar for an already encoded query (shape (1, dim)), e.g. one query over several partitions."""
+        return self.search_many_by_embedding(q_emb, [category], top_k, nprobe, ef_search, where, saved_after, saved_before)[0]
+
+    def search_similar_many(self, queries: List[str], categories: Optional[List[Optional[str]]] = None, top_k: int = 5,
+                            nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                            where: Optional[Dict[str, Any]] = None,
+                            saved_after: TimeBound = None, saved_before: TimeBound = None) -> List[List[Dict[str, Any]]]:
+        """
+        search_similar for several queries at once, one result list per query. `categories[i]` filters query i
+        (None: any category); the other filters apply to every query.
+        Distinct query texts are encoded in one batch and searched with one index call over the query matrix
+        (a filtered query whose candidates were crowded out is re-searched on its own).
+        """
+        categories = list(categories) if categories is not None else [None] * len(queries)
+        if len(categories) != len(queries):
+            raise ValueError("queries and categories must have the same length")
+        if not queries:
+            return []
+        distinct = list(dict.fromkeys(queries))
+        embs = np.asarray(self.embedding_model.encode(distinct, show_progress_bar=False))
+        rows = {text: row for row, text in enumerate(distinct)}
+        q_embs = embs[[rows[text] for text in queries]]
+        return self.search_many_by_embedding(q_embs, categories, top_k, nprobe, ef_search, where, saved_after, saved_before)
+
+    def search_many_by_embedding(self, q_embs, categories: List[Optional[str]], top_k: int = 5,
+                                 nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                                 where: Optional[Dict[str, Any]] = None,
+                                 saved_after: TimeBound = None, saved_before: TimeBound = None) -> List[List[Dict[str, Any]]]:
+        """search_similar_many for already encoded queries (shape (n, dim))."""
+        wheres = []
+        for category in categories:
+            row_where = dict(where or {})
+            if category:
+                row_where["category"] = category
+            wheres.append(row_where)
         if self.vector_db_type == "chroma":
-            # Chroma query
-            results = self.collection.query(query_embeddings=q_emb, n_results=top_k, include=["metadatas","documents","distances"])
-            docs = []
-            # `ids` は `include` に指定しなくてもデフォルトで返されるため、後続のコードは変更不要
-            for i in range(len(results["ids"])):
-                # results return lists per field
-                for j in range(len(results["ids"][i])):
-                    meta = results["metadatas"][i][j]
-                    if category and meta.get("category") != category:
-                        continue
-                    docs.append({
-                        "id": results["ids"][i][j],
-                        "text": results["documents"][i][j],
-                        "metadata": meta,
-                        "score": results["distances"][i][j]
-                    })
-            return docs[:top_k]
+            return self._search_chroma(q_embs, wheres, top_k, saved_after, saved_before)
         else:
             # FAISS search - inner product on normalized vectors works as cosine similarity
-            qn = self._normalize(q_emb).astype('float32')
-            D, I = self.index.search(qn, top_k)
-            docs = []
-            for idx, score in zip(I[0], D[0]):
-                if idx < 0:
-                    continue
-                # mapping: our stored metadata keys are 1-based incremental ints as strings; we stored in insertion order
-                # faiss IndexFlatIP doesn't retain ids; we map by insertion ordinal.
-                # Here we compute mapping index -> id_str = str(idx+1)
-                id_str = str(idx+1)
-                entry = self.metadata.get(id_str)
-                if not entry:
-                    continue
-                if category and entry["meta"].get("category") != category:
-                    continue
-                docs.append({
-                    "id": id_str,
-                    "text": entry["text"],
-                    "metadata": entry["meta"],
-                    "score": float(score)
-                })
-            return docs
+            qn = self._normalize(q_embs)
+            with self._lock:
+                return [[{
+                    "id": doc_id,
+                    "text": self.metadata[doc_id]["text"],
+                    "metadata": self.metadata[doc_id]["meta"],
+                    "score": score
+                } for doc_id, score in hits] for hits in self._search_faiss(qn, wheres, top_k, nprobe, ef_search,
+                                                                             saved_after, saved_before)]
+
+    @staticmethod
+    def _chroma_docs(results) -> List[List[Dict[str, Any]]]:
+        # `ids` は `include` に指定しなくてもデフォルトで返される
+        return [[{
+            "id": results["ids"][i][j],
+            "text": results["documents"][i][j],
+            "metadata": results["metadatas"][i][j],
+            "score": results["distances"][i][j]
+        } for j in range(len(results["ids"][i]))] for i in range(len(results["ids"]))]
+
+    def _search_chroma(self, q_embs, wheres: List[Dict[str, Any]], top_k: int,
+                       saved_after: TimeBound, saved_before: TimeBound) -> List[List[Dict[str, Any]]]:
+        # one query for every row: the rows' category filters are merged (dropped if some row has none),
+        # the other filters are shared; rows are re-filtered by category below
+        categories = [row_where.get("category") for row_where in wheres]
+        union = {field: value for field, value in wheres[0].items() if field != "category"}
+        if all(category is not None for category in categories):
+            union["category"] = sorted({c for category in categories for c in as_list(category)})
+        groups = len({str(category) for category in categories})
+        per_row = self._chroma_docs(self.collection.query(
+            query_embeddings=q_embs, n_results=top_k * groups, where=chroma_where(union, saved_after, saved_before),
+            include=["metadatas", "documents", "distances"]))
+        results = []
+        for row, (docs, category) in enumerate(zip(per_row, categories)):
+            if category is not None:
+                docs = [doc for doc in docs if doc["metadata"].get("category") in as_list(category)]
+            if len(docs) < top_k and groups > 1:
+                # crowded out by the other rows' categories: query this row with its own filter
+                docs = self._chroma_docs(self.collection.query(
+                    query_embeddings=q_embs[row:row + 1], n_results=top_k,
+                    where=chroma_where(wheres[row], saved_after, saved_before),
+                    include=["metadatas", "documents", "distances"]))[0]
+            results.append(docs[:top_k])
+        return results
+
+    def _search_faiss(self, qn: np.ndarray, wheres: List[Dict[str, Any]], top_k: int, nprobe: Optional[int],
+                      ef_search: Optional[int], saved_after: TimeBound, saved_before: TimeBound) -> List[List[tuple]]:
+        """
+        (doc id, score) of the best live matches per query row, row i filtered by wheres[i].
+        One index call over the query matrix, restricted to the union of the rows' candidates; a filtered row
+        that comes back short is searched again on its own. A lossy index fetches top_k*FAISS_RESCORE_FACTOR
+        candidates per row and ranks them by their stored full-precision vectors. Caller holds the lock.
+        """
+        rescore = FAISS_RESCORE_FACTOR if self._keep_vectors and is_lossy(self.index) else 0
+        fetch = top_k * max(rescore, 1)
+        timed = saved_after is not None or saved_before is not None
+        candidates = [self._meta_index.select(row_where, saved_after, saved_before) if row_where or timed else None
+                      for row_where in wheres]
+        union = None if any(c is None for c in candidates) else np.unique(np.concatenate(candidates))
+        groups = len({json.dumps(row_where, sort_keys=True, default=str) for row_where in wheres})
+        # over-fetch for tombstoned (or stale HNSW) vectors awaiting compaction, and for the other rows' filters
+        k = min(fetch * groups + self._dead_vectors(), self.index.ntotal)
+        if k <= 0 or (union is not None and not len(union)):
+            return [[] for _ in wheres]
+        sel = self.faiss.IDSelectorBatch(union) if union is not None else None
+        D, I = self.index.search(qn, k, params=search_params(self.index, nprobe, ef_search, sel))
+        results = []
+        for row, row_candidates in enumerate(candidates):
+            fids, scores = I[row], D[row]
+            if row_candidates is not None and groups > 1:
+                keep = np.isin(fids, row_candidates)
+                fids, scores = fids[keep], scores[keep]
+            hits = self._distinct_hits(fids, scores)
+            if row_candidates is not None and len(hits) < min(top_k, len(row_candidates)):
+                hits = self._filtered_hits(qn[row:row + 1], row_candidates, fetch, nprobe, ef_search,
+                                           searched=groups == 1)
+            results.append(self._rescore(qn[row], hits[:fetch])[:top_k] if rescore else hits[:top_k])
+        return results
+
+    def _rescore(self, q: np.ndarray, hits: List[tuple]) -> List[tuple]:
+        """Re-rank (doc id, approximate score) hits by exact inner product with their stored vectors. Caller holds the lock."""
+        fids = [self.faiss_id(doc_id) for doc_id, _ in hits]
+        vectors = self._full_vectors(fids)
+        rescored = [(doc_id, float(vectors[fid] @ q) if fid in vectors else score)
+                    for (doc_id, score), fid in zip(hits, fids)]
+        return sorted(rescored, key=lambda hit: hit[1], reverse=True)
+
+    def _filtered_hits(self, q: np.ndarray, candidates: np.ndarray, top_k: int, nprobe: Optional[int],
+                       ef_search: Optional[int], searched: bool = False) -> List[tuple]:
+        """
+        Best matches among `candidates` for one query. Graph / probed-list search can miss most of a small
+        filtered set, so a short result falls back to an exhaustive scan of the candidates.
+        `searched`: the selector search was already done (and came back short).
+        """
+        k = min(top_k + self._dead_vectors(), self.index.ntotal)
+        sel = self.faiss.IDSelectorBatch(candidates)
+        hits = []
+        if not searched:
+            D, I = self.index.search(q, k, params=search_params(self.index, nprobe, ef_search, sel))
+            hits = self._distinct_hits(I[0], D[0])
+        if len(hits) < min(top_k, len(candidates)):
+            if index_kind(self.index) == INDEX_IVFPQ:
+                D, I = self.index.search(q, k, params=search_params(self.index, base_index(self.index).nlist, None, sel))
+            else:
+                scores = self.index.reconstruct_batch(candidates) @ q[0]
+                order = np.argsort(-scores)[:k]
+                D, I = scores[order][None, :], candidates[order][None, :]
+            hits = self._distinct_hits(I[0], D[0])
+        return hits
+
+    def _distinct_hits(self, fids, scores) -> List[tuple]:
+        hits, seen = [], set()
+        for fid, score in zip(fids, scores):
+            doc_id = self._doc_ids.get(int(fid))
+            if doc_id is None or doc_id in seen:
+                continue
+            seen.add(doc_id)
+            hits.append((doc_id, float(score)))
+        return hits
 
     def persist_chroma(self):
         """
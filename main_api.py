@@ -8,10 +8,57 @@ class Settings(BaseSettings):
     # データベース
     USE_MEMORY_STORAGE: bool = True
     VECTOR_DB_PATH: str = "./chroma_db"
+    # 埋め込み: "local"（SentenceTransformer）、"onnx"（同じモデルを ONNX 化し onnxruntime で実行。
+    # ONNX_QUANTIZE_INT8 で int8 量子化、torch 不要）、または "remote"（LLMノードの /v1/embeddings）
+    EMBEDDING_BACKEND: str = "local"
+    # 一括投入（RAGStorage.save_batch）で1回にエンコード・書き込みする件数
+    STORAGE_BATCH_SIZE: int = 64
+    # 埋め込みキャッシュ（テキストのハッシュ単位。空文字でメモリのみ）。再起動後もシードデータを再エンコードしない
+    EMBEDDING_CACHE_ENABLED: bool = True
+    EMBEDDING_CACHE_PATH: str = "./embedding_cache"
+    # 同時に届いたクエリの埋め込みを待ち時間（ミリ秒）の間まとめて1回でエンコードする（0で無効）
+    EMBEDDING_MICROBATCH_WINDOW_MS: float = 2.0
+    # ユーザーごとのベクトルパーティション（FAISS はディレクトリ単位、Chroma はコレクション単位）。
+    # 常駐するパーティションは推定メモリ量と個数で上限を設け、古いものから永続化して解放する
+    PARTITION_DIR: str = "./partitions"
+    PARTITION_CACHE_MAX_BYTES: int = 1 << 30
+    PARTITION_CACHE_MAX_COUNT: int = 256
+    # RAG サービスモード: 埋め込みモデルとベクトルストアを1プロセス（python -m lm_studio_rag.rag_service）に集約し、
+    # 各ワーカーは Unix ソケット経由で利用する。空なら各ワーカーが自前で RAGStorage を構築する
+    RAG_SERVICE_SOCKET: str = ""
     
     # LM Studio
     LM_STUDIO_BASE_URL: str = "http://localhost:1234/v1"
+    # 複数ノードに分散する場合はこちらに列挙（空なら LM_STUDIO_BASE_URL のみ）
+    LM_STUDIO_BASE_URLS: list[str] = []
+    LLM_HEALTH_CHECK_INTERVAL: float = 10.0
     LM_STUDIO_MODEL: str = "gemma-3-1b-it"
+    # 段階ごとのモデル・生成長の振り分け（未指定の項目は LM_STUDIO_MODEL / max_tokens=512 / temperature=0.2）
+    # 例: {"rag_query": {"model": "qwen2.5-0.5b-instruct", "max_tokens": 64}, "classification": {"max_tokens": 64}}
+    # 段階: rag_query, emotion_estimation, think_estimation, final_response, classification など（lm_studio_rag/routing.py）
+    LLM_STAGE_PROFILES: dict[str, dict] = {}
+
+    # LLM応答キャッシュ（空文字でメモリのみ）。temperature 0 の決定的な呼び出しだけを保存し、サンプリングする呼び出しは毎回生成する
+    LLM_CACHE_ENABLED: bool = True
+    LLM_CACHE_PATH: str = "./llm_cache.db"
+
+    # LLM同時実行数の上限（超過分は優先度順に待機）
+    LLM_MAX_IN_FLIGHT: int = 4
+    # 観測レイテンシから上限を自動調整する（"off" | "aimd" | "gradient"）。LLM_MAX_IN_FLIGHT は初期値になる
+    LLM_ADAPTIVE_LIMIT: str = "off"
+
+    # 一時的な障害のリトライ回数と、p95超過時に別ノードへ複製リクエストを送るヘッジング
+    LLM_RETRY_ATTEMPTS: int = 3
+    LLM_HEDGE_ENABLED: bool = False
+
+    # LLM通信の記録/再生（"record" | "replay" | 空文字で無効）。再生時はモデル不要でパイプライン全体を計測できる
+    LLM_CASSETTE_MODE: str = ""
+    LLM_CASSETTE_PATH: str = "./llm_traffic.cassette.zst"
+    LLM_CASSETTE_TIME_SCALE: float = 1.0
+
+    # ストリーミング要求の受付制御: 同時処理数と待機数の上限（超えたら 503 + Retry-After で即時拒否）
+    STREAM_MAX_ACTIVE: int = 8
+    STREAM_MAX_QUEUE: int = 32
     
     # API
     CORS_ORIGINS: list[str] = ["http://localhost:3000"]
@@ -28,14 +75,52 @@ settings = Settings()
 # 依存関係の構築（ここで全て束ねる）
 # ========================================
 from lm_studio_rag.storage import RAGStorage
-from lm_studio_rag.lm_studio_client import LMStudioClient
+from lm_studio_rag.partitions import PartitionedStorage
+from lm_studio_rag.rag_service import RAGServiceClient, RAGServiceError
+from lm_studio_rag.lm_studio_client import LMStudioClient, AsyncLMStudioClient, aclose_all_pools
+from lm_studio_rag.llm_cache import LLMResponseCache
+from lm_studio_rag.endpoint_pool import EndpointPool
+from lm_studio_rag.cassette import Cassette
+from lm_studio_rag.admission import AdmissionController
+from lm_studio_rag.routing import ModelRouter, StageProfile
+from lm_studio_rag.embedding_cache import EmbeddingCache
 from architecture.concrete_understanding.base import ConcreteUnderstanding
 from architecture.user_response.generator import UserResponseGenerator
 
-storage = RAGStorage(USE_MEMORY_RUN=settings.USE_MEMORY_STORAGE)
-lm_client = LMStudioClient(base_url=settings.LM_STUDIO_BASE_URL)
-concrete_process = ConcreteUnderstanding(storage=storage, lm_client=lm_client)
-response_gen = UserResponseGenerator(lm_client=lm_client)
+llm_cache = LLMResponseCache(path=settings.LLM_CACHE_PATH or None) if settings.LLM_CACHE_ENABLED else None
+llm_endpoints = EndpointPool(
+    settings.LM_STUDIO_BASE_URLS or [settings.LM_STUDIO_BASE_URL],
+    max_in_flight=settings.LLM_MAX_IN_FLIGHT,
+    probe_interval=settings.LLM_HEALTH_CHECK_INTERVAL,
+    adaptive=settings.LLM_ADAPTIVE_LIMIT,
+)
+llm_cassette = (
+    Cassette(settings.LLM_CASSETTE_PATH, mode=settings.LLM_CASSETTE_MODE, time_scale=settings.LLM_CASSETTE_TIME_SCALE)
+    if settings.LLM_CASSETTE_MODE else None
+)
+llm_router = ModelRouter(settings.LLM_STAGE_PROFILES, default=StageProfile(model=settings.LM_STUDIO_MODEL))
+lm_client = LMStudioClient(base_url=settings.LM_STUDIO_BASE_URL, cache=llm_cache, pool=llm_endpoints,
+                           retry_attempts=settings.LLM_RETRY_ATTEMPTS, cassette=llm_cassette, router=llm_router)
+async_lm_client = AsyncLMStudioClient(base_url=settings.LM_STUDIO_BASE_URL, cache=llm_cache, pool=llm_endpoints,
+                                      retry_attempts=settings.LLM_RETRY_ATTEMPTS, hedge=settings.LLM_HEDGE_ENABLED,
+                                      cassette=llm_cassette, router=llm_router)
+if settings.RAG_SERVICE_SOCKET:
+    # モデルもデータも RAG サービス側にあるため、ワーカーを増やしてもモデルのメモリは増えない
+    embedding_cache = None
+    storage = partitioned_storage = RAGServiceClient(settings.RAG_SERVICE_SOCKET)
+else:
+    embedding_cache = EmbeddingCache(path=settings.EMBEDDING_CACHE_PATH or None) if settings.EMBEDDING_CACHE_ENABLED else None
+    storage = RAGStorage(USE_MEMORY_RUN=settings.USE_MEMORY_STORAGE,
+                         embedding_backend=settings.EMBEDDING_BACKEND, embedding_client=lm_client,
+                         embedding_cache=embedding_cache,
+                         embedding_batch_window_ms=settings.EMBEDDING_MICROBATCH_WINDOW_MS)
+    # ユーザーごとのパーティション（共有パーティション = storage、シードデータはここに入る）
+    partitioned_storage = PartitionedStorage(storage, root=settings.PARTITION_DIR,
+                                             max_bytes=settings.PARTITION_CACHE_MAX_BYTES,
+                                             max_resident=settings.PARTITION_CACHE_MAX_COUNT)
+concrete_process = ConcreteUnderstanding(storage=partitioned_storage, lm_client=lm_client, async_lm_client=async_lm_client)
+response_gen = UserResponseGenerator(lm_client=lm_client, async_lm_client=async_lm_client)
+admission = AdmissionController(max_active=settings.STREAM_MAX_ACTIVE, max_queue=settings.STREAM_MAX_QUEUE)
 
 # ========================================
 # FastAPIアプリケーション
@@ -60,14 +145,16 @@ app.add_middleware(
 # 依存性注入の設定（実体を束ねる）
 # ========================================
 from dependencies import (
-    get_storage, get_lm_client, 
-    get_concrete_process, get_response_gen
+    get_storage, get_lm_client, get_async_lm_client,
+    get_concrete_process, get_response_gen, get_admission
 )
 
 app.dependency_overrides[get_storage] = lambda: storage
 app.dependency_overrides[get_lm_client] = lambda: lm_client
+app.dependency_overrides[get_async_lm_client] = lambda: async_lm_client
 app.dependency_overrides[get_concrete_process] = lambda: concrete_process
 app.dependency_overrides[get_response_gen] = lambda: response_gen
+app.dependency_overrides[get_admission] = lambda: admission
 
 # ========================================
 # ルーター登録
@@ -80,19 +167,68 @@ app.include_router(threads.router, prefix="/api/v1/threads", tags=["threads"])
 # ========================================
 @app.on_event("startup")
 async def startup_event():
-    if settings.USE_MEMORY_STORAGE:
-        import json
-        from tqdm import tqdm
-        print("テスト経験データをデータベースに追加")
-        try:
-            with open("sample_test_data.json")as f:
-                data = json.load(f)
-            for d in tqdm(data["sample_experience_data"], desc="Load-test-data",ncols=120, ascii="-="):
-                storage.save_experience_data(text=d, metadata={"source": "initial"})
-        except FileNotFoundError:
-            print("sample_test_data.json not found, skipping data loading.")
+    # LLMノードのヘルスチェック（/v1/models）を定期実行し、障害ノードを振り分け対象から外す
+    app.state.health_check_task = None
+    if settings.LLM_HEALTH_CHECK_INTERVAL > 0 and settings.LLM_CASSETTE_MODE != "replay":
+        import asyncio
+        app.state.health_check_task = asyncio.create_task(async_lm_client.run_health_checks())
+    # テスト経験データはバックグラウンドで一括投入し、起動直後からリクエストを受け付ける
+    app.state.seed_task = None
+    # RAG サービスモードではサービス側で一度だけ投入する（--seed）
+    if settings.USE_MEMORY_STORAGE and not settings.RAG_SERVICE_SOCKET:
+        import asyncio
+        app.state.seed_task = asyncio.create_task(asyncio.to_thread(load_seed_data, "sample_test_data.json"))
     print(f"🚀 Application started in {settings.ENVIRONMENT} mode")
 
+def load_seed_data(path: str):
+    import json
+    from tqdm import tqdm
+    print("テスト経験データをデータベースに追加")
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        print(f"{path} not found, skipping data loading.")
+        return
+    texts = data["sample_experience_data"]
+    with tqdm(total=len(texts), desc="Load-test-data", ncols=120, ascii="-=") as bar:
+        storage.save_batch(texts, [{"source": "initial"} for _ in texts], category="experience",
+                           batch_size=settings.STORAGE_BATCH_SIZE, progress=lambda done, total: bar.update(done - bar.n))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if app.state.health_check_task is not None:
+        app.state.health_check_task.cancel()
+    if app.state.seed_task is not None and not app.state.seed_task.done():
+        # スレッド内の投入処理は中断できないため、完了を待ってから後片付けする
+        await app.state.seed_task
+    # FAISS バックエンドではインデックスをファイルへ書き出し、常駐中のユーザーパーティションを閉じる（Chroma では何もしない）。
+    # RAG サービスモードでは接続を閉じるだけで、永続化はサービスの終了時に行われる
+    # RAG サービスモードでは統計取得がソケット往復になる。サービスが先に落ちていても後片付けは続ける
+    try:
+        partition_stats, embedding_batch_stats = partitioned_storage.stats(), storage.embedding_batch_stats()
+    except (OSError, RAGServiceError) as e:
+        print(f"Storage stats unavailable: {e!r}")
+        partition_stats = embedding_batch_stats = None
+    partitioned_storage.close()
+    if partition_stats is not None:
+        print(f"Storage partition stats: {partition_stats}")
+    # LM Studio への keep-alive 接続プールを閉じる
+    await aclose_all_pools()
+    print(f"LLM endpoint stats: {llm_endpoints.stats()}")
+    print(f"Stream admission stats: {admission.stats()}")
+    print(f"LLM usage per stage: {llm_router.stats()['usage']}")
+    if llm_cassette is not None:
+        print(f"LLM cassette stats: {llm_cassette.stats()}")
+        llm_cassette.close()
+    if embedding_cache is not None:
+        print(f"Embedding cache stats: {embedding_cache.stats()}")
+    if embedding_batch_stats is not None:
+        print(f"Embedding micro-batch stats: {embedding_batch_stats}")
+    if llm_cache is not None:
+        print(f"LLM cache stats: {llm_cache.stats()}")
+        llm_cache.close()
+
 if __name__ == "__main__":
     import uvicorn
     from colorful_print import color_set_print
@@ -39,10 +39,12 @@ def setup_storage() -> RAGStorage:
         "将来に対する不安はあまりない。自分が良くなった素敵な未来があるだろうと考えている。どこで死んでも良い、今を全力に生きれるような人でありたいと考えている。"
     ]
     
-    for d in tqdm(sample_experience_data, desc="Load-test-data",ncols=120, ascii="-="):
-        storage.save_experience_data(
-            text=d,
-            metadata={"source": "initial_data"}
+    with tqdm(total=len(sample_experience_data), desc="Load-test-data",ncols=120, ascii="-=") as bar:
+        storage.save_batch(
+            sample_experience_data,
+            [{"source": "initial_data"} for _ in sample_experience_data],
+            category="experience",
+            progress=lambda done, total: bar.update(done - bar.n)
         )
  
     print("ストレージの準備が完了しました。")
@@ -0,0 +1,53 @@
+# test_admission.py
+import asyncio
+import unittest
+
+from lm_studio_rag.admission import AdmissionController, AdmissionRejected
+
+
+class TestAdmissionController(unittest.IsolatedAsyncioTestCase):
+    """
+    AdmissionController の上限・待機順位の通知・満杯時の即時拒否を検証するテスト。
+    """
+
+    async def test_queue_positions_advance_and_full_queue_rejects(self):
+        admission = AdmissionController(max_active=1, max_queue=2)
+        running = admission.enter()
+        first, second = admission.enter(), admission.enter()
+        with self.assertRaises(AdmissionRejected) as ctx:
+            admission.enter()
+        self.assertGreaterEqual(ctx.exception.retry_after, 1.0)
+
+        updates = []
+
+        async def follow():
+            async for position, _ in admission.wait(second):
+                updates.append(position)
+
+        follower = asyncio.ensure_future(follow())
+        await asyncio.sleep(0)
+        admission.release(running)
+        await asyncio.sleep(0)
+        admission.release(first)
+        await asyncio.wait_for(follower, timeout=1)
+
+        self.assertEqual(updates, [2, 1])
+        self.assertTrue(second.admitted)
+        self.assertEqual(admission.stats()["rejected"], 1)
+
+    async def test_abandoned_waiter_frees_its_place(self):
+        admission = AdmissionController(max_active=1, max_queue=1)
+        running = admission.enter()
+        waiting = admission.enter()
+        admission.release(waiting)
+        admission.release(waiting)  # idempotent
+        replacement = admission.enter()
+        admission.release(running)
+
+        self.assertTrue(replacement.admitted)
+        stats = admission.stats()
+        self.assertEqual((stats["active"], stats["queued"], stats["abandoned"]), (1, 0, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
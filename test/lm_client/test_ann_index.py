@@ -0,0 +1,76 @@
+# test_ann_index.py
+import unittest
+
+import numpy as np
+
+from lm_studio_rag.ann_index import (
+    build_index, index_codec, index_kind, index_pca_dim, recall_report, search_params, vector_bytes,
+)
+
+
+def normalized(rng, n, dim):
+    x = rng.standard_normal((n, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+class TestAnnIndex(unittest.TestCase):
+    """
+    ann_index の各インデックス種別（durable id の保持・削除）と recall@k レポートを検証するテスト。
+    """
+
+    def test_ivfpq_keeps_durable_ids_through_removal(self):
+        rng = np.random.default_rng(0)
+        vectors = normalized(rng, 600, 16)
+        ids = np.arange(600, dtype=np.int64) * 7919 + (1 << 62)
+        index = build_index("ivfpq", 16, vectors, ids)
+        self.assertEqual(index_kind(index), "ivfpq")
+
+        index.remove_ids(ids[:100])
+        params = search_params(index, nprobe=64)
+        _, I = index.search(vectors[100:110], 1, params=params)
+        self.assertEqual(index.ntotal, 500)
+        self.assertGreaterEqual(np.mean(I[:, 0] == ids[100:110]), 0.8)
+
+    def test_report_compares_every_setting_against_exact_search(self):
+        rng = np.random.default_rng(1)
+        vectors = normalized(rng, 1000, 16)
+        rows = recall_report(vectors, vectors[:20], k=5, nprobes=(1, 64), ef_searches=(256,))
+
+        self.assertEqual([(r["index"], r["setting"]) for r in rows],
+                         [("flat", "exact"), ("ivfpq", "nprobe=1"), ("ivfpq", "nprobe=64"),
+                          ("ivfpq", "nprobe=16 rescore=4"), ("hnsw", "efSearch=256")])
+        self.assertLess(rows[1]["recall"], rows[2]["recall"])
+        self.assertLess(rows[2]["recall"], rows[3]["recall"])  # rescoring recovers what PQ codes lose
+        self.assertGreaterEqual(rows[4]["recall"], 0.95)
+
+    def test_compact_codecs_and_pca_shrink_vectors_and_rescoring_restores_recall(self):
+        rng = np.random.default_rng(2)
+        vectors = normalized(rng, 500, 32)
+        ids = np.arange(500, dtype=np.int64) + (1 << 40)
+        index = build_index("hnsw", 32, vectors, ids, codec="int8", pca_dim=16)
+        self.assertEqual((index_kind(index), index_codec(index), index_pca_dim(index)), ("hnsw", "int8", 16))
+        _, I = index.search(vectors[:1], 1, params=search_params(index))
+        self.assertEqual(I[0, 0], ids[0])
+
+        rows = recall_report(vectors, vectors[:20], k=5, nprobes=(), ef_searches=(), codecs=("float16", "int8"),
+                             rescore=4)
+        by_setting = {(r["index"], r["setting"]): r for r in rows if r["index"] == "flat"}
+        self.assertEqual(by_setting[("flat", "exact")]["bytes_per_vector"], 4 * 32 + 8)
+        self.assertEqual(by_setting[("flat", "float16")]["bytes_per_vector"], 2 * 32 + 8)
+        self.assertEqual(by_setting[("flat", "int8")]["bytes_per_vector"], 32 + 8)
+        self.assertEqual(by_setting[("flat", "int8 rescore=4")]["recall"], 1.0)
+
+    def test_vector_bytes_reflects_codec_and_pca_dim(self):
+        rng = np.random.default_rng(3)
+        vectors = normalized(rng, 100, 32)
+        ids = np.arange(100, dtype=np.int64)
+
+        self.assertEqual(vector_bytes(build_index("flat", 32, vectors, ids)), 4 * 32 + 8)
+        self.assertEqual(vector_bytes(build_index("flat", 32, vectors, ids, codec="float16")), 2 * 32 + 8)
+        self.assertEqual(vector_bytes(build_index("flat", 32, vectors, ids, codec="int8")), 32 + 8)
+        self.assertEqual(vector_bytes(build_index("flat", 32, vectors, ids, codec="int8", pca_dim=16)), 16 + 8)
+        self.assertGreater(vector_bytes(build_index("hnsw", 32, vectors, ids, codec="int8", pca_dim=16)), 16 + 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+# test_cassette.py
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+import httpx
+
+from lm_studio_rag import lm_studio_client
+from lm_studio_rag.cassette import Cassette, CassetteMiss, MODE_RECORD, MODE_REPLAY
+from lm_studio_rag.fake_server import FakeServerConfig, create_app
+from lm_studio_rag.lm_studio_client import AsyncLMStudioClient
+
+
+class TestCassette(unittest.IsolatedAsyncioTestCase):
+    """
+    偽サーバーとの通信を記録し、モデルなしで再生できることを検証するテスト。
+    """
+
+    BASE_URL = "http://cassette.test"
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "traffic.cassette.zst")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    async def record(self):
+        app = create_app(FakeServerConfig(ttft=0.05, tokens_per_sec=0))
+        http = httpx.AsyncClient(base_url=self.BASE_URL, transport=httpx.ASGITransport(app=app))
+        lm_studio_client._async_clients[(self.BASE_URL, id(asyncio.get_running_loop()))] = http
+        cassette = Cassette(self.path, mode=MODE_RECORD)
+        client = AsyncLMStudioClient(base_url=self.BASE_URL, cassette=cassette)
+        answer = await client.generate_response("質問", "文脈")
+        deltas = [d async for d in client.generate_response_stream("質問", "別の文脈")]
+        cassette.close()
+        await lm_studio_client.aclose_all_pools()
+        return answer, deltas
+
+    async def test_replay_serves_recorded_traffic_without_upstream(self):
+        answer, deltas = await self.record()
+
+        cassette = Cassette(self.path, mode=MODE_REPLAY, time_scale=0.0)
+        client = AsyncLMStudioClient(base_url="http://nowhere.invalid", cassette=cassette)
+        replayed = await client.generate_response("質問", "文脈")
+        replayed_stream = [d async for d in client.generate_response_stream("質問", "別の文脈")]
+        # a streamed recording also answers the non-streamed form of the same request
+        joined = await client.generate_response("質問", "別の文脈")
+
+        self.assertEqual(replayed, answer)
+        self.assertEqual(replayed_stream, deltas)
+        self.assertEqual(joined, "".join(deltas))
+        with self.assertRaises(CassetteMiss):
+            await client.generate_response("未記録", "")
+
+    async def test_replay_keeps_recorded_timing(self):
+        await self.record()
+        client = AsyncLMStudioClient(base_url="http://nowhere.invalid", cassette=Cassette(self.path, time_scale=1.0))
+        started = time.monotonic()
+        await client.generate_response("質問", "文脈")
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
+
+
+if __name__ == "__main__":
+    unittest.main()
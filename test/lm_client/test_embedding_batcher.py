@@ -0,0 +1,102 @@
+# test_embedding_batcher.py
+import threading
+import unittest
+
+import numpy as np
+
+from lm_studio_rag.embedding_batcher import MicroBatchEmbedder, find_batcher
+from lm_studio_rag.embedding_cache import CachedEmbedder, EmbeddingCache
+
+
+class GatedEmbedder:
+    """encode() blocks on the first call until released, so later requests queue up behind it."""
+
+    def __init__(self, dim: int = 4):
+        self.dim = dim
+        self.calls = []
+        self.first_call = threading.Event()
+        self.release = threading.Event()
+        self.fail = False
+
+    def encode(self, texts, show_progress_bar=False, **kwargs):
+        self.calls.append(list(texts))
+        self.first_call.set()
+        self.release.wait(5)
+        if self.fail:
+            raise RuntimeError("encoder down")
+        return np.array([[float(len(text))] * self.dim for text in texts], dtype=np.float32)
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+
+class TestMicroBatchEmbedder(unittest.TestCase):
+    """
+    MicroBatchEmbedder が同時に届いたエンコード要求を1回の encode にまとめ、各呼び出し元へ自分の行を返すことを検証するテスト。
+    """
+
+    def setUp(self):
+        self.inner = GatedEmbedder()
+        self.batcher = MicroBatchEmbedder(self.inner, window_ms=50, max_batch=8)
+        self.addCleanup(self.batcher.close)
+
+    def run_concurrently(self, requests):
+        results, errors = {}, {}
+
+        def call(name, texts):
+            try:
+                results[name] = self.batcher.encode(texts)
+            except Exception as e:
+                errors[name] = e
+
+        # the first request occupies the worker; the rest queue while it encodes
+        first = threading.Thread(target=call, args=requests[0])
+        first.start()
+        self.assertTrue(self.inner.first_call.wait(5))
+        threads = [threading.Thread(target=call, args=request) for request in requests[1:]]
+        for thread in threads:
+            thread.start()
+        while self.batcher._queue.qsize() < len(threads):
+            threading.Event().wait(0.001)
+        self.inner.release.set()
+        for thread in [first] + threads:
+            thread.join(5)
+        return results, errors
+
+    def test_concurrent_requests_share_one_encode_and_get_their_own_rows(self):
+        results, errors = self.run_concurrently([("warmup", ["w"]), ("a", ["x", "yy"]), ("b", ["zzz"]),
+                                                 ("c", ["qqqq"])])
+
+        self.assertEqual(errors, {})
+        self.assertEqual(len(self.inner.calls), 2)
+        self.assertEqual(sorted(self.inner.calls[1]), ["qqqq", "x", "yy", "zzz"])
+        self.assertEqual(results["a"][:, 0].tolist(), [1.0, 2.0])
+        self.assertEqual(results["b"][:, 0].tolist(), [3.0])
+        self.assertEqual(results["c"][:, 0].tolist(), [4.0])
+
+        stats = self.batcher.stats()
+        self.assertEqual(stats["batch_size"]["count"], 2)
+        self.assertEqual(stats["batch_size"]["buckets"]["<=4"], 1)  # the 4 coalesced texts
+        self.assertEqual(stats["wait_ms"]["count"], 4)
+        self.assertGreater(stats["latency_p50_ms"], 0)
+
+    def test_errors_reach_every_caller_and_large_batches_bypass_the_window(self):
+        self.inner.fail = True
+        results, errors = self.run_concurrently([("warmup", ["w"]), ("a", ["x"]), ("b", ["yy"])])
+        self.assertEqual(results, {})
+        self.assertEqual(sorted(errors), ["a", "b", "warmup"])
+
+        self.inner.fail = False
+        self.inner.calls.clear()
+        vectors = self.batcher.encode(["t"] * 8)
+        self.assertEqual((vectors.shape, self.inner.calls), ((8, 4), [["t"] * 8]))
+        self.assertEqual(self.batcher.stats()["bypassed"], 1)
+
+    def test_find_batcher_looks_through_the_cache_wrapper(self):
+        cached = CachedEmbedder(self.batcher, EmbeddingCache(), "test:model")
+        self.assertIs(find_batcher(cached), self.batcher)
+        self.assertIsNone(find_batcher(self.inner))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+# test_embedding_cache.py
+import tempfile
+import unittest
+
+import numpy as np
+
+from lm_studio_rag.embedding_cache import EmbeddingCache
+
+
+class CountingEncoder:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return np.array([[len(t), ord(t[0]), 1.0] for t in texts], dtype=np.float32)
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    """
+    埋め込みキャッシュの重複排除・LRU・再起動後のディスク再利用を検証するテスト。
+    """
+
+    def test_only_missing_texts_are_encoded_once(self):
+        cache, encoder = EmbeddingCache(), CountingEncoder()
+        first = cache.encode("m", ["a", "bb", "a"], encoder)
+        second = cache.encode("m", ["bb\r\n", "ccc"], encoder)
+
+        self.assertEqual(encoder.calls, [["a", "bb"], ["ccc"]])
+        self.assertEqual(first.dtype, np.float32)
+        np.testing.assert_array_equal(first[0], first[2])
+        np.testing.assert_array_equal(second[0], first[1])
+        # the model name is part of the key
+        cache.encode("other", ["a"], encoder)
+        self.assertEqual(encoder.calls[-1], ["a"])
+
+    def test_vectors_survive_restart_through_disk_shard(self):
+        with tempfile.TemporaryDirectory() as path:
+            encoder = CountingEncoder()
+            stored = EmbeddingCache(path=path).encode("local:mini", ["x", "yy"], encoder)
+            EmbeddingCache(path=path).encode("local:mini", ["zzz"], encoder)
+
+            reloaded = EmbeddingCache(path=path, max_entries=1)
+            again = reloaded.encode("local:mini", ["yy", "x", "zzz"], encoder)
+
+            self.assertEqual(len(encoder.calls), 2)
+            np.testing.assert_array_equal(again[:2], stored[::-1])
+            self.assertEqual(reloaded.stats()["disk_hits"], 3)
+            self.assertEqual(reloaded.stats()["memory_entries"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
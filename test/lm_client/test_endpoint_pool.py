@@ -0,0 +1,110 @@
+# test_endpoint_pool.py
+import asyncio
+import unittest
+
+import httpx
+
+from lm_studio_rag import lm_studio_client
+from lm_studio_rag.endpoint_pool import EndpointPool, normalize_base_url
+from lm_studio_rag.lm_studio_client import AsyncLMStudioClient
+
+
+def _never(e):
+    return False
+
+
+def _always(e):
+    return True
+
+
+class TestEndpointPool(unittest.TestCase):
+    """
+    EndpointPool の振り分け・排除・復帰を検証するテスト。
+    """
+
+    def test_base_urls_are_normalized_and_deduplicated(self):
+        pool = EndpointPool(["http://a:1234/v1", "http://a:1234/", "http://b:1234"])
+        self.assertEqual([e.base_url for e in pool.endpoints], ["http://a:1234", "http://b:1234"])
+        self.assertEqual(normalize_base_url("http://x/v1/"), "http://x")
+
+    def test_least_outstanding_wins(self):
+        pool = EndpointPool(["http://pool-lo-a", "http://pool-lo-b"])
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertIsNot(first, second)
+        pool.release(first)
+        self.assertIs(pool.acquire(), first)
+
+    def test_requests_go_to_nodes_serving_the_model(self):
+        pool = EndpointPool(["http://pool-m-a", "http://pool-m-b"])
+        a, b = pool.endpoints
+        pool.record_probe(a, ["qwen"])
+        pool.record_probe(b, ["gemma-3-1b-it"])
+        for _ in range(3):
+            self.assertIs(pool.acquire("gemma-3-1b-it"), b)
+        # nobody advertises it -> let any node try
+        self.assertIs(pool.acquire("unknown-model"), a)
+
+    def test_failing_node_is_ejected_and_readmitted(self):
+        pool = EndpointPool(["http://pool-e-a", "http://pool-e-b"], eject_after_failures=2, eject_seconds=60)
+        a, b = pool.endpoints
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                with pool.lease(None, _always) as endpoint:
+                    self.assertIs(endpoint, a)
+                    raise ConnectionError("down")
+        self.assertFalse(a.healthy)
+        self.assertEqual([pool.acquire() for _ in range(3)], [b, b, b])
+
+        a.ejected_until = 0.0  # ejection period over: trial request allowed
+        with pool.lease(None, _never) as endpoint:
+            self.assertIs(endpoint, a)
+        self.assertTrue(a.healthy)
+
+    def test_client_errors_do_not_count_against_node(self):
+        pool = EndpointPool("http://pool-4xx", eject_after_failures=1)
+        with self.assertRaises(ValueError):
+            with pool.lease(None, _never):
+                raise ValueError("bad request")
+        self.assertTrue(pool.primary.healthy)
+
+
+class TestAsyncClientRouting(unittest.IsolatedAsyncioTestCase):
+
+    def install(self, base_url, handler):
+        client = httpx.AsyncClient(base_url=base_url, transport=httpx.MockTransport(handler))
+        lm_studio_client._async_clients[(base_url, id(asyncio.get_running_loop()))] = client
+        self.addAsyncCleanup(lm_studio_client.aclose_all_pools)
+
+    async def test_probe_and_failover(self):
+        hits = {"a": 0, "b": 0}
+
+        def node(name, models, healthy):
+            def handler(request: httpx.Request):
+                if request.url.path == "/v1/models":
+                    return httpx.Response(200, json={"data": [{"id": m} for m in models]})
+                hits[name] += 1
+                if not healthy:
+                    return httpx.Response(503, json={})
+                return httpx.Response(200, json={"choices": [{"message": {"content": name}}]})
+            return handler
+
+        self.install("http://route-a", node("a", ["gemma-3-1b-it"], healthy=False))
+        self.install("http://route-b", node("b", ["gemma-3-1b-it"], healthy=True))
+        pool = EndpointPool(["http://route-a/v1", "http://route-b/v1"], eject_after_failures=1)
+        client = AsyncLMStudioClient(pool=pool)
+        await client.check_health()
+
+        answers = [
+            (await client.chat([{"role": "user", "content": str(i)}], model="gemma-3-1b-it"))["choices"][0]["message"]["content"]
+            for i in range(3)
+        ]
+
+        # the 503 from a is retried on b, and a is ejected afterwards
+        self.assertEqual(answers, ["b", "b", "b"])
+        self.assertEqual(hits, {"a": 1, "b": 3})
+        self.assertFalse(pool.endpoints[0].healthy)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+# test_fake_server.py
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+import httpx
+
+from architecture.user_response.generator import UserResponseGenerator
+from lm_studio_rag import lm_studio_client
+from lm_studio_rag.fake_server import FakeServerConfig, create_app
+from lm_studio_rag.lm_studio_client import AsyncLMStudioClient
+
+
+class TestFakeServer(unittest.IsolatedAsyncioTestCase):
+    """
+    偽のOpenAI互換サーバーを AsyncLMStudioClient から叩いて検証するテスト。
+    """
+
+    BASE_URL = "http://fake-llm.test"
+
+    def serve(self, **config):
+        app = create_app(FakeServerConfig(ttft=0.0, tokens_per_sec=0, **config))
+        client = httpx.AsyncClient(base_url=self.BASE_URL, transport=httpx.ASGITransport(app=app))
+        lm_studio_client._async_clients[(self.BASE_URL, id(asyncio.get_running_loop()))] = client
+        self.addAsyncCleanup(lm_studio_client.aclose_all_pools)
+        return app
+
+    async def test_user_response_format_is_parseable(self):
+        self.serve()
+        client = AsyncLMStudioClient(base_url=self.BASE_URL)
+        generator = UserResponseGenerator(lm_client=object(), async_lm_client=client)
+        abstract_info = SimpleNamespace(emotion_estimation="不安", think_estimation="迷っている")
+        raw = await client.generate_response(generator.PROMPT, generator._build_context(abstract_info, "進路の相談"),
+                                             model="gemma-3-1b-it")
+        parsed = UserResponseGenerator._parse_response(raw)
+        self.assertEqual(parsed.dialogue, "焦らなくていいと思う。まずは一つだけ試してみよう")
+
+    async def test_stream_models_and_embeddings(self):
+        self.serve()
+        client = AsyncLMStudioClient(base_url=self.BASE_URL)
+        await client.check_health()
+        deltas = [d async for d in client.generate_response_stream("質問", "文脈", model="gemma-3-1b-it")]
+        vectors = await client.embed_texts(["a", "b", "a"])
+
+        self.assertGreater(len(deltas), 1)
+        self.assertIn("gemma-3-1b-it", client.pool.primary.models)
+        self.assertEqual(vectors.shape, (3, 384))
+        self.assertEqual(vectors[0].tolist(), vectors[2].tolist())
+
+    async def test_error_injection(self):
+        app = self.serve(error_rate=1.0, error_status=503)
+        client = AsyncLMStudioClient(base_url=self.BASE_URL, retry_attempts=1)
+        with self.assertRaises(httpx.HTTPStatusError):
+            await client.generate_response("質問", "文脈")
+        self.assertEqual(app.state.stats.errors, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+# test_llm_cache.py
+import os
+import tempfile
+import time
+import unittest
+
+from lm_studio_rag.llm_cache import LLMResponseCache, request_cache_key
+
+
+def _payload(content: str, temperature: float = 0.0) -> dict:
+    return {"model": "gemma-3-1b-it", "messages": [{"role": "user", "content": content}],
+            "temperature": temperature, "max_tokens": 200}
+
+
+class TestLLMResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, "llm_cache.db")
+
+    def test_key_ignores_stream_flag_and_indentation(self):
+        a = _payload("\n        状況説明文:\n        「公園」\n        ")
+        b = dict(_payload("状況説明文:\n「公園」"), stream=True)
+        self.assertEqual(request_cache_key(a), request_cache_key(b))
+        self.assertNotEqual(request_cache_key(a), request_cache_key(_payload("状況説明文:\n「公園」", 0.7)))
+
+    def test_disk_tier_survives_restart(self):
+        key = request_cache_key(_payload("hi"))
+        cache = LLMResponseCache(path=self.path)
+        cache.set(key, {"choices": [{"message": {"content": "ok"}}]})
+        cache.close()
+
+        reopened = LLMResponseCache(path=self.path)
+        self.addCleanup(reopened.close)
+        self.assertEqual(reopened.get(key)["choices"][0]["message"]["content"], "ok")
+        self.assertEqual(reopened.stats()["disk_hits"], 1)
+        reopened.get(key)
+        self.assertEqual(reopened.stats()["memory_hits"], 1)
+
+    def test_ttl_and_lru_eviction(self):
+        cache = LLMResponseCache(max_entries=2, ttl_seconds=0.05)
+        cache.set("a", {"v": 1})
+        cache.set("b", {"v": 2})
+        cache.set("c", {"v": 3})
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("c"), {"v": 3})
+        time.sleep(0.06)
+        self.assertIsNone(cache.get("c"))
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_disk_size_limit(self):
+        cache = LLMResponseCache(path=self.path, max_entries=1, max_disk_bytes=200)
+        self.addCleanup(cache.close)
+        for i in range(20):
+            cache.set(f"k{i}", {"text": os.urandom(64).hex()})
+        self.assertLessEqual(cache.stats()["disk_bytes"], 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,212 @@
+# test_lm_studio_client.py
+import asyncio
+import json
+import threading
+import unittest
+
+import httpx
+import numpy as np
+
+from lm_studio_rag import lm_studio_client
+from lm_studio_rag.lm_studio_client import AsyncLMStudioClient
+from lm_studio_rag.llm_cache import LLMResponseCache
+from lm_studio_rag.single_flight import SingleFlight
+
+
+def _completion(content: str) -> dict:
+    return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+
+class TestAsyncLMStudioClient(unittest.IsolatedAsyncioTestCase):
+    """
+    AsyncLMStudioClient をモックトランスポート越しに検証するテスト。
+    """
+
+    BASE_URL = "http://lmstudio.test"
+
+    def install_transport(self, handler):
+        """共有プールにモックトランスポート付きのクライアントを差し込む"""
+        client = httpx.AsyncClient(base_url=self.BASE_URL, transport=httpx.MockTransport(handler))
+        key = (self.BASE_URL, id(asyncio.get_running_loop()))
+        lm_studio_client._async_clients[key] = client
+        self.addAsyncCleanup(lm_studio_client.aclose_all_pools)
+
+    async def test_generate_response_returns_content(self):
+        seen = []
+
+        def handler(request: httpx.Request):
+            seen.append(json.loads(request.content))
+            return httpx.Response(200, json=_completion("ok"))
+
+        self.install_transport(handler)
+        client = AsyncLMStudioClient(base_url=self.BASE_URL)
+        result = await client.generate_response("質問", "文脈", model="gemma-3-1b-it")
+
+        self.assertEqual(result, "ok")
+        self.assertEqual(seen[0]["model"], "gemma-3-1b-it")
+        self.assertEqual(seen[0]["max_tokens"], 512)
+
+    async def test_clients_share_one_pool_per_base_url(self):
+        self.install_transport(lambda request: httpx.Response(200, json=_completion("ok")))
+        a = AsyncLMStudioClient(base_url=self.BASE_URL)
+        b = AsyncLMStudioClient(base_url=self.BASE_URL + "/")
+        self.assertIs(a.http, b.http)
+
+    async def test_classification_falls_back_on_invalid_json(self):
+        self.install_transport(lambda request: httpx.Response(200, json=_completion("not json")))
+        client = AsyncLMStudioClient(base_url=self.BASE_URL)
+        result = await client.classify_content_via_llm("昨日は寿司屋に行った")
+        self.assertEqual(result["label"], "personality")
+        self.assertEqual(result["score"], 0.5)
+
+    async def test_http_error_is_raised(self):
+        self.install_transport(lambda request: httpx.Response(500, json={}))
+        client = AsyncLMStudioClient(base_url=self.BASE_URL)
+        with self.assertRaises(httpx.HTTPStatusError):
+            await client.chat([{"role": "user", "content": "hi"}])
+
+    async def test_generate_response_stream_yields_deltas(self):
+        body = "".join(
+            f"data: {json.dumps({'choices': [{'delta': {'content': part}}]})}\n\n"
+            for part in ["わん", "ちゃん", "！"]
+        ) + "data: [DONE]\n\n"
+        seen = []
+
+        def handler(request: httpx.Request):
+            seen.append(json.loads(request.content))
+            return httpx.Response(200, text=body, headers={"Content-Type": "text/event-stream"})
+
+        self.install_transport(handler)
+        client = AsyncLMStudioClient(base_url=self.BASE_URL)
+        deltas = [d async for d in client.generate_response_stream("質問", "文脈")]
+
+        self.assertEqual(deltas, ["わん", "ちゃん", "！"])
+        self.assertTrue(seen[0]["stream"])
+
+    async def test_embed_texts_chunks_and_preserves_order(self):
+        batches = []
+
+        async def handler(request: httpx.Request):
+            texts = json.loads(request.content)["input"]
+            batches.append(texts)
+            await asyncio.sleep(0.01 * (3 - len(batches)))  # later chunks answer first
+            data = [{"index": i, "embedding": [float(t), 1.0]} for i, t in reversed(list(enumerate(texts)))]
+            return httpx.Response(200, json={"data": data})
+
+        self.install_transport(handler)
+        client = AsyncLMStudioClient(base_url=self.BASE_URL)
+        texts = [str(i) for i in range(5)] + ["0"]
+        client._embedding_chunks = lambda t: AsyncLMStudioClient._embedding_chunks(t, max_items=2)
+        vectors = await client.embed_texts(texts)
+
+        self.assertEqual(vectors.dtype, np.float32)
+        self.assertEqual(vectors[:, 0].tolist(), [0, 1, 2, 3, 4, 0])
+        self.assertEqual(sorted(len(b) for b in batches), [1, 2, 2])
+
+    async def test_cache_serves_repeated_and_streamed_calls(self):
+        calls = []
+
+        def handler(request: httpx.Request):
+            calls.append(json.loads(request.content))
+            return httpx.Response(200, json=_completion("cached"))
+
+        self.install_transport(handler)
+        client = AsyncLMStudioClient(base_url=self.BASE_URL, cache=LLMResponseCache())
+        first = await client.generate_response("質問", "文脈", temperature=0.0)
+        second = await client.generate_response("質問", "文脈", temperature=0.0)
+        streamed = [d async for d in client.generate_response_stream("質問", "文脈", temperature=0.0)]
+        await client.generate_response("質問", "文脈", temperature=0.0, use_cache=False)
+
+        self.assertEqual((first, second, streamed), ("cached", "cached", ["cached"]))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(client.cache.stats()["memory_hits"], 2)
+
+    async def test_sampled_calls_are_cached_only_on_opt_in(self):
+        calls = []
+
+        def handler(request: httpx.Request):
+            calls.append(json.loads(request.content))
+            return httpx.Response(200, json=_completion(f"sample {len(calls)}"))
+
+        self.install_transport(handler)
+        client = AsyncLMStudioClient(base_url=self.BASE_URL, cache=LLMResponseCache())
+        sampled = [await client.generate_response("質問", "文脈", temperature=0.2) for _ in range(2)]
+        opted_in = [await client.generate_response("質問", "文脈", temperature=0.7, use_cache=True) for _ in range(2)]
+
+        self.assertEqual(sampled, ["sample 1", "sample 2"])
+        self.assertEqual(opted_in, ["sample 3", "sample 3"])
+        self.assertEqual(len(calls), 3)
+
+    async def test_identical_concurrent_calls_are_coalesced(self):
+        calls = []
+
+        async def handler(request: httpx.Request):
+            calls.append(request)
+            await asyncio.sleep(0.05)
+            if json.loads(request.content).get("stream"):
+                body = "".join(f"data: {json.dumps({'choices': [{'delta': {'content': c}}]})}\n\n" for c in "abc")
+                return httpx.Response(200, text=body + "data: [DONE]\n\n")
+            return httpx.Response(200, json=_completion("shared"))
+
+        self.install_transport(handler)
+        client = AsyncLMStudioClient(base_url=self.BASE_URL)
+        results = await asyncio.gather(*[client.generate_response("同じ状況", "") for _ in range(5)])
+
+        async def collect():
+            return "".join([d async for d in client.generate_response_stream("同じ状況", "")])
+        streams = await asyncio.gather(*[collect() for _ in range(3)])
+
+        self.assertEqual(results, ["shared"] * 5)
+        self.assertEqual(streams, ["abc"] * 3)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(client.flight.stats()["coalesced"], 6)
+
+
+
+class TestSingleFlightStream(unittest.TestCase):
+    """
+    同期クライアント用の SingleFlight.stream が、同時に購読したスレッドで1本の上流ストリームを共有することを検証するテスト。
+    """
+
+    def test_concurrent_subscribers_share_one_upstream_and_abandon_closes_it(self):
+        flight, opened, closed = SingleFlight(), [], []
+        release = threading.Event()
+
+        def upstream():
+            opened.append(1)
+            try:
+                yield "a"
+                release.wait(1)
+                yield from "bc"
+            finally:
+                closed.append(1)
+
+        results = [None] * 3
+        joined = threading.Barrier(4)
+
+        def subscribe(i):
+            stream = flight.stream("k", upstream)
+            first = next(stream)
+            joined.wait()
+            results[i] = first + "".join(stream)
+
+        threads = [threading.Thread(target=subscribe, args=(i,)) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        joined.wait()
+        release.set()
+        for thread in threads:
+            thread.join(2)
+
+        self.assertEqual((results, len(opened), len(closed)), (["abc"] * 3, 1, 1))
+        self.assertEqual(flight.stats(), {"leaders": 1, "coalesced": 2, "in_flight": 0})
+
+        release.clear()
+        stream = flight.stream("k", upstream)
+        self.assertEqual(next(stream), "a")
+        stream.close()  # the only subscriber leaves mid-stream
+        self.assertEqual((len(opened), len(closed), flight.stats()["in_flight"]), (2, 2, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+# test_metadata_index.py
+import unittest
+
+from lm_studio_rag.metadata_index import MetadataIndex, chroma_where
+
+
+class TestMetadataIndex(unittest.TestCase):
+    """
+    MetadataIndex の値ごとのスロット集合による絞り込み（値・複数値・時間範囲）と、Chroma の where 句への変換を検証するテスト。
+    """
+
+    def test_select_combines_fields_values_and_time_range_and_reuses_slots(self):
+        index = MetadataIndex(fields=("category", "user_id"), capacity=2)
+        index.add(1, {"category": "experience", "user_id": "u1", "saved_at": "2026-01-01T00:00:00Z"})
+        index.add(2, {"category": "personality", "user_id": "u1", "saved_ts": 1_800_000_000})
+        index.add(3, {"category": "experience", "user_id": "u2"})  # grows past the initial capacity
+
+        self.assertEqual(sorted(index.select({"user_id": "u1"})), [1, 2])
+        self.assertEqual(sorted(index.select({"category": ["experience", "personality"], "user_id": "u1"})), [1, 2])
+        self.assertEqual(list(index.select({"category": "experience"}, saved_after="2025-12-31T00:00:00Z")), [1])
+        self.assertEqual(list(index.select({}, saved_before="2026-01-01T00:00:00Z")), [])
+
+        index.add(1, {"category": "personality", "user_id": "u2"})  # re-index replaces the old values
+        index.remove(3)
+        index.add(4, {"category": "experience"})
+        self.assertEqual(list(index.select({"category": "experience"})), [4])
+        self.assertEqual(len(index), 3)
+        self.assertEqual(sorted(index._postings["user_id"]), ["u1", "u2"])  # values without documents are dropped
+        index.remove(2)
+        self.assertEqual(list(index._postings["user_id"]), ["u2"])
+
+    def test_chroma_where_pushes_down_values_and_time_bounds(self):
+        self.assertIsNone(chroma_where({}))
+        self.assertEqual(chroma_where({"category": "experience"}), {"category": "experience"})
+        self.assertEqual(chroma_where({"source": ["chat", "web"]}, saved_after=10, saved_before="1970-01-01T00:01:00Z"), {
+            "$and": [{"source": {"$in": ["chat", "web"]}}, {"saved_ts": {"$gte": 10}}, {"saved_ts": {"$lt": 60.0}}],
+        })
+
+
+if __name__ == "__main__":
+    unittest.main()
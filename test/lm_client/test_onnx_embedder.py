@@ -0,0 +1,107 @@
+# test_onnx_embedder.py
+import importlib.util
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from lm_studio_rag.onnx_embedder import OnnxEmbedder, _read_pipeline, _sample_texts, artifact_dir, parity_report, pool
+
+_EXPORT_DEPS = ("torch", "transformers", "sentence_transformers", "onnxruntime", "onnx", "tokenizers")
+
+
+class TestOnnxEmbedderPipeline(unittest.TestCase):
+    """
+    ONNX 埋め込みのプーリング・正規化が sentence-transformers の構成（modules.json）どおりになることを検証するテスト。
+    """
+
+    def test_mean_pooling_ignores_padding_and_normalizes(self):
+        hidden = np.array([[[1.0, 0.0], [3.0, 0.0], [100.0, 100.0]],
+                           [[0.0, 2.0], [50.0, 50.0], [50.0, 50.0]]], dtype=np.float32)
+        mask = np.array([[1, 1, 0], [1, 0, 0]])
+
+        np.testing.assert_allclose(pool(hidden, mask, "mean", normalize=False), [[2.0, 0.0], [0.0, 2.0]])
+        np.testing.assert_allclose(pool(hidden, mask, "mean"), [[1.0, 0.0], [0.0, 1.0]])
+        np.testing.assert_allclose(pool(hidden, mask, "cls", normalize=False), [[1.0, 0.0], [0.0, 2.0]])
+
+    def test_pipeline_is_read_from_a_local_sentence_transformers_directory(self):
+        with tempfile.TemporaryDirectory() as model_dir:
+            os.makedirs(os.path.join(model_dir, "1_Pooling"))
+            files = {
+                "modules.json": [{"idx": 0, "path": "", "type": "sentence_transformers.models.Transformer"},
+                                 {"idx": 1, "path": "1_Pooling", "type": "sentence_transformers.models.Pooling"},
+                                 {"idx": 2, "path": "2_Normalize", "type": "sentence_transformers.models.Normalize"}],
+                "1_Pooling/config.json": {"word_embedding_dimension": 384, "pooling_mode_mean_tokens": True},
+                "sentence_bert_config.json": {"max_seq_length": 128},
+            }
+            for name, content in files.items():
+                with open(os.path.join(model_dir, name), "w", encoding="utf-8") as f:
+                    json.dump(content, f)
+
+            self.assertEqual(_read_pipeline(model_dir),
+                             {"pooling": "mean", "normalize": True, "max_seq_length": 128, "dim": 384})
+        self.assertEqual(artifact_dir("all-MiniLM-L6-v2", "/models"),
+                         os.path.join("/models", "sentence-transformers__all-MiniLM-L6-v2"))
+
+
+
+@unittest.skipUnless(all(importlib.util.find_spec(name) for name in _EXPORT_DEPS),
+                     "needs torch, transformers, sentence-transformers and onnxruntime")
+class TestOnnxEmbedderExport(unittest.TestCase):
+    """
+    小さな BERT を sentence-transformers 形式で保存し、ONNX（fp32 / int8）へのエクスポート結果が
+    埋め込み次元と torch 版とのコサイン類似度の許容範囲を満たすことを検証するテスト。
+    """
+
+    DIM = 32
+
+    @classmethod
+    def setUpClass(cls):
+        import torch
+        from sentence_transformers import SentenceTransformer, models
+        from transformers import BertConfig, BertModel, BertTokenizerFast
+
+        cls.tmp = tempfile.TemporaryDirectory()
+        hf_dir = os.path.join(cls.tmp.name, "hf")
+        cls.model_dir = os.path.join(cls.tmp.name, "tiny-st")
+        cls.root = os.path.join(cls.tmp.name, "onnx")
+        cls.texts = _sample_texts(64)
+        os.makedirs(hf_dir)
+        words = sorted({word.lower() for text in cls.texts for word in text.split()})
+        vocab_file = os.path.join(hf_dir, "vocab.txt")
+        with open(vocab_file, "w", encoding="utf-8") as f:
+            f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *words]) + "\n")
+        tokenizer = BertTokenizerFast(vocab_file=vocab_file)
+        torch.manual_seed(0)
+        config = BertConfig(vocab_size=len(tokenizer), hidden_size=cls.DIM, num_hidden_layers=2, num_attention_heads=2,
+                            intermediate_size=64, max_position_embeddings=128)
+        BertModel(config).save_pretrained(hf_dir)
+        tokenizer.save_pretrained(hf_dir)
+        SentenceTransformer(modules=[models.Transformer(hf_dir, max_seq_length=64), models.Pooling(cls.DIM, "mean"),
+                                     models.Normalize()], device="cpu").save(cls.model_dir)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_fp32_and_int8_embeddings_match_the_torch_model(self):
+        for quantize in (False, True):
+            embedder = OnnxEmbedder(self.model_dir, self.root, quantize=quantize, batch_size=8)
+            vectors = embedder.encode(self.texts)
+            self.assertEqual(embedder.get_sentence_embedding_dimension(), self.DIM)
+            self.assertEqual((vectors.shape, vectors.dtype), ((len(self.texts), self.DIM), np.float32))
+            np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1.0, atol=1e-5)
+        directory = artifact_dir(self.model_dir, self.root)
+        self.assertTrue(os.path.exists(os.path.join(directory, "model.int8.onnx")))
+
+        rows = {row["backend"]: row for row in parity_report(self.model_dir, self.texts, batch_size=8, root=self.root)}
+        self.assertEqual(set(rows), {"torch", "onnx-fp32", "onnx-int8"})
+        self.assertGreater(rows["onnx-fp32"]["min_cosine"], 0.999)
+        self.assertGreater(rows["onnx-int8"]["min_cosine"], 0.99)
+        self.assertGreater(rows["onnx-int8"]["texts_per_s"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
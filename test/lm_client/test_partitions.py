@@ -0,0 +1,96 @@
+# test_partitions.py
+import importlib.util
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from lm_studio_rag import storage as storage_module
+from lm_studio_rag.partitions import PartitionedStorage
+from lm_studio_rag.storage import RAGStorage
+from test_storage import CountingEmbeddingClient
+
+
+class TestPartitionedStorage(unittest.TestCase):
+    """
+    PartitionedStorage のユーザー間の分離・共有データとの統合・LRU による退避と再読み込みを検証するテスト。
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        for name, filename in (("METADATA_STORE_PATH", "meta.db"), ("FAISS_INDEX_PATH", "faiss.index")):
+            patcher = mock.patch.object(storage_module, name, os.path.join(self.tmp.name, filename))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = CountingEmbeddingClient()
+        self.shared = RAGStorage(dim=8, vector_db_type="faiss", embedding_backend="remote", embedding_client=self.client)
+        self.partitions = PartitionedStorage(self.shared, root=os.path.join(self.tmp.name, "partitions"), max_resident=1)
+
+    def test_users_only_see_their_own_partition_and_shared_data(self):
+        self.shared.save_batch(["seed"], [{"source": "initial"}])
+        self.partitions.save_experience_data("alice1", {}, user_id="alice")
+        self.partitions.save_experience_data("bob001", {}, user_id="bob")
+
+        alice = self.partitions.search_similar("bob001", category="experience", top_k=5, user_id="alice")
+        self.assertEqual(sorted(hit["text"] for hit in alice), ["alice1", "seed"])
+        self.assertEqual([hit["metadata"]["user_id"] for hit in alice if hit["text"] == "alice1"], ["alice"])
+        bob = self.partitions.search_similar("bob001", top_k=5, user_id="bob", include_shared=False)
+        self.assertEqual([hit["text"] for hit in bob], ["bob001"])
+        self.assertEqual([hit["text"] for hit in self.partitions.search_similar("seed", top_k=5)], ["seed"])
+
+    def test_lru_evicts_idle_partitions_and_reloads_them_from_disk(self):
+        self.partitions.upsert(["a1"], ["alice"], user_id="alice")
+        with self.partitions.partition("carol") as carol:
+            # alice, then bob once released, are idle and over the bound: persisted, closed and dropped
+            self.partitions.upsert(["b1"], ["bob"], user_id="bob")
+            # carol is pinned, so it stays usable whatever the bound
+            self.assertEqual((self.partitions.stats()["resident"], self.partitions.stats()["pinned"]), (1, 1))
+            carol.upsert(["c1"], ["carol"])
+
+        stats = self.partitions.stats()
+        self.assertEqual((stats["loads"], stats["evictions"], stats["resident"]), (3, 2, 1))
+        self.client.calls.clear()
+        hits = self.partitions.search_similar("alice", top_k=1, user_id="alice", include_shared=False)
+        self.assertEqual([hit["id"] for hit in hits], ["a1"])
+        self.assertEqual(self.client.calls, [["alice"]])  # the query only: the partition reloaded from its files
+        self.assertEqual(self.partitions._key_locks, {})
+
+    def test_memory_run_spills_evicted_partitions_to_a_temporary_directory(self):
+        shared = RAGStorage(dim=8, vector_db_type="faiss", USE_MEMORY_RUN=True, embedding_backend="remote",
+                            embedding_client=self.client)
+        partitions = PartitionedStorage(shared, root=os.path.join(self.tmp.name, "unused"), max_resident=1)
+        for user in ("alice", "bob", "carol"):
+            partitions.upsert([user[0] + "1"], [user], user_id=user)
+
+        stats = partitions.stats()
+        self.assertEqual((stats["evictions"], stats["resident"]), (2, 1))
+        hits = partitions.search_similar("alice", top_k=1, user_id="alice", include_shared=False)
+        self.assertEqual([hit["id"] for hit in hits], ["a1"])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, "unused")))
+        spill_dir = partitions.root
+        partitions.close()
+        self.assertFalse(os.path.exists(spill_dir))
+
+    @unittest.skipUnless(importlib.util.find_spec("chromadb"), "chromadb is not installed")
+    def test_memory_run_spills_chroma_partitions_to_a_temporary_directory(self):
+        shared = RAGStorage(dim=8, vector_db_type="chroma", USE_MEMORY_RUN=True, embedding_backend="remote",
+                            embedding_client=self.client, collection_name="shared_" + os.path.basename(self.tmp.name))
+        self.assertEqual(shared.vector_db_type, "chroma")
+        partitions = PartitionedStorage(shared, root=os.path.join(self.tmp.name, "unused"), max_resident=1)
+        for user in ("alice", "bob", "carol"):
+            partitions.upsert([user[0] + "1"], [user], user_id=user)
+
+        self.assertEqual((partitions.stats()["evictions"], partitions.stats()["resident"]), (2, 1))
+        # user collections live in the spill directory, not in the shared in-memory client
+        self.assertEqual([c.name for c in shared.client.list_collections()], [shared.collection.name])
+        hits = partitions.search_similar("alice", top_k=1, user_id="alice", include_shared=False)
+        self.assertEqual([hit["id"] for hit in hits], ["a1"])
+        spill_dir = partitions.root
+        self.assertTrue(os.listdir(os.path.join(spill_dir, "chroma")))
+        partitions.close()
+        self.assertFalse(os.path.exists(spill_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+# test_rag_service.py
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from lm_studio_rag.partitions import PartitionedStorage
+from lm_studio_rag.rag_service import RAGService, RAGServiceClient, encode_frame, OP_EMBED
+from lm_studio_rag.storage import RAGStorage
+from test_storage import CountingEmbeddingClient
+
+
+class TestRAGService(unittest.TestCase):
+    """
+    RAG サービス（Unix ソケット）経由で埋め込み・検索・投入ができ、ワーカー側のクライアントが
+    PartitionedStorage と同じ結果を返すことを検証するテスト。
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.embedder = CountingEmbeddingClient()
+        shared = RAGStorage(dim=8, vector_db_type="faiss", USE_MEMORY_RUN=True, embedding_backend="remote",
+                            embedding_client=self.embedder, embedding_batch_window_ms=0)
+        self.storage = PartitionedStorage(shared, root=self.tmp.name)
+        self.addCleanup(self.storage.close)
+        self.path = os.path.join(self.tmp.name, "rag.sock")
+        self.service = RAGService(self.storage, self.path)
+        self.service.start()
+        self.addCleanup(self.service.stop)
+        self.client = RAGServiceClient(self.path)
+        self.addCleanup(self.client.close)
+
+    def test_ingest_and_search_round_trip_with_user_routing(self):
+        progress = []
+        ids = self.client.save_batch(["a", "bb", "ccc"], [{"source": "initial"}] * 3, batch_size=2,
+                                     progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual((len(ids), progress), (3, [(2, 3), (3, 3)]))
+        self.client.save_experience_data("dddd", {"source": "chat"}, user_id="alice")
+
+        self.assertEqual(self.client.search_similar("bb", top_k=1)[0]["text"], "bb")
+        alice = self.client.search_similar("dddd", category="experience", top_k=4, user_id="alice")
+        self.assertEqual(alice, self.storage.search_similar("dddd", category="experience", top_k=4, user_id="alice"))
+        self.assertEqual(alice[0]["metadata"]["user_id"], "alice")
+        self.assertNotIn("dddd", [hit["text"] for hit in self.client.search_similar("dddd", top_k=4, user_id="bob")])
+
+        many = self.client.search_similar_many(["a", "ccc"], top_k=1, where={"source": "initial"})
+        self.assertEqual([hits[0]["text"] for hits in many], ["a", "ccc"])
+        self.assertEqual(self.client.delete([ids[0]]), 1)
+        with self.assertRaises(ValueError):  # remote ValueErrors keep their type
+            self.client.search_similar("a", where={"reasoning": "x"})
+
+    def test_embeddings_travel_as_float32_and_connections_are_reused_and_reopened(self):
+        vectors = self.client.embedding_model.encode(["x", "yyy"])
+        np.testing.assert_array_equal(vectors, self.embedder.embed_texts(["x", "yyy"]))
+        self.assertEqual(self.client.embedding_model.get_sentence_embedding_dimension(), 8)
+        self.assertEqual(len(self.client._idle), 1)
+        # float32 rows, not JSON numbers
+        self.assertLess(len(encode_frame(OP_EMBED, {}, vectors)), 2 * vectors.nbytes)
+
+        self.service.stop()  # pooled connection goes stale
+        self.service.start()
+        self.assertEqual(self.client.search_similar("x"), [])
+        self.assertEqual(self.client.stats()["partitions"]["resident"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
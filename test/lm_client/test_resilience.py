@@ -0,0 +1,82 @@
+# test_resilience.py
+import asyncio
+import time
+import unittest
+
+import httpx
+
+from lm_studio_rag import lm_studio_client
+from lm_studio_rag.endpoint_pool import EndpointPool
+from lm_studio_rag.lm_studio_client import AsyncLMStudioClient
+from lm_studio_rag.resilience import RetryBudget
+
+
+def _completion(content: str) -> dict:
+    return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+
+class TestRetryBudget(unittest.TestCase):
+
+    def test_budget_limits_retries_to_share_of_traffic(self):
+        budget = RetryBudget(ratio=0.5, min_per_second=0.0, max_tokens=1.0)
+        self.assertTrue(budget.try_spend())
+        self.assertFalse(budget.try_spend())
+        budget.record_request()
+        budget.record_request()
+        self.assertTrue(budget.try_spend())
+        self.assertEqual(budget.stats()["denied"], 1)
+
+
+class TestRetriesAndHedging(unittest.IsolatedAsyncioTestCase):
+    """
+    AsyncLMStudioClient のリトライとヘッジングを検証するテスト。
+    """
+
+    def install(self, base_url, handler):
+        client = httpx.AsyncClient(base_url=base_url, transport=httpx.MockTransport(handler))
+        lm_studio_client._async_clients[(base_url, id(asyncio.get_running_loop()))] = client
+        self.addAsyncCleanup(lm_studio_client.aclose_all_pools)
+
+    async def test_transient_error_is_retried(self):
+        responses = [httpx.Response(502, json={}), httpx.Response(200, json=_completion("ok"))]
+        self.install("http://retry-node", lambda request: responses.pop(0))
+        client = AsyncLMStudioClient(base_url="http://retry-node", retry_budget=RetryBudget())
+
+        self.assertEqual(await client.generate_response("質問", "文脈"), "ok")
+        self.assertEqual(responses, [])
+
+    async def test_exhausted_budget_raises_first_error(self):
+        calls = []
+
+        def handler(request):
+            calls.append(request)
+            return httpx.Response(503, json={})
+
+        self.install("http://budget-node", handler)
+        client = AsyncLMStudioClient(base_url="http://budget-node",
+                                     retry_budget=RetryBudget(ratio=0.0, min_per_second=0.0, max_tokens=0.0))
+        with self.assertRaises(httpx.HTTPStatusError):
+            await client.generate_response("質問", "文脈")
+        self.assertEqual(len(calls), 1)
+
+    async def test_slow_call_is_hedged_to_other_endpoint(self):
+        async def slow(request):
+            await asyncio.sleep(1.0)
+            return httpx.Response(200, json=_completion("slow"))
+
+        self.install("http://hedge-slow", slow)
+        self.install("http://hedge-fast", lambda request: httpx.Response(200, json=_completion("fast")))
+        client = AsyncLMStudioClient(pool=EndpointPool(["http://hedge-slow", "http://hedge-fast"]), hedge=True)
+        for _ in range(client.latency.min_samples):
+            client.latency.observe(0.02)
+
+        started = time.monotonic()
+        result = await client.generate_response("質問", "文脈")
+
+        self.assertEqual(result, "fast")
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(client.stats()["hedging"]["won"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
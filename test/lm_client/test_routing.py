@@ -0,0 +1,63 @@
+# test_routing.py
+import asyncio
+import unittest
+
+import httpx
+
+from lm_studio_rag import lm_studio_client
+from lm_studio_rag.fake_server import FakeServerConfig, create_app
+from lm_studio_rag.lm_studio_client import AsyncLMStudioClient
+from lm_studio_rag.routing import ModelRouter, StageProfile, STAGE_RAG_QUERY, STAGE_FINAL_RESPONSE, STAGE_CLASSIFICATION
+
+
+class TestModelRouter(unittest.IsolatedAsyncioTestCase):
+    """
+    段階ごとのモデル・生成長の振り分けと、段階別トークン使用量の集計を検証するテスト。
+    """
+
+    BASE_URL = "http://routing.test"
+
+    def test_profiles_merge_over_defaults(self):
+        router = ModelRouter({STAGE_RAG_QUERY: {"model": "tiny", "max_tokens": 8, "stop": ["\n"]},
+                              STAGE_CLASSIFICATION: {"model": "tiny"}},
+                             default=StageProfile(model="big"))
+        self.assertEqual(router.profile(STAGE_RAG_QUERY), StageProfile(model="tiny", max_tokens=8, stop=("\n",)))
+        # built-in classification caps survive a partial override
+        self.assertEqual(router.profile(STAGE_CLASSIFICATION), StageProfile(model="tiny", max_tokens=200, temperature=0.0))
+        self.assertEqual(router.profile(STAGE_FINAL_RESPONSE).model, "big")
+
+    async def test_stage_routes_request_and_reports_usage(self):
+        app = create_app(FakeServerConfig(ttft=0.0, tokens_per_sec=0, models=["big", "tiny"]))
+        http = httpx.AsyncClient(base_url=self.BASE_URL, transport=httpx.ASGITransport(app=app))
+        lm_studio_client._async_clients[(self.BASE_URL, id(asyncio.get_running_loop()))] = http
+        self.addAsyncCleanup(lm_studio_client.aclose_all_pools)
+        router = ModelRouter({STAGE_RAG_QUERY: {"model": "tiny", "max_tokens": 3}}, default=StageProfile(model="big"))
+        client = AsyncLMStudioClient(base_url=self.BASE_URL, router=router)
+
+        sent = []
+        original = client._post
+
+        async def spy(path, payload, **kwargs):
+            sent.append(payload)
+            return await original(path, payload, **kwargs)
+
+        client._post = spy
+        await client.generate_response("質問", "文脈", stage=STAGE_RAG_QUERY)
+        await client.generate_response("質問", "文脈", stage=STAGE_RAG_QUERY)
+        deltas = [d async for d in client.generate_response_stream("質問", "別の文脈", stage=STAGE_FINAL_RESPONSE)]
+
+        self.assertEqual((sent[0]["model"], sent[0]["max_tokens"]), ("tiny", 3))
+        # explicit arguments win over the stage profile
+        await client.generate_response("質問", "文脈", max_tokens=7, temperature=0.0, stage=STAGE_RAG_QUERY)
+        self.assertEqual((sent[-1]["model"], sent[-1]["max_tokens"], sent[-1]["temperature"]), ("tiny", 7, 0.0))
+        usage = client.stats()["routing"]["usage"]
+        self.assertEqual((usage[STAGE_RAG_QUERY]["calls"], usage[STAGE_RAG_QUERY]["cached"]), (3, 0))
+        self.assertEqual(usage[STAGE_RAG_QUERY]["completion_tokens"], 13)
+        self.assertEqual(usage[STAGE_RAG_QUERY]["truncated"], 3)
+        self.assertGreater(usage[STAGE_RAG_QUERY]["prompt_tokens"], 0)
+        self.assertEqual(usage[STAGE_FINAL_RESPONSE]["completion_tokens"], len(deltas))
+        self.assertEqual(usage[STAGE_FINAL_RESPONSE]["models"], {"big": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
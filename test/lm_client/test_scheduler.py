@@ -0,0 +1,122 @@
+# test_scheduler.py
+import asyncio
+import unittest
+
+from lm_studio_rag.adaptive_limit import AdaptiveLimit
+from lm_studio_rag.scheduler import LLMScheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+
+
+class TestLLMScheduler(unittest.IsolatedAsyncioTestCase):
+    """
+    LLMScheduler の同時実行上限と優先度順の払い出しを検証するテスト。
+    """
+
+    async def test_in_flight_never_exceeds_cap(self):
+        scheduler = LLMScheduler(max_in_flight=2)
+        peak = 0
+
+        async def call():
+            nonlocal peak
+            async with scheduler.aslot():
+                peak = max(peak, scheduler.stats()["in_flight"])
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*[call() for _ in range(6)])
+        stats = scheduler.stats()
+        self.assertEqual(peak, 2)
+        self.assertEqual(stats["in_flight"], 0)
+        self.assertEqual(stats["served"][PRIORITY_INTERACTIVE], 6)
+
+    async def test_interactive_overtakes_queued_background(self):
+        scheduler = LLMScheduler(max_in_flight=1)
+        order = []
+
+        async def call(name, priority):
+            async with scheduler.aslot(priority):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        blocker = asyncio.ensure_future(call("blocker", PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        tasks = [asyncio.ensure_future(call(f"bg{i}", PRIORITY_BACKGROUND)) for i in range(2)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(call("live", PRIORITY_INTERACTIVE)))
+        await asyncio.gather(blocker, *tasks)
+
+        self.assertEqual(order, ["blocker", "live", "bg0", "bg1"])
+
+    async def test_cancelled_waiter_does_not_leak_slot(self):
+        scheduler = LLMScheduler(max_in_flight=1)
+        await scheduler.acquire_async()
+        waiter = asyncio.ensure_future(scheduler.acquire_async(PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        scheduler.release()
+
+        await asyncio.wait_for(scheduler.acquire_async(), timeout=1)
+        self.assertEqual(scheduler.stats()["in_flight"], 1)
+
+
+class TestAdaptiveLimit(unittest.TestCase):
+
+    def test_limit_grows_while_latency_is_flat_and_saturated(self):
+        for algorithm in ("aimd", "gradient"):
+            limit = AdaptiveLimit(algorithm, initial_limit=4)
+            for _ in range(200):
+                limit.update(0.1, in_flight=limit.limit)
+            self.assertGreater(limit.limit, 8, algorithm)
+
+    def test_limit_does_not_grow_when_not_saturated(self):
+        limit = AdaptiveLimit("gradient", initial_limit=4)
+        for _ in range(200):
+            limit.update(0.1, in_flight=1)
+        self.assertEqual(limit.limit, 4)
+
+    def test_latency_inflation_and_errors_back_off(self):
+        for algorithm in ("aimd", "gradient"):
+            limit = AdaptiveLimit(algorithm, initial_limit=32)
+            for _ in range(50):
+                limit.update(0.1, in_flight=limit.limit)
+            before = limit.limit
+            for _ in range(50):
+                limit.update(1.0, in_flight=limit.limit)
+                limit._last_decrease = 0.0  # let every sample count in the test
+            self.assertLess(limit.limit, before, algorithm)
+            self.assertGreater(len(limit.history), 1)
+
+        limit = AdaptiveLimit("aimd", initial_limit=10)
+        limit.update(0.1, in_flight=1, dropped=True)
+        self.assertEqual(limit.limit, 9)
+
+    def test_scheduler_follows_limiter(self):
+        scheduler = LLMScheduler(limiter=AdaptiveLimit("aimd", initial_limit=10))
+        self.assertEqual(scheduler.max_in_flight, 10)
+        with scheduler.slot():
+            pass
+        with self.assertRaises(RuntimeError):
+            with scheduler.slot():
+                raise RuntimeError("backend error")
+
+        stats = scheduler.stats()
+        self.assertEqual((stats["adaptive"]["samples"], stats["adaptive"]["drops"]), (2, 1))
+        self.assertEqual(scheduler.max_in_flight, 9)
+
+    def test_client_errors_are_completed_samples_not_drops(self):
+        scheduler = LLMScheduler(limiter=AdaptiveLimit("aimd", initial_limit=10))
+        is_drop = lambda e: isinstance(e, TimeoutError)  # クライアントの判定（429 / 5xx / 通信エラー）の代わり
+        with self.assertRaises(ValueError):
+            with scheduler.slot(is_drop=is_drop):
+                raise ValueError("400 unknown model")
+        self.assertEqual(scheduler.stats()["adaptive"]["drops"], 0)
+        with self.assertRaises(TimeoutError):
+            with scheduler.slot(is_drop=is_drop):
+                raise TimeoutError()
+
+        stats = scheduler.stats()
+        self.assertEqual((stats["adaptive"]["samples"], stats["adaptive"]["drops"]), (2, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,243 @@
+# test_storage.py
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from lm_studio_rag import storage as storage_module
+from lm_studio_rag.ann_index import index_kind
+from lm_studio_rag.storage import RAGStorage
+
+
+class CountingEmbeddingClient:
+    """Deterministic embed_texts: one-hot on text length, records each call's batch."""
+
+    def __init__(self, dim: int = 8):
+        self.dim = dim
+        self.calls = []
+
+    def embed_texts(self, texts, model=None):
+        self.calls.append(list(texts))
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            vectors[row, len(text) % self.dim] = 1.0
+        return vectors
+
+
+class HashEmbeddingClient(CountingEmbeddingClient):
+    """Deterministic dense vectors seeded by the text, so compact codecs and PCA have something to lose."""
+
+    def embed_texts(self, texts, model=None):
+        self.calls.append(list(texts))
+        seeds = [int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little") for text in texts]
+        return np.stack([np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32) for seed in seeds])
+
+
+class TestRAGStorageBatch(unittest.TestCase):
+    """
+    RAGStorage.save_batch の一括投入と、FAISS インデックスの永続化・再起動時の復元を検証するテスト。
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        for name, filename in (("METADATA_STORE_PATH", "meta.db"), ("FAISS_INDEX_PATH", "faiss.index")):
+            patcher = mock.patch.object(storage_module, name, os.path.join(self.tmp.name, filename))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+        self.client = CountingEmbeddingClient()
+        self.storage = self.open_storage()
+
+    def open_storage(self) -> RAGStorage:
+        return RAGStorage(dim=8, vector_db_type="faiss", embedding_backend="remote", embedding_client=self.client)
+
+    def test_batches_are_length_bucketed_and_ids_follow_input_order(self):
+        texts = ["a" * n for n in (7, 1, 5, 3, 2, 6)]
+        progress = []
+        ids = self.storage.save_batch(texts, [{"n": i} for i in range(len(texts))], category="experience",
+                                      batch_size=4, progress=lambda done, total: progress.append((done, total)))
+
+        self.assertEqual(self.client.calls, [["a", "aa", "aaa", "aaaaa"], ["aaaaaa", "aaaaaaa"]])
+        self.assertEqual(progress, [(4, 6), (6, 6)])
+        for text, id_str, n in zip(texts, ids, range(len(texts))):
+            entry = self.storage.metadata[id_str]
+            self.assertEqual((entry["text"], entry["meta"]["n"], entry["meta"]["category"]), (text, n, "experience"))
+
+        hits = self.storage.search_similar("aaa", category="experience", top_k=1)
+        self.assertEqual(hits[0]["text"], "aaa")
+
+    def test_restart_reloads_index_and_re_embeds_unsaved_tail(self):
+        self.storage.save_batch(["a", "bb"], category="experience")
+        # single saves below FAISS_PERSIST_EVERY only reach the metadata table
+        self.storage.save_experience_data("cccc", {"source": "late"})
+        late_id = next(k for k, v in self.storage.metadata.items() if v["text"] == "cccc")
+        self.assertEqual(self.storage.index.ntotal, 3)
+
+        self.client.calls.clear()
+        restarted = self.open_storage()
+
+        self.assertEqual(self.client.calls, [["cccc"]])
+        self.assertEqual(restarted.index.ntotal, 3)
+        self.assertEqual(restarted.metadata[late_id]["meta"]["source"], "late")
+        self.assertEqual(restarted.search_similar("bb", top_k=1)[0]["text"], "bb")
+        self.assertEqual(restarted.search_similar("cccc", top_k=1)[0]["text"], "cccc")
+
+    def test_delete_and_upsert_survive_restart_and_compaction_drops_tombstones(self):
+        ids = self.storage.upsert([f"doc{i}" for i in range(10)], ["a" * n for n in range(1, 11)],
+                                  [{"category": "experience"} for _ in range(10)])
+        self.storage.persist()
+
+        self.assertEqual(self.storage.delete(["doc2", "missing"]), 1)
+        self.assertEqual(self.storage.index.ntotal, 10)  # tombstoned, not yet compacted
+        self.assertNotIn("aaa", [hit["text"] for hit in self.storage.search_similar("aaa", top_k=10)])
+
+        self.storage.upsert(["doc4"], ["bbbbbbb"], [{"category": "experience", "v": 2}])
+        hits = self.storage.search_similar("bbbbbbb", top_k=10)
+        self.assertEqual([hit["id"] for hit in hits].count("doc4"), 1)
+        self.assertEqual(self.storage.metadata["doc4"]["text"], "bbbbbbb")
+
+        self.client.calls.clear()
+        restarted = self.open_storage()
+        # only the rows written since the last persist are re-applied
+        self.assertEqual(self.client.calls, [["bbbbbbb"]])
+        self.assertNotIn("doc2", restarted.metadata)
+        self.assertEqual(restarted.metadata["doc4"]["meta"]["v"], 2)
+        self.assertEqual((len(restarted.metadata), restarted.index.ntotal), (9, 9))
+
+        restarted.delete(["doc0"])
+        self.assertEqual(restarted.index.ntotal, 9)
+        restarted.delete(["doc1"])  # 2 dead of 9 reaches FAISS_COMPACT_TOMBSTONE_RATIO
+        self.assertEqual(restarted.index.ntotal, 7)
+        self.assertEqual(restarted._meta_db.execute("SELECT COUNT(*) FROM faiss_documents").fetchone()[0], 7)
+        self.assertEqual(sorted(restarted.metadata), sorted(set(ids) - {"doc0", "doc1", "doc2"}))
+
+    def test_flat_index_is_promoted_to_hnsw_at_threshold_and_survives_restart(self):
+        with mock.patch.object(storage_module, "FAISS_INDEX_TYPE", "hnsw"), \
+                mock.patch.object(storage_module, "FAISS_ANN_THRESHOLD", 4), \
+                mock.patch.object(storage_module, "FAISS_COMPACT_TOMBSTONE_RATIO", 0.5):
+            ids = self.storage.upsert(["d1", "d2", "d3"], ["a", "bb", "ccc"])
+            self.assertEqual(index_kind(self.storage.index), "flat")
+            self.storage.upsert(["d4"], ["dddd"])
+            self.assertEqual(index_kind(self.storage.index), "hnsw")
+
+            # HNSW cannot remove: the old vector of d2 stays until a rebuild, but is never returned twice
+            self.storage.upsert(["d2"], ["eeeee"])
+            self.assertEqual(self.storage.index.ntotal, 5)
+            hits = self.storage.search_similar("eeeee", top_k=4, ef_search=8)
+            self.assertEqual(sorted(hit["id"] for hit in hits), sorted(ids + ["d4"]))
+            self.assertEqual(hits[0]["text"], "eeeee")
+
+            restarted = self.open_storage()
+            self.assertEqual((index_kind(restarted.index), len(restarted.metadata)), ("hnsw", 4))
+            self.assertEqual(restarted.search_similar("dddd", top_k=1)[0]["id"], "d4")
+
+            restarted.compact()  # rebuilds without the stale copy
+            self.assertEqual((index_kind(restarted.index), restarted.index.ntotal), ("hnsw", 4))
+
+    def test_filters_are_applied_before_the_knn_scan(self):
+        # every personality row is closer to the query than any experience row
+        self.storage.upsert([f"p{i}" for i in range(20)], [f"p{i:02d}" for i in range(20)],
+                            [{"category": "personality", "saved_ts": 100} for _ in range(20)])
+        self.storage.upsert(["e1", "e2", "e3"], ["exp1", "exp02", "exp003"], [
+            {"category": "experience", "source": "chat", "saved_ts": 100},
+            {"category": "experience", "source": "initial", "saved_ts": 200},
+            {"category": "experience", "source": "chat", "saved_at": "1970-01-01T00:05:00Z"},
+        ])
+
+        hits = self.storage.search_similar("xyz", category="experience", top_k=3)
+        self.assertEqual(sorted(hit["id"] for hit in hits), ["e1", "e2", "e3"])
+        hits = self.storage.search_similar("xyz", top_k=3, where={"source": ["chat", "web"]}, saved_after=150)
+        self.assertEqual([hit["id"] for hit in hits], ["e3"])  # saved_at is used when saved_ts is absent
+        self.storage.delete(["e3"])
+        self.assertEqual(self.storage.search_similar("xyz", where={"source": "chat"}, saved_after=150), [])
+        with self.assertRaises(ValueError):
+            self.storage.search_similar("xyz", where={"reasoning": "x"})
+
+    def test_search_similar_many_encodes_distinct_queries_once_and_filters_per_query(self):
+        self.storage.upsert([f"p{i}" for i in range(6)], ["aaa", "bbbb", "ccccc", "dd", "e", "ffffff"],
+                            [{"category": "personality"} for _ in range(6)])
+        self.storage.upsert(["e1", "e2"], ["gggggggg", "hhhhhhh"], [{"category": "experience"} for _ in range(2)])
+        self.client.calls.clear()
+        many = self.storage.search_similar_many(["xxx", "xxx", "xxx", "bbbb"], [None, "personality", "experience", None],
+                                                top_k=2)
+        self.assertEqual(self.client.calls, [["xxx", "bbbb"]])
+        self.assertEqual([hits[0]["id"] for hits in many[:2]], ["p0", "p0"])
+        self.assertEqual([hit["metadata"]["category"] for hit in many[1]], ["personality"] * 2)
+        # every nearer neighbour is a personality row; the experience query still gets its top_k
+        self.assertEqual(sorted(hit["id"] for hit in many[2]), ["e1", "e2"])
+        self.assertEqual(many[3][0]["id"], self.storage.search_similar("bbbb", top_k=1)[0]["id"])
+
+    def test_compact_vectors_are_rescored_exactly_and_rebuilt_from_stored_vectors(self):
+        client = HashEmbeddingClient(dim=16)
+        open_compact = lambda: RAGStorage(dim=16, vector_db_type="faiss", embedding_backend="remote",
+                                          embedding_client=client)
+        texts = [f"memory {i}" for i in range(60)]
+        with mock.patch.object(storage_module, "FAISS_VECTOR_CODEC", "int8"), \
+                mock.patch.object(storage_module, "FAISS_PCA_DIM", 8), \
+                mock.patch.object(storage_module, "FAISS_CODEC_MIN_VECTORS", 40):
+            storage = open_compact()
+            storage.upsert([f"d{i}" for i in range(30)], texts[:30])
+            self.assertEqual(storage._layout(), ("flat", "float32", 0))
+            storage.upsert([f"d{i}" for i in range(30, 60)], texts[30:])
+            self.assertEqual(storage._layout(), ("flat", "int8", 8))
+            self.assertEqual(storage.memory_estimate(), 60 * (8 + 8 + storage_module._DOC_OVERHEAD_BYTES))
+
+            for i in (3, 42):
+                hit = storage.search_similar(texts[i], top_k=1)[0]
+                self.assertEqual(hit["id"], f"d{i}")
+                self.assertAlmostEqual(hit["score"], 1.0, places=5)  # exact cosine, not the int8/PCA estimate
+            storage.delete(["d3"])
+            self.assertNotEqual(storage.search_similar(texts[3], top_k=1)[0]["id"], "d3")
+
+            client.calls.clear()
+            restarted = open_compact()
+            self.assertEqual((restarted._layout(), restarted.index.ntotal), (("flat", "int8", 8), 59))
+            self.assertEqual(restarted.search_similar(texts[42], top_k=1)[0]["id"], "d42")
+        # back to float32: rebuilt from the stored full vectors, nothing re-embedded but the query
+        client.calls.clear()
+        restored = open_compact()
+        self.assertEqual(restored._layout(), ("flat", "float32", 0))
+        self.assertEqual(client.calls, [])
+        self.assertAlmostEqual(restored.search_similar(texts[7], top_k=1)[0]["score"], 1.0, places=5)
+
+
+
+class _Settings:
+    """chromadb.config.Settings の代わり（pydantic v1 と同じく __fields__ でキーを公開する）"""
+    __fields__ = {"chroma_segment_cache_policy": None, "chroma_memory_limit_bytes": None, "chroma_api_impl": None}
+
+    def __init__(self, **values):
+        self.values = values
+        self.chroma_api_impl = "chromadb.api.rust.RustBindingsAPI"
+
+
+class _LegacySettings(_Settings):
+    __fields__ = {"chroma_api_impl": None}
+
+
+class TestChromaSettings(unittest.TestCase):
+    """
+    Chroma クライアントのセグメント LRU 設定が、キーを持つ chromadb にだけ渡されることを検証するテスト。
+    """
+
+    def test_lru_keys_are_only_passed_when_declared(self):
+        self.assertEqual(storage_module._chroma_settings(_Settings, 1 << 20).values,
+                         {"chroma_segment_cache_policy": "LRU", "chroma_memory_limit_bytes": 1 << 20})
+        with self.assertLogs("storage", "WARNING"):
+            self.assertEqual(storage_module._chroma_settings(_LegacySettings, 1 << 20).values, {})
+        self.assertEqual(storage_module._chroma_settings(_Settings, 0).values, {})
+
+    def test_installed_chromadb_accepts_the_lru_keys(self):
+        try:
+            from chromadb.config import Settings
+        except ImportError:
+            self.skipTest("chromadb is not installed")
+        settings = storage_module._chroma_settings(Settings, 1 << 20)
+        self.assertEqual((settings.chroma_segment_cache_policy, settings.chroma_memory_limit_bytes), ("LRU", 1 << 20))
+
+
+if __name__ == "__main__":
+    unittest.main()